@@ -1,18 +1,239 @@
+
 # === Accounting Logic ===
 
+import os
+import time
+import threading
+from datetime import datetime, date
 from flask import jsonify
+from sqlalchemy import select, literal, func, union_all
+from app import db
+from models import Budget, SpendRollup, PurchaseRequest, CashDemand, ExpenseRecord, User
+from rollups import (SPEND_CATEGORIES, UNASSIGNED_DEPARTMENT, month_start, spend_timeseries, bucket_label,
+                     add_to_bucket, approved_amount)
+from ledger import post_entry
+from budget_guard import sync_counter
+from downsampling import lttb_indices
+
+# Seconds a cached summary is served before it is recomputed. Approvals
+# clear this worker's cache immediately; other workers catch up within the TTL.
+ACCOUNTING_CACHE_SECONDS = int(os.environ.get("ACCOUNTING_CACHE_SECONDS", 60))
+
+# Browser cache lifetime for time series made only of closed buckets
+TIMESERIES_CLOSED_MAX_AGE = int(os.environ.get("TIMESERIES_CLOSED_MAX_AGE", 30 * 86400))
+
+# Months shown in the expense trend, including the selected one
+TREND_MONTHS = 6
+
+_summary_cache = {}
+_summary_lock = threading.Lock()
+
+def parse_period(value=None):
+    """First day of the month named by 'YYYY-MM', defaulting to the current month"""
+    if not value:
+        return month_start(datetime.utcnow().date())
+    try:
+        return datetime.strptime(value, '%Y-%m').date()
+    except ValueError:
+        raise ValueError("period must be in YYYY-MM format")
+
+def parse_series_date(value):
+    """Date from 'YYYY-MM-DD' or 'YYYY-MM' (first of the month), or None"""
+    if not value:
+        return None
+    for fmt in ('%Y-%m-%d', '%Y-%m'):
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            pass
+    raise ValueError("dates must be in YYYY-MM-DD or YYYY-MM format")
+
+def add_months(day, months):
+    month_index = day.year * 12 + day.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+def get_accounting_summary(period=None):
+    period_start = parse_period(period)
+    key = period_start.isoformat()
+    now = time.monotonic()
+
+    cached = _summary_cache.get(key)
+    if cached and cached[0] > now:
+        return jsonify(cached[1])
+
+    summary = build_accounting_summary(period_start)
+    with _summary_lock:
+        _summary_cache[key] = (now + ACCOUNTING_CACHE_SECONDS, summary)
+    return jsonify(summary)
+
+def build_accounting_summary(period_start):
+    """Budget vs actual per department and category, plus the monthly spend trend"""
+    # Budgets and rollup actuals are stacked and summed in one grouped query,
+    # so departments with spend but no budget (and vice versa) both show up
+    budgets = select(
+        Budget.department, Budget.category,
+        Budget.amount.label('budget'), literal(0.0).label('actual')
+    ).where(Budget.period_start == period_start)
+    actuals = select(
+        SpendRollup.department, SpendRollup.category,
+        literal(0.0).label('budget'), SpendRollup.amount.label('actual')
+    ).where(SpendRollup.period_start == period_start)
+    combined = union_all(budgets, actuals).subquery()
+    rows = db.session.execute(
+        select(combined.c.department, combined.c.category,
+               func.sum(combined.c.budget), func.sum(combined.c.actual))
+        .group_by(combined.c.department, combined.c.category)
+        .order_by(combined.c.department, combined.c.category)
+    ).all()
+
+    by_category = {category: {"category": category, "budget": 0, "actual": 0}
+                   for category in SPEND_CATEGORIES.values()}
+    departments = []
+    for department, category, budget, actual in rows:
+        budget = round(budget or 0, 2)
+        actual = round(actual or 0, 2)
+        totals = by_category.setdefault(category, {"category": category, "budget": 0, "actual": 0})
+        totals["budget"] += budget
+        totals["actual"] += actual
+        departments.append({
+            "department": department,
+            "category": category,
+            "budget": budget,
+            "actual": actual,
+            "variance": round(budget - actual, 2)
+        })
 
-def get_accounting_summary():
-    return jsonify({
+    trend = spend_timeseries('month', add_months(period_start, 1 - TREND_MONTHS), period_start)
+    monthly_expense = [
+        {
+            "month": month.strftime('%b'),
+            "period": month.strftime('%Y-%m'),
+            "amount": round(sum(spend.values()), 2)
+        }
+        for month, _, spend in trend
+    ]
+
+    return {
+        "period": period_start.strftime('%Y-%m'),
         "budget_vs_actual": [
-            {"category": "Labor", "budget": 50000, "actual": 46000},
-            {"category": "Materials", "budget": 80000, "actual": 82000},
-            {"category": "Transport", "budget": 10000, "actual": 7500}
+            {**totals, "budget": round(totals["budget"], 2), "actual": round(totals["actual"], 2)}
+            for totals in by_category.values()
         ],
-        "monthly_expense": [
-            {"month": "Jan", "amount": 12000},
-            {"month": "Feb", "amount": 15000},
-            {"month": "Mar", "amount": 9800},
-            {"month": "Apr", "amount": 17500}
-        ]
-    })
+        "departments": departments,
+        "monthly_expense": monthly_expense
+    }
+
+def get_spend_timeseries(granularity='month', start=None, end=None, department=None, points=None):
+    """Spend series payload and whether every bucket in it is closed.
+
+    With points, the series is reduced to that many buckets by LTTB on the
+    totals, keeping the first and last bucket.
+    """
+    series = []
+    for bucket, closed, spend in spend_timeseries(granularity, start, end):
+        if department:
+            spend = {department: spend.get(department, 0)}
+        series.append({
+            "period": bucket_label(bucket, granularity),
+            "start": bucket.isoformat(),
+            "closed": closed,
+            "total": round(sum(spend.values()), 2),
+            "departments": {name: round(amount, 2) for name, amount in sorted(spend.items())}
+        })
+    if points is not None:
+        if points < 3:
+            raise ValueError("points must be at least 3")
+        keep = lttb_indices(range(len(series)), [point["total"] for point in series], points)
+        series = [series[index] for index in keep]
+    payload = {"granularity": granularity, "department": department, "series": series}
+    return payload, all(point["closed"] for point in series)
+
+def dashboard_metrics(today=None):
+    """Live figures for the AI dashboard cards.
+
+    Spend and request counts are month to date, projected to month end at
+    the current daily rate; risk is the worst department budget utilisation.
+    """
+    today = today or datetime.utcnow().date()
+    period_start = month_start(today)
+    days_in_month = (add_months(period_start, 1) - period_start).days
+    scale = days_in_month / ((today - period_start).days + 1)
+
+    spend = dict(db.session.execute(
+        select(SpendRollup.department, func.sum(SpendRollup.amount))
+        .where(SpendRollup.period_start == period_start).group_by(SpendRollup.department)
+    ).all())
+    budgets = dict(db.session.execute(
+        select(Budget.department, func.sum(Budget.amount))
+        .where(Budget.period_start == period_start).group_by(Budget.department)
+    ).all())
+    month_begin = datetime.combine(period_start, datetime.min.time())
+    requests = sum(
+        db.session.execute(select(func.count(model.id)).where(model.submitted_at >= month_begin)).scalar() or 0
+        for model in (PurchaseRequest, CashDemand, ExpenseRecord)
+    )
+
+    spend_to_date = sum(amount or 0 for amount in spend.values())
+    utilisation = max(((spend.get(department) or 0) / amount for department, amount in budgets.items() if amount),
+                      default=0)
+    return {
+        "period": period_start.strftime('%Y-%m'),
+        "spend_to_date": round(spend_to_date, 2),
+        "projected_spend": round(spend_to_date * scale, 2),
+        "requests_to_date": requests,
+        "projected_requests": round(requests * scale),
+        "headcount": db.session.execute(select(func.count(User.id))).scalar() or 0,
+        "budget_utilisation": round(utilisation * 100, 1),
+        "risk": "High" if utilisation >= 1 else "Medium" if utilisation >= 0.8 else "Low"
+    }
+
+def invalidate_accounting_summary(moment=None):
+    """Drop cached summaries for the month of moment, or all of them"""
+    with _summary_lock:
+        if moment is None:
+            _summary_cache.clear()
+            return
+        # The trend covers the following months too, so drop those as well
+        changed = month_start(moment.date() if isinstance(moment, datetime) else moment)
+        for key in [key for key in _summary_cache if key >= changed.isoformat()]:
+            _summary_cache.pop(key, None)
+
+def record_status_change(request_type, item, previous_status):
+    """Keep the ledger and spend rollups in step with an approval decision; the caller commits.
+
+    Approvals are journaled and added to the approval day's bucket. Revoking
+    an earlier approval is booked as a negative entry on the day it happens
+    so closed months are never rewritten.
+    """
+    if request_type not in SPEND_CATEGORIES or previous_status == item.status:
+        return
+    if item.status == 'Approved':
+        sign, entry_type = 1, 'approval'
+    elif previous_status == 'Approved':
+        sign, entry_type = -1, 'reversal'
+    else:
+        return
+
+    department = getattr(item, 'department', None) or UNASSIGNED_DEPARTMENT
+    category = SPEND_CATEGORIES[request_type]
+    amount = sign * approved_amount(request_type, item)
+    post_entry(request_type, item.id, department, category, amount, item.reviewed_at, entry_type)
+    add_to_bucket(item.reviewed_at.date(), department, category, amount, count=sign)
+    invalidate_accounting_summary(item.reviewed_at)
+
+def set_budget(department, category, period_start, amount):
+    """Create or update a department's budget for a category and month"""
+    if category not in SPEND_CATEGORIES.values():
+        raise ValueError(f"Unknown budget category: {category}")
+    period_start = month_start(period_start)
+    budget = Budget.query.filter_by(department=department, category=category,
+                                    period_start=period_start).first()
+    if budget:
+        budget.amount = amount
+    else:
+        budget = Budget(department=department, category=category,
+                        period_start=period_start, amount=amount)
+        db.session.add(budget)
+    sync_counter(department, category, period_start, amount)
+    invalidate_accounting_summary(period_start)
+    return budget
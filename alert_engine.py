@@ -0,0 +1,164 @@
+# Sensor alert rules
+#
+# Rules are compiled once into tuples grouped by metric, and all state for
+# a sensor metric lives in one list, so evaluating a reading is a dict
+# lookup plus a few comparisons per rule on that metric. Like
+# timeseries_store, this module must not import the Flask app so the
+# benchmark can drive it directly.
+#
+# Rule kinds:
+#   threshold  value <op> limit
+#   rate       change per minute over each `for`-second window (default 60) <op> limit
+#   sustained  value <op> limit continuously for `for` seconds
+#
+# An alert fires once when its rule starts breaching and resolves once the
+# rule has stayed clear for `clear` seconds, so a value flapping around
+# the limit produces a single alert. Rules on a sensor seen for the first
+# time start clear, so only a real fire/resolve pair reaches the receiver.
+# The state list for a sensor metric is plain JSON-able data: callers with
+# several processes (iot_ingest) keep it in the database and pass it in,
+# so every reading of a sensor is evaluated against the same state.
+
+import json
+import operator
+from collections import namedtuple
+
+_OPERATORS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le}
+
+_THRESHOLD, _RATE, _SUSTAINED = 0, 1, 2
+_KINDS = {'threshold': _THRESHOLD, 'rate': _RATE, 'sustained': _SUSTAINED}
+
+# Mirrors the hand-written sensor_alerts in project_context.json
+DEFAULT_ALERT_RULES = [
+    {'name': 'heat', 'label': 'High temperature', 'metric': 'temperature', 'kind': 'threshold',
+     'op': '>', 'limit': 40, 'severity': 'critical'},
+    {'name': 'heat-rise', 'label': 'Rapid temperature rise', 'metric': 'temperature', 'kind': 'rate',
+     'op': '>', 'limit': 5, 'severity': 'warning'},
+    {'name': 'noise', 'label': 'Sustained noise', 'metric': 'noise', 'kind': 'sustained',
+     'op': '>', 'limit': 85, 'for': 60, 'severity': 'warning'},
+    {'name': 'leak', 'label': 'Possible water leakage', 'metric': 'humidity', 'kind': 'sustained',
+     'op': '>', 'limit': 75, 'for': 300, 'severity': 'critical'},
+]
+
+Rule = namedtuple('Rule', 'name label metric kind op limit seconds clear severity zones')
+Alert = namedtuple('Alert', 'state rule label severity sensor_id zone metric value timestamp')
+
+def compile_rule(spec):
+    """Rule from a dict spec; raises ValueError on a malformed one"""
+    try:
+        kind = _KINDS[spec.get('kind', 'threshold')]
+        op = _OPERATORS[spec.get('op', '>')]
+        limit = float(spec['limit'])
+        name = str(spec['name'])
+        metric = str(spec['metric'])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"invalid alert rule {spec!r}: {e}")
+    zones = frozenset(spec['zones']) if spec.get('zones') else None
+    seconds = float(spec.get('for', 60 if kind == _RATE else 0))
+    return Rule(name, spec.get('label', name), metric, kind, op, limit, seconds,
+                float(spec.get('clear', 60)), spec.get('severity', 'warning'), zones)
+
+def load_rules(path=None):
+    """Compiled rules from a JSON file of specs, or the defaults"""
+    specs = DEFAULT_ALERT_RULES
+    if path:
+        with open(path) as handle:
+            specs = json.load(handle)
+    return [compile_rule(spec) for spec in specs]
+
+class AlertEngine:
+    """Evaluates rules over readings in arrival order and returns alert transitions.
+
+    The engine keeps its own state unless process() is given one, so
+    rate and sustained rules see consecutive values of a sensor only when
+    all its readings go through the same state.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self._by_metric = {}
+        for rule in self.rules:
+            self._by_metric.setdefault(rule.metric, []).append(rule)
+        self.metrics = frozenset(self._by_metric)
+        # (sensor_id, metric) -> [last timestamp, then per rule: breach start
+        # (rate: window start), window start value, firing, clear start]
+        self._state = {}
+
+    def new_state(self, metric, timestamp, firing=()):
+        """State list for a sensor metric not seen yet; rules named in firing start as firing"""
+        state = [timestamp]
+        for rule in self._by_metric.get(metric, ()):
+            state += [None, None, rule.name in firing, None]
+        return state
+
+    def process(self, readings, states=None):
+        """Alerts fired or resolved by (sensor_id, zone, metric, value, epoch seconds) readings.
+
+        states, when given, is a (sensor_id, metric) -> state list dict used
+        instead of the engine's own; it is updated in place.
+        """
+        alerts = []
+        by_metric = self._by_metric
+        if states is None:
+            states = self._state
+        for sensor_id, zone, metric, value, timestamp in readings:
+            rules = by_metric.get(metric)
+            if rules is None:
+                continue
+            key = (sensor_id, metric)
+            state = states.get(key)
+            if state is None:
+                state = states[key] = [timestamp] + [None, None, False, None] * len(rules)
+            elif timestamp < state[0]:
+                continue  # late reading; newer data has been evaluated
+            state[0] = timestamp
+
+            slot = -3  # advanced to 1, the first rule's slot, at the top of the loop
+            for rule in rules:
+                slot += 4
+                if rule.zones is not None and zone not in rule.zones:
+                    continue
+                kind = rule.kind
+                if kind == _RATE:
+                    window_start = state[slot]
+                    if window_start is None:
+                        state[slot], state[slot + 1] = timestamp, value
+                        continue
+                    elapsed = timestamp - window_start
+                    if elapsed < rule.seconds:
+                        continue
+                    breached = rule.op((value - state[slot + 1]) * 60 / elapsed, rule.limit)
+                    state[slot], state[slot + 1] = timestamp, value
+                else:
+                    breached = rule.op(value, rule.limit)
+                    if kind == _SUSTAINED:
+                        if not breached:
+                            state[slot] = None
+                        elif state[slot] is None:
+                            state[slot] = timestamp
+                        breached = breached and timestamp - state[slot] >= rule.seconds
+
+                if breached:
+                    state[slot + 3] = None
+                    if not state[slot + 2]:
+                        state[slot + 2] = True
+                        alerts.append(Alert('fired', rule.name, rule.label, rule.severity,
+                                            sensor_id, zone, metric, value, timestamp))
+                elif state[slot + 2]:
+                    if state[slot + 3] is None:
+                        state[slot + 3] = timestamp
+                    if timestamp - state[slot + 3] >= rule.clear:
+                        state[slot + 2] = False
+                        state[slot + 3] = None
+                        alerts.append(Alert('resolved', rule.name, rule.label, rule.severity,
+                                            sensor_id, zone, metric, value, timestamp))
+        return alerts
+
+    def firing(self):
+        """(rule name, sensor_id) of every alert currently firing"""
+        active = []
+        for (sensor_id, metric), state in self._state.items():
+            for index, rule in enumerate(self._by_metric.get(metric, ())):
+                if state[1 + index * 4 + 2]:
+                    active.append((rule.name, sensor_id))
+        return active
@@ -0,0 +1,75 @@
+# Badge registry
+#
+# Badges are stored as bits in LeaderboardEntry.badge_mask. A badge's bit is
+# permanent: append new badges with the next free bit and never reuse or
+# reorder existing ones. This module must not import the app or models,
+# since models.py builds its per-badge indexes from the registry.
+
+from collections import namedtuple
+from functools import lru_cache
+
+Badge = namedtuple('Badge', 'key bit label')
+
+BADGES = (
+    Badge('streak', 0, '🔥 Streak'),
+    Badge('pro', 1, '💼 Pro'),
+    Badge('focus', 2, '🎯 Focus'),
+    Badge('rising', 3, '🌟 Rising'),
+    Badge('punctual', 4, '⏱️ Punctual'),
+)
+
+BADGES_BY_KEY = {badge.key: badge for badge in BADGES}
+
+def badge_bit(key):
+    """Mask value of a badge key; raises KeyError for unknown badges"""
+    return 1 << BADGES_BY_KEY[key].bit
+
+def _normalize(name):
+    # Compare on the words only, so '🔥 Streak', 'Streak' and 'streak' match
+    return ''.join(ch for ch in name.lower() if ch.isalnum())
+
+_LOOKUP = {}
+for _badge in BADGES:
+    _LOOKUP[_normalize(_badge.key)] = _badge
+    _LOOKUP[_normalize(_badge.label)] = _badge
+
+def encode_badges(names):
+    """Mask for an iterable of badge keys or labels, plus the names not in the registry"""
+    mask, unknown = 0, []
+    for name in names:
+        badge = _LOOKUP.get(_normalize(name))
+        if badge:
+            mask |= 1 << badge.bit
+        elif name.strip():
+            unknown.append(name.strip())
+    return mask, unknown
+
+def parse_legacy_badges(value):
+    """Mask from the old comma-separated badges string"""
+    return encode_badges((value or '').split(','))
+
+@lru_cache(maxsize=1024)
+def decode_badges(mask):
+    """Badge labels set in a mask, in registry order"""
+    mask = mask or 0
+    return tuple(badge.label for badge in BADGES if mask & (1 << badge.bit))
+
+def badge_index_condition(badge):
+    """SQL predicate for the partial index over holders of a badge"""
+    return f"(badge_mask & {1 << badge.bit}) <> 0"
+
+# Rules checked after every XP event; state is the xp_pipeline user state
+BADGE_RULES = {
+    'streak': lambda state, event_type: state['streak'] >= 7,
+    'rising': lambda state, event_type: state['level'] >= 3,
+    'pro': lambda state, event_type: state['level'] >= 5,
+    'punctual': lambda state, event_type: event_type == 'timesheet_on_time',
+}
+
+def earned_mask(state, event_type):
+    """Badges a user qualifies for after an event"""
+    mask = 0
+    for key, rule in BADGE_RULES.items():
+        if rule(state, event_type):
+            mask |= badge_bit(key)
+    return mask
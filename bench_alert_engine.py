@@ -0,0 +1,60 @@
+# Benchmark: alert engine throughput on one core
+#
+# Feeds synthetic readings (sensors reporting temperature, humidity and
+# noise every second, with occasional excursions past the default rule
+# limits) through AlertEngine.process in ingest-sized batches and reports
+# readings per second and the number of alert transitions.
+#
+#   python bench_alert_engine.py
+#   python bench_alert_engine.py --sensors 1000 --seconds 300 --batch 5000
+
+import argparse
+import random
+import time
+from alert_engine import AlertEngine, load_rules
+
+def _readings(sensors, seconds, rng):
+    zones = ['Zone A', 'Zone B', 'Zone C', 'Zone D']
+    start = 1_700_000_000.0
+    readings = []
+    for second in range(seconds):
+        for sensor in range(sensors):
+            sensor_id = f"sensor-{sensor:04d}"
+            zone = zones[sensor % len(zones)]
+            hot = sensor % 50 == 0 and (second // 120) % 2 == 1
+            timestamp = start + second
+            readings.append((sensor_id, zone, 'temperature', rng.gauss(43 if hot else 28, 1.5), timestamp))
+            readings.append((sensor_id, zone, 'humidity', rng.gauss(80 if sensor % 97 == 0 else 45, 3), timestamp))
+            readings.append((sensor_id, zone, 'noise', rng.gauss(90 if hot else 60, 4), timestamp))
+    return readings
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sensors', type=int, default=500)
+    parser.add_argument('--seconds', type=int, default=600)
+    parser.add_argument('--batch', type=int, default=5000, help='readings per process() call')
+    parser.add_argument('--rules', help='JSON rules file (default: built-in rules)')
+    args = parser.parse_args()
+
+    readings = _readings(args.sensors, args.seconds, random.Random(7))
+    engine = AlertEngine(load_rules(args.rules))
+
+    fired = resolved = 0
+    started = time.perf_counter()
+    for start in range(0, len(readings), args.batch):
+        for alert in engine.process(readings[start:start + args.batch]):
+            if alert.state == 'fired':
+                fired += 1
+            else:
+                resolved += 1
+    elapsed = time.perf_counter() - started
+
+    print(f"rules             {len(engine.rules):>12}")
+    print(f"readings          {len(readings):>12,}")
+    print(f"throughput        {len(readings) / elapsed:>12,.0f} readings/s ({elapsed:.2f}s)")
+    print(f"alerts fired      {fired:>12,}")
+    print(f"alerts resolved   {resolved:>12,}")
+    print(f"still firing      {len(engine.firing()):>12,}")
+
+if __name__ == '__main__':
+    main()
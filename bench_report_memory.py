@@ -0,0 +1,84 @@
+# Benchmark: peak memory of PDF detail sections vs. row count
+#
+# Builds a single detail section from a synthetic row stream, once per row
+# count, each in a fresh subprocess so ru_maxrss reflects only that build.
+# "stream" uses FlowableStream + chunked LongTables (what the report
+# generator does); "list" materializes every row into one table first.
+#
+#   python bench_report_memory.py                 # 1k, 10k, 100k rows
+#   python bench_report_memory.py --rows 100000 --max-rows 5000
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+def _rows(count):
+    for i in range(count):
+        yield [f"Item {i}", str(i % 50 + 1), f"${i % 997:.2f}", f"${i % 9973:.2f}", 'Approved', 'Normal']
+
+def run_once(rows, mode, max_rows):
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.lib.units import inch
+    from reportlab.platypus import SimpleDocTemplate, LongTable
+    from report_layout import FlowableStream, detail_section, detail_table_style
+
+    styles = getSampleStyleSheet()
+    header = ['Item', 'Quantity', 'Unit Price', 'Total', 'Status', 'Urgency']
+    col_widths = [2, 0.7, 0.8, 0.8, 0.8, 0.7]
+
+    started = time.perf_counter()
+    with tempfile.TemporaryFile() as output:
+        doc = SimpleDocTemplate(output, pagesize=A4, topMargin=1*inch)
+        if mode == 'stream':
+            story = FlowableStream(detail_section(
+                'Purchase Requests', header, _rows(rows), col_widths, '#00D4AA',
+                styles['Heading2'], styles['Normal'], max_rows=max_rows, total_rows=rows
+            ))
+        else:
+            data = [header] + list(_rows(rows))
+            story = [LongTable(data, colWidths=[w * inch for w in col_widths], repeatRows=1,
+                               style=detail_table_style('#00D4AA'))]
+        doc.build(story)
+        output.seek(0, os.SEEK_END)
+        pdf_bytes = output.tell()
+
+    return {
+        'mode': mode,
+        'rows': rows,
+        'max_rows': max_rows,
+        'seconds': round(time.perf_counter() - started, 2),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'pdf_kb': pdf_bytes // 1024
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--mode', choices=['stream', 'list', 'both'], default='stream')
+    parser.add_argument('--max-rows', type=int, default=None, help='cap rows per section')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_once(args.rows[0], args.mode, args.max_rows)))
+        return
+
+    modes = ['stream', 'list'] if args.mode == 'both' else [args.mode]
+    print(f"{'mode':<8}{'rows':>10}{'cap':>8}{'seconds':>10}{'peak RSS MB':>14}{'PDF KB':>10}")
+    for mode in modes:
+        for rows in args.rows:
+            command = [sys.executable, __file__, '--child', '--mode', mode, '--rows', str(rows)]
+            if args.max_rows:
+                command += ['--max-rows', str(args.max_rows)]
+            result = json.loads(subprocess.check_output(command))
+            print(f"{result['mode']:<8}{result['rows']:>10}{result['max_rows'] or '-':>8}"
+                  f"{result['seconds']:>10}{result['peak_rss_mb']:>14}{result['pdf_kb']:>10}")
+
+if __name__ == '__main__':
+    main()
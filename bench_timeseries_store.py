@@ -0,0 +1,82 @@
+# Benchmark: time-series store ingest rate, compression and query speed
+#
+# Writes synthetic readings (one per sensor and metric every interval, with
+# a little clock jitter and values rounded like real sensors report them)
+# into a fresh store, then times a full range scan and per-window min/max/avg.
+# Bytes per point are the on-disk chunk file size over points written; a raw
+# (int64 timestamp, float64 value) pair is 16 bytes.
+#
+#   python bench_timeseries_store.py
+#   python bench_timeseries_store.py --sensors 200 --points 5000 --jitter 0
+
+import argparse
+import math
+import os
+import random
+import tempfile
+import time
+from timeseries_store import TimeSeriesStore, CHUNK_POINTS
+
+METRICS = (('temperature', 22.0, 6.0, 1), ('humidity', 45.0, 15.0, 0), ('noise', 60.0, 20.0, 1))
+
+def _series(sensor, metric, base, swing, digits, points, interval, jitter, rng):
+    phase = rng.random() * math.tau
+    timestamps, values = [], []
+    start = 1_700_000_000_000
+    for i in range(points):
+        timestamps.append(start + i * interval + (rng.randint(-jitter, jitter) if jitter else 0))
+        value = base + swing * math.sin(phase + i / 600) + rng.gauss(0, swing / 50)
+        values.append(round(value, digits))
+    return f"{sensor}/{metric}", timestamps, values
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sensors', type=int, default=50)
+    parser.add_argument('--points', type=int, default=10000, help='points per sensor and metric')
+    parser.add_argument('--interval', type=int, default=1000, help='ms between readings')
+    parser.add_argument('--jitter', type=int, default=20, help='max clock jitter in ms')
+    parser.add_argument('--chunk-points', type=int, default=CHUNK_POINTS)
+    parser.add_argument('--window', type=int, default=60, help='aggregate window in seconds')
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    data = [_series(f"sensor-{sensor:04d}", metric, base, swing, digits,
+                    args.points, args.interval, args.jitter, rng)
+            for sensor in range(args.sensors) for metric, base, swing, digits in METRICS]
+    total = len(data) * args.points
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = TimeSeriesStore(directory, writer_id='bench', chunk_points=args.chunk_points)
+        started = time.perf_counter()
+        # Interleave series the way live ingest does: one batch per interval
+        for i in range(args.points):
+            for name, timestamps, values in data:
+                store.append(name, timestamps[i], values[i])
+        store.flush()
+        ingest_seconds = time.perf_counter() - started
+        size = os.path.getsize(store.path)
+
+        name, timestamps, values = data[0]
+        reader = TimeSeriesStore(directory, writer_id='bench-reader', chunk_points=args.chunk_points)
+        started = time.perf_counter()
+        points = reader.scan(name, timestamps[0] - args.interval, timestamps[-1] + args.interval)
+        scan_seconds = time.perf_counter() - started
+        assert [value for _, value in points] == values
+
+        started = time.perf_counter()
+        windows = reader.aggregate(name, timestamps[0] - args.interval, timestamps[-1] + args.interval,
+                                   args.window * 1000)
+        aggregate_seconds = time.perf_counter() - started
+        reader.close()
+        store.close()
+
+    print(f"series            {len(data):>12,}")
+    print(f"points            {total:>12,}")
+    print(f"ingest            {total / ingest_seconds:>12,.0f} points/s ({ingest_seconds:.2f}s incl. encoding)")
+    print(f"on disk           {size:>12,} bytes")
+    print(f"bytes per point   {size / total:>12.2f} (raw 16.00, {16 * total / size:.1f}x)")
+    print(f"scan one series   {len(points) / scan_seconds:>12,.0f} points/s ({len(points):,} points)")
+    print(f"{args.window}s windows      {aggregate_seconds * 1000:>12.1f} ms ({len(windows):,} windows)")
+
+if __name__ == '__main__':
+    main()
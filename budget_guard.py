@@ -0,0 +1,135 @@
+import os
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import update, func
+from app import db
+from models import PurchaseRequest, CashDemand, BudgetCounter
+from rollups import month_start
+
+logger = logging.getLogger(__name__)
+
+# Hard limit as a multiple of the budget; the budget itself is the soft limit
+BUDGET_HARD_LIMIT_RATIO = float(os.environ.get("BUDGET_HARD_LIMIT_RATIO", 1.1))
+
+# Request types checked at submission, with their budget category
+GUARDED_REQUESTS = {
+    'purchase': (PurchaseRequest, PurchaseRequest.total_amount, 'Purchases'),
+    'demand': (CashDemand, CashDemand.amount, 'Cash Demands')
+}
+
+class BudgetExceeded(Exception):
+    """Raised when a submission would take a department past its hard limit"""
+
+    def __init__(self, department, category, remaining):
+        self.department = department
+        self.category = category
+        self.remaining = max(remaining, 0)
+        super().__init__(f"{department} has ${self.remaining:,.2f} of its {category} budget left")
+
+def request_amount(request_type, item):
+    if request_type == 'purchase':
+        return item.total_amount or 0
+    return item.amount or 0
+
+def _counter_filter(department, category, period_start):
+    return (
+        BudgetCounter.department == department,
+        BudgetCounter.category == category,
+        BudgetCounter.period_start == period_start
+    )
+
+def reserve(request_type, department, amount, moment=None, enforce=True):
+    """Reserve amount against the department's counter for the month of moment.
+
+    A single conditional UPDATE ... RETURNING both checks the hard limit and
+    books the amount, so concurrent submissions serialize on the counter row
+    only. Returns the counter state, or None when the department has no
+    budget for the month. Raises BudgetExceeded past the hard limit unless
+    enforce is False. Runs inside the caller's transaction.
+    """
+    if request_type not in GUARDED_REQUESTS or not department:
+        return None
+    category = GUARDED_REQUESTS[request_type][2]
+    period_start = month_start((moment or datetime.utcnow()).date())
+    conditions = _counter_filter(department, category, period_start)
+
+    guard = (BudgetCounter.reserved + amount <= BudgetCounter.hard_limit,) if enforce else ()
+    row = db.session.execute(
+        update(BudgetCounter)
+        .where(*conditions, *guard)
+        .values(reserved=BudgetCounter.reserved + amount)
+        .returning(BudgetCounter.reserved, BudgetCounter.soft_limit, BudgetCounter.hard_limit)
+    ).first()
+    if row:
+        return {
+            'reserved': row.reserved,
+            'soft_limit': row.soft_limit,
+            'hard_limit': row.hard_limit,
+            'over_soft_limit': row.reserved > row.soft_limit
+        }
+
+    counter = db.session.query(BudgetCounter.reserved, BudgetCounter.hard_limit).filter(*conditions).first()
+    if counter is None:
+        return None
+    raise BudgetExceeded(department, category, counter.hard_limit - counter.reserved)
+
+def release(request_type, department, amount, moment=None):
+    """Give back a reservation, e.g. when a request is rejected"""
+    reserve(request_type, department, -amount, moment, enforce=False)
+
+def sync_reservation(request_type, item, previous_status):
+    """Adjust the counter when a decision moves a request into or out of Rejected"""
+    if request_type not in GUARDED_REQUESTS or previous_status == item.status:
+        return
+    amount = request_amount(request_type, item)
+    if item.status == 'Rejected':
+        release(request_type, item.department, amount, item.submitted_at)
+    elif previous_status == 'Rejected':
+        reserve(request_type, item.department, amount, item.submitted_at, enforce=False)
+
+def remaining_budget(request_type, department, moment=None):
+    """Counter state for a department this month, or None without a budget"""
+    if request_type not in GUARDED_REQUESTS:
+        return None
+    category = GUARDED_REQUESTS[request_type][2]
+    period_start = month_start((moment or datetime.utcnow()).date())
+    counter = BudgetCounter.query.filter(*_counter_filter(department, category, period_start)).first()
+    if counter is None:
+        return None
+    return {
+        'department': department,
+        'category': category,
+        'reserved': round(counter.reserved, 2),
+        'soft_remaining': round(counter.soft_limit - counter.reserved, 2),
+        'hard_remaining': round(counter.hard_limit - counter.reserved, 2)
+    }
+
+def sync_counter(department, category, period_start, budget_amount):
+    """Create or re-limit the counter behind a budget; the caller commits.
+
+    A new counter starts from the month's non-rejected submissions, the only
+    time history is summed.
+    """
+    request_type = next((key for key, (_, _, name) in GUARDED_REQUESTS.items() if name == category), None)
+    if request_type is None:
+        return None
+
+    limits = dict(soft_limit=budget_amount, hard_limit=budget_amount * BUDGET_HARD_LIMIT_RATIO)
+    counter = BudgetCounter.query.filter(*_counter_filter(department, category, period_start)).first()
+    if counter:
+        for name, value in limits.items():
+            setattr(counter, name, value)
+        return counter
+
+    model, amount, _ = GUARDED_REQUESTS[request_type]
+    period_end = (period_start + timedelta(days=32)).replace(day=1)
+    reserved = db.session.query(func.coalesce(func.sum(amount), 0)).filter(
+        model.department == department,
+        model.status != 'Rejected',
+        model.submitted_at >= period_start,
+        model.submitted_at < period_end
+    ).scalar()
+    counter = BudgetCounter(department=department, category=category, period_start=period_start,
+                            reserved=reserved, **limits)
+    db.session.add(counter)
+    return counter
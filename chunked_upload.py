@@ -0,0 +1,373 @@
+# Resumable chunked uploads
+#
+# A client opens an upload with the file's name and size, PUTs fixed-size
+# chunks at chunk-aligned offsets in any order (and again after a dropped
+# connection), then completes it. Each chunk is streamed from the request
+# body straight into its place in a preallocated staging file and is only
+# recorded once its SHA-256 matches. Completion checks the file against
+# the digest given at init and renames the staging file into place, so the
+# data is never copied. A tree digest is checked from the recorded chunk
+# digests at once; a whole-file digest means re-reading the file, which
+# runs in the process pool while the client polls; the outcome stays in
+# the staging directory until the off-hours purge. All state is on disk,
+# so any worker can take any request.
+
+import os
+import json
+import time
+import uuid
+import errno
+import shutil
+import hashlib
+import logging
+from functools import partial
+from werkzeug.utils import secure_filename
+from process_pool import get_process_pool
+
+logger = logging.getLogger(__name__)
+
+DRONE_UPLOAD_STAGING = os.environ.get("DRONE_UPLOAD_STAGING", os.path.join('uploads', 'drone_staging'))
+
+# Below MAX_CONTENT_LENGTH so one chunk fits in a request
+DRONE_CHUNK_SIZE = int(os.environ.get("DRONE_CHUNK_SIZE", 8 * 1024 * 1024))
+
+DRONE_MAX_UPLOAD_BYTES = int(os.environ.get("DRONE_MAX_UPLOAD_BYTES", 20 * 1024 ** 3))
+
+# Unfinished uploads older than this are removed by the off-hours scheduler
+DRONE_UPLOAD_EXPIRY_HOURS = int(os.environ.get("DRONE_UPLOAD_EXPIRY_HOURS", 48))
+
+DRONE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'tif', 'tiff', 'webp'}
+
+# Request body read size while streaming a chunk to disk
+_READ_SIZE = 1024 * 1024
+
+class UploadError(Exception):
+    """Rejected upload request; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def _upload_dir(upload_id):
+    if len(upload_id) != 32 or any(c not in '0123456789abcdef' for c in upload_id):
+        raise UploadError("Unknown upload", 404)
+    return os.path.join(DRONE_UPLOAD_STAGING, upload_id)
+
+def _load(upload_id, user_id):
+    directory = _upload_dir(upload_id)
+    try:
+        with open(os.path.join(directory, 'meta.json')) as handle:
+            meta = json.load(handle)
+    except (OSError, ValueError):
+        raise UploadError("Unknown upload", 404)
+    if meta['user_id'] != user_id:
+        raise UploadError("Unknown upload", 404)
+    return directory, meta
+
+def _chunk_count(meta):
+    return max(1, -(-meta['size'] // meta['chunk_size']))
+
+def _received(directory):
+    try:
+        return {int(name) for name in os.listdir(os.path.join(directory, 'chunks')) if name.isdigit()}
+    except FileNotFoundError:
+        return set()
+
+def _normalise_digest(value, name):
+    value = (value or '').strip().lower()
+    if len(value) != 64 or any(c not in '0123456789abcdef' for c in value):
+        raise UploadError(f"{name} must be a hex SHA-256 digest")
+    return value
+
+def init_upload(filename, size, user_id, sha256=None, sha256_tree=None):
+    """Open an upload and return its status.
+
+    sha256 is the digest of the whole file; sha256_tree, which a browser can
+    compute chunk by chunk, is the SHA-256 of the concatenated binary chunk
+    digests. At least one is required.
+    """
+    filename = secure_filename(filename or '')
+    if '.' not in filename or filename.rsplit('.', 1)[1].lower() not in DRONE_EXTENSIONS:
+        raise UploadError(f"File type not allowed; expected one of: {', '.join(sorted(DRONE_EXTENSIONS))}")
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise UploadError("size must be an integer")
+    if size <= 0:
+        raise UploadError("size must be positive")
+    if size > DRONE_MAX_UPLOAD_BYTES:
+        raise UploadError(f"Uploads are limited to {DRONE_MAX_UPLOAD_BYTES} bytes", 413)
+    if not sha256 and not sha256_tree:
+        raise UploadError("sha256 or sha256_tree is required")
+
+    os.makedirs(DRONE_UPLOAD_STAGING, exist_ok=True)
+    if shutil.disk_usage(DRONE_UPLOAD_STAGING).free < size * 2:
+        raise UploadError("Not enough free disk space for this upload", 507)
+
+    upload_id = uuid.uuid4().hex
+    directory = os.path.join(DRONE_UPLOAD_STAGING, upload_id)
+    os.makedirs(os.path.join(directory, 'chunks'))
+    meta = {
+        "upload_id": upload_id,
+        "user_id": user_id,
+        "filename": filename,
+        "size": size,
+        "chunk_size": DRONE_CHUNK_SIZE,
+        "sha256": _normalise_digest(sha256, 'sha256') if sha256 else None,
+        "sha256_tree": _normalise_digest(sha256_tree, 'sha256_tree') if sha256_tree else None,
+        "created_at": time.time()
+    }
+    # Sparse preallocation: chunks are written in place at their offsets
+    with open(os.path.join(directory, 'data.part'), 'wb') as handle:
+        handle.truncate(size)
+    # meta.json is written last; an upload without it does not exist yet
+    with open(os.path.join(directory, 'meta.tmp'), 'w') as handle:
+        json.dump(meta, handle)
+    os.replace(os.path.join(directory, 'meta.tmp'), os.path.join(directory, 'meta.json'))
+    logger.info(f"Upload {upload_id} opened: {filename} ({size} bytes)")
+    return _status(directory, meta)
+
+def _status(directory, meta):
+    received = _received(directory)
+    chunks = _chunk_count(meta)
+    missing = [index for index in range(chunks) if index not in received]
+    return {
+        "upload_id": meta['upload_id'],
+        "filename": meta['filename'],
+        "size": meta['size'],
+        "chunk_size": meta['chunk_size'],
+        "chunks": chunks,
+        "received": len(received),
+        "received_bytes": sum(min(meta['chunk_size'], meta['size'] - index * meta['chunk_size'])
+                              for index in received),
+        "next_offset": missing[0] * meta['chunk_size'] if missing else None,
+        "missing": missing[:1000],
+        "complete": not missing
+    }
+
+def upload_status(upload_id, user_id):
+    """Progress of an upload, including which chunks are still missing"""
+    return _status(*_load(upload_id, user_id))
+
+def write_chunk(upload_id, user_id, offset, stream, length, sha256):
+    """Stream one chunk from a file-like request body into place.
+
+    The chunk at offset must be exactly chunk_size bytes (the last one the
+    remainder) and hash to sha256. A retried chunk simply overwrites the
+    same bytes.
+    """
+    directory, meta = _load(upload_id, user_id)
+    if os.path.exists(os.path.join(directory, 'completing')):
+        raise UploadError("Upload is already being completed", 409)
+    chunk_size, size = meta['chunk_size'], meta['size']
+    try:
+        offset = int(offset)
+    except (TypeError, ValueError):
+        raise UploadError("offset must be an integer")
+    if offset < 0 or offset >= size or offset % chunk_size:
+        raise UploadError(f"offset must be a multiple of {chunk_size} below {size}")
+    expected = min(chunk_size, size - offset)
+    if length != expected:
+        raise UploadError(f"Chunk at offset {offset} must be {expected} bytes")
+    sha256 = _normalise_digest(sha256, 'X-Chunk-SHA256')
+
+    digest = hashlib.sha256()
+    try:
+        fd = os.open(os.path.join(directory, 'data.part'), os.O_WRONLY)
+    except FileNotFoundError:
+        raise UploadError("Upload is already complete", 409)
+    try:
+        position, remaining = offset, length
+        while remaining:
+            piece = stream.read(min(_READ_SIZE, remaining))
+            if not piece:
+                raise UploadError(f"Chunk body ended after {length - remaining} of {length} bytes")
+            os.pwrite(fd, piece, position)
+            digest.update(piece)
+            position += len(piece)
+            remaining -= len(piece)
+        if digest.hexdigest() != sha256:
+            raise UploadError(f"Checksum mismatch for chunk at offset {offset}", 422)
+        # The data must be durable before the chunk is recorded as received
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    index = offset // chunk_size
+    marker = os.path.join(directory, 'chunks', str(index))
+    with open(f"{marker}.{os.getpid()}.tmp", 'w') as handle:
+        handle.write(sha256)
+    os.replace(f"{marker}.{os.getpid()}.tmp", marker)
+    return _status(directory, meta)
+
+def _unique_path(folder, filename):
+    path = os.path.join(folder, filename)
+    stem, ext = os.path.splitext(filename)
+    while os.path.exists(path):
+        path = os.path.join(folder, f"{stem}-{uuid.uuid4().hex[:8]}{ext}")
+    return path
+
+def _marker_digest(directory, index):
+    with open(os.path.join(directory, 'chunks', str(index))) as marker:
+        return marker.read().strip()
+
+def _store(directory, meta, destination):
+    """Move the verified staging file into the destination folder; returns the stored path"""
+    data_path = os.path.join(directory, 'data.part')
+    os.makedirs(destination, exist_ok=True)
+    path = _unique_path(destination, meta['filename'])
+    try:
+        os.replace(data_path, path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # Staging on another filesystem; this is the only case that copies
+        shutil.move(data_path, path)
+    os.chmod(path, 0o644)
+    return path
+
+def _write_result(directory, result):
+    with open(os.path.join(directory, 'result.tmp'), 'w') as handle:
+        json.dump(result, handle)
+    os.replace(os.path.join(directory, 'result.tmp'), os.path.join(directory, 'result.json'))
+
+def _failed(directory, message, status):
+    """Record a failed completion and release the upload so it can be completed again"""
+    _write_result(directory, {"state": "failed", "error": message, "status": status})
+    os.remove(os.path.join(directory, 'completing'))
+
+def verify_upload(directory, destination):
+    """Process pool job: re-hash a staged file against its digests and store it.
+
+    The outcome is written to result.json for completion_status().
+    """
+    with open(os.path.join(directory, 'meta.json')) as handle:
+        meta = json.load(handle)
+    try:
+        whole, tree = hashlib.sha256(), hashlib.sha256()
+        with open(os.path.join(directory, 'data.part'), 'rb') as handle:
+            for index in range(_chunk_count(meta)):
+                chunk = handle.read(meta['chunk_size'])
+                whole.update(chunk)
+                chunk_digest = hashlib.sha256(chunk)
+                if chunk_digest.hexdigest() != _marker_digest(directory, index):
+                    os.remove(os.path.join(directory, 'chunks', str(index)))
+                    raise UploadError(f"Chunk {index} changed on disk; upload it again", 409)
+                tree.update(chunk_digest.digest())
+        if whole.hexdigest() != meta['sha256']:
+            raise UploadError("File checksum mismatch", 422)
+        if meta['sha256_tree'] and tree.hexdigest() != meta['sha256_tree']:
+            raise UploadError("File checksum mismatch", 422)
+        path = _store(directory, meta, destination)
+    except UploadError as e:
+        _failed(directory, str(e), e.status)
+        return
+    except Exception as e:
+        logger.error(f"Verifying upload {meta['upload_id']} failed: {e}")
+        _failed(directory, "Upload could not be verified; try completing it again", 500)
+        return
+    _write_result(directory, {"state": "stored", "path": path})
+    logger.info(f"Upload {meta['upload_id']} completed: {path} ({meta['size']} bytes)")
+
+def _verify_done(directory, future):
+    # A job lost with its pool process never wrote a result
+    if future.exception() is not None and not os.path.exists(os.path.join(directory, 'result.json')):
+        logger.error(f"Verifying upload in {directory} failed: {future.exception()}")
+        _failed(directory, "Upload could not be verified; try completing it again", 500)
+
+def complete_upload(upload_id, user_id, destination):
+    """Start storing a fully received upload; returns its completion state (see completion_status).
+
+    With only sha256_tree the check uses the digests recorded as each chunk
+    arrived and the file is stored at once. A whole-file sha256 needs the
+    file (up to DRONE_MAX_UPLOAD_BYTES) read again, so that is left to the
+    process pool and the state is "verifying".
+    """
+    directory, meta = _load(upload_id, user_id)
+    status = _status(directory, meta)
+    if not status['complete']:
+        raise UploadError(f"{status['chunks'] - status['received']} chunks are still missing", 409)
+    try:
+        # Only one request gets to finish the upload
+        os.close(os.open(os.path.join(directory, 'completing'), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        raise UploadError("Upload is already being completed", 409)
+    try:
+        os.remove(os.path.join(directory, 'result.json'))
+    except FileNotFoundError:
+        pass
+
+    if meta['sha256']:
+        get_process_pool().submit(verify_upload, directory, destination).add_done_callback(
+            partial(_verify_done, directory))
+        return {"state": "verifying"}
+
+    try:
+        tree = hashlib.sha256()
+        for index in range(status['chunks']):
+            tree.update(bytes.fromhex(_marker_digest(directory, index)))
+        if tree.hexdigest() != meta['sha256_tree']:
+            raise UploadError("File checksum mismatch", 422)
+        path = _store(directory, meta, destination)
+    except BaseException:
+        os.remove(os.path.join(directory, 'completing'))
+        raise
+    result = {"state": "stored", "path": path}
+    _write_result(directory, result)
+    logger.info(f"Upload {upload_id} completed: {path} ({meta['size']} bytes)")
+    return result
+
+def completion_status(upload_id, user_id):
+    """Completion state of an upload.
+
+    "verifying" while the pool job runs; "stored" with the path once the
+    file is in place; "failed" with an error and HTTP status, after which
+    the upload can be completed again.
+    """
+    directory, _ = _load(upload_id, user_id)
+    try:
+        with open(os.path.join(directory, 'result.json')) as handle:
+            return json.load(handle)
+    except FileNotFoundError:
+        if os.path.exists(os.path.join(directory, 'completing')):
+            return {"state": "verifying"}
+        raise UploadError("Upload has not been completed", 409)
+
+def claim_stored(upload_id, user_id):
+    """True for the one caller that gets to catalog a stored upload"""
+    directory, _ = _load(upload_id, user_id)
+    try:
+        os.close(os.open(os.path.join(directory, 'cataloged'), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return False
+    return True
+
+def abort_upload(upload_id, user_id):
+    """Discard an upload and its staged data"""
+    directory, _ = _load(upload_id, user_id)
+    if (os.path.exists(os.path.join(directory, 'completing'))
+            and not os.path.exists(os.path.join(directory, 'result.json'))):
+        raise UploadError("Upload is being verified", 409)
+    shutil.rmtree(directory, ignore_errors=True)
+
+def purge_stale_uploads():
+    """Remove staging directories untouched for DRONE_UPLOAD_EXPIRY_HOURS; returns how many"""
+    cutoff = time.time() - DRONE_UPLOAD_EXPIRY_HOURS * 3600
+    removed = 0
+    try:
+        entries = list(os.scandir(DRONE_UPLOAD_STAGING))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        if not entry.is_dir():
+            continue
+        try:
+            touched = max([entry.stat().st_mtime, os.stat(os.path.join(entry.path, 'chunks')).st_mtime])
+        except OSError:
+            touched = entry.stat().st_mtime
+        if touched < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+    if removed:
+        logger.info(f"Removed {removed} stale drone uploads")
+    return removed
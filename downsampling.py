@@ -0,0 +1,155 @@
+# Chart downsampling
+#
+# Series are reduced to a target point count before they are sent to the
+# browser. "minmax" keeps the lowest and highest point of each time bucket;
+# "lttb" (Largest-Triangle-Three-Buckets) first preselects min/max points on
+# a finer grid and then picks the visually most significant of those. The
+# bucket grid is aligned to the epoch, so the preselection of a finished
+# stretch of time never changes and is cached per tile. Like
+# timeseries_store, this module must not import the Flask app.
+
+import threading
+from collections import OrderedDict
+import numpy as np
+
+DOWNSAMPLING_METHODS = ('lttb', 'minmax')
+
+# Preselected points per output point before LTTB
+LTTB_PRESELECT_RATIO = 4
+
+# Buckets per cached tile
+TILE_BUCKETS = 64
+
+# Bucket widths in ms; wider ranges use whole days
+_WIDTHS = [seconds * 1000 for seconds in (1, 2, 5, 10, 15, 30, 60, 120, 300, 600, 900, 1800,
+                                          3600, 7200, 10800, 21600, 43200, 86400)]
+
+def lttb_indices(x, y, points):
+    """Indices of the points LTTB keeps; x must be sorted"""
+    size = len(x)
+    if points >= size or points < 3:
+        return np.arange(size)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # points - 2 buckets between the fixed first and last points
+    edges = np.linspace(1, size - 1, points - 1).astype(np.int64)
+    selected = np.empty(points, dtype=np.int64)
+    selected[0], selected[-1] = 0, size - 1
+    anchor = 0
+    for bucket in range(points - 2):
+        low, high = edges[bucket], edges[bucket + 1]
+        next_high = edges[bucket + 2] if bucket + 2 < len(edges) else size
+        next_x = x[high:next_high].mean()
+        next_y = y[high:next_high].mean()
+        area = np.abs((x[anchor] - next_x) * (y[low:high] - y[anchor])
+                      - (x[anchor] - x[low:high]) * (next_y - y[anchor]))
+        anchor = low + int(area.argmax())
+        selected[bucket + 1] = anchor
+    return selected
+
+def minmax_indices(x, y, width, origin=0):
+    """Indices of the min and max point of every width-wide bucket, in x order; x must be sorted"""
+    if len(x) == 0:
+        return np.arange(0)
+    bucket = (np.asarray(x) - origin) // width
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    ends = np.r_[starts[1:], len(bucket)]
+    order = np.lexsort((y, bucket))
+    return np.unique(np.concatenate((order[starts], order[ends - 1])))
+
+def bucket_width(span, buckets):
+    """Smallest standard bucket width (ms) that splits span into at most `buckets`"""
+    needed = span / max(buckets, 1)
+    for width in _WIDTHS:
+        if width >= needed:
+            return width
+    return int(-(-needed // _WIDTHS[-1]) * _WIDTHS[-1])
+
+class TileCache:
+    """Bounded LRU of preselected tiles"""
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+def _load(store, series, start, end):
+    points = store.scan(series, start, end)
+    if not points:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    timestamps, values = zip(*points)
+    return np.array(timestamps, dtype=np.int64), np.array(values, dtype=np.float64)
+
+def _preselect(store, series, start, end, width, cache, settled_before):
+    """Min/max points per width bucket over [start, end).
+
+    Tiles of TILE_BUCKETS buckets lying inside the range and ending before
+    settled_before come from the cache; each run of other tiles is read
+    with one scan.
+    """
+    tile_span = width * TILE_BUCKETS
+    tiles = []
+    tile = start // tile_span * tile_span
+    while tile < end:
+        low, high = max(tile, start), min(tile + tile_span, end)
+        cacheable = cache is not None and low == tile and high == tile + tile_span and high <= settled_before
+        tiles.append((tile, low, high, cacheable, cache.get((series, width, tile)) if cacheable else None))
+        tile += tile_span
+
+    parts_t, parts_v = [], []
+    index = 0
+    while index < len(tiles):
+        cached = tiles[index][4]
+        if cached is not None:
+            parts_t.append(cached[0])
+            parts_v.append(cached[1])
+            index += 1
+            continue
+        run_end = index
+        while run_end < len(tiles) and tiles[run_end][4] is None:
+            run_end += 1
+        timestamps, values = _load(store, series, tiles[index][1], tiles[run_end - 1][2])
+        for tile, low, high, cacheable, _ in tiles[index:run_end]:
+            first, last = np.searchsorted(timestamps, [low, high])
+            keep = minmax_indices(timestamps[first:last], values[first:last], width) + first
+            selected = (timestamps[keep], values[keep])
+            if cacheable:
+                cache.put((series, width, tile), selected)
+            parts_t.append(selected[0])
+            parts_v.append(selected[1])
+        index = run_end
+    return np.concatenate(parts_t), np.concatenate(parts_v)
+
+def downsample_store_series(store, series, start, end, points, method='lttb', cache=None, settled_before=None):
+    """At most `points` (timestamp ms, value) pairs of a store series over [start, end)"""
+    if method not in DOWNSAMPLING_METHODS:
+        raise ValueError(f"method must be one of: {', '.join(DOWNSAMPLING_METHODS)}")
+    settled_before = start if settled_before is None else settled_before
+    if method == 'minmax':
+        # Two points per bucket; the aligned grid can add a partial bucket at the end
+        width = bucket_width(end - start, points // 2 - 1)
+        timestamps, values = _preselect(store, series, start, end, width, cache, settled_before)
+    else:
+        width = bucket_width(end - start, points * LTTB_PRESELECT_RATIO // 2)
+        timestamps, values = _preselect(store, series, start, end, width, cache, settled_before)
+        keep = lttb_indices(timestamps, values, points)
+        timestamps, values = timestamps[keep], values[keep]
+    return list(zip(timestamps.tolist(), values.tolist()))
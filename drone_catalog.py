@@ -0,0 +1,278 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+import click
+from sqlalchemy import insert, update, tuple_, and_, or_, cast, BigInteger
+from app import app, db
+from models import DroneImage
+from process_pool import get_process_pool, get_tiling_pool
+from thumbnails import DRONE_THUMBNAIL_DIR, render_thumbnails
+from tile_pyramid import DRONE_TILE_DIR, DRONE_TILE_MIN_EDGE, DRONE_TILE_MAX_PIXELS, build_pyramid
+from geo_index import encode, bbox_ranges, load_zones
+
+logger = logging.getLogger(__name__)
+
+DRONE_UPLOAD_FOLDER = os.path.join(app.static_folder, 'drone_uploads')
+
+DRONE_PAGE_SIZE = int(os.environ.get("DRONE_PAGE_SIZE", 48))
+DRONE_MAX_PAGE_SIZE = 200
+
+# JSON file of site zones, {"Zone A": [min_lon, min_lat, max_lon, max_lat], ...}
+DRONE_SITE_ZONES = os.environ.get("DRONE_SITE_ZONES")
+SITE_ZONES = load_zones(DRONE_SITE_ZONES)
+
+# Most images one map query returns
+DRONE_AREA_MAX_RESULTS = int(os.environ.get("DRONE_AREA_MAX_RESULTS", 1000))
+
+# Sort name -> (column, descending); every one has an index ending in id
+GALLERY_SORTS = {
+    'uploaded': (DroneImage.uploaded_at, True),
+    'captured': (DroneImage.captured_at, True),
+    'name': (DroneImage.filename, False),
+    'size': (DroneImage.size_bytes, True),
+}
+
+_recorder_pool = None
+_recorder_pool_pid = None
+
+def _recorder():
+    """Single thread that writes finished background jobs to the catalog"""
+    global _recorder_pool, _recorder_pool_pid
+    if _recorder_pool is None or _recorder_pool_pid != os.getpid():
+        _recorder_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='drone-catalog')
+        _recorder_pool_pid = os.getpid()
+    return _recorder_pool
+
+_METADATA_FIELDS = ('sha256', 'size_bytes', 'width', 'height', 'captured_at', 'latitude', 'longitude',
+                    'altitude', 'geohash', 'camera')
+
+def _geohash(latitude, longitude):
+    try:
+        return encode(latitude, longitude) if latitude is not None and longitude is not None else None
+    except ValueError:
+        return None
+
+def _metadata_values(metadata):
+    values = {field: metadata.get(field) for field in _METADATA_FIELDS}
+    values['geohash'] = _geohash(values['latitude'], values['longitude'])
+    return values
+
+def _apply_result(filename, future):
+    """Store a finished render_thumbnails job on the catalog row; the caller commits.
+
+    Returns the stored values.
+    """
+    try:
+        values = {**_metadata_values(future.result()), 'error': None}
+    except Exception as e:
+        logger.error(f"Drone image processing failed for {filename}: {e}")
+        values = {'error': str(e)[:200]}
+    db.session.execute(update(DroneImage).where(DroneImage.filename == filename)
+                       .values(processed_at=datetime.utcnow(), **values))
+    return values
+
+def _needs_tiles(values):
+    width, height = values.get('width') or 0, values.get('height') or 0
+    return max(width, height) > DRONE_TILE_MIN_EDGE and width * height <= DRONE_TILE_MAX_PIXELS
+
+def _apply_tiles(filename, future):
+    """Record a finished build_pyramid job; the caller commits"""
+    try:
+        tiles = future.result()
+    except Exception as e:
+        logger.error(f"Tiling failed for {filename}: {e}")
+        return
+    db.session.execute(update(DroneImage).where(DroneImage.filename == filename).values(tiled_at=datetime.utcnow()))
+    logger.info(f"Tiled {filename} into {tiles} tiles")
+
+def register_upload(path, user_id=None):
+    """Catalog a newly stored image and process it in the background.
+
+    A file saved over an existing name replaces that entry's metadata.
+    """
+    filename = os.path.basename(path)
+    image = DroneImage.query.filter_by(filename=filename).first() or DroneImage(filename=filename)
+    for field in _METADATA_FIELDS:
+        setattr(image, field, None)
+    image.size_bytes = os.path.getsize(path)
+    image.uploaded_by = user_id
+    image.uploaded_at = datetime.utcnow()
+    image.processed_at = image.error = image.tiled_at = None
+    db.session.add(image)
+    db.session.commit()
+
+    # Done callbacks run on the process pool's management thread, which must
+    # not wait on the database; they hand the results to the recorder thread
+    def record_tiles(future):
+        with app.app_context():
+            try:
+                _apply_tiles(filename, future)
+                db.session.commit()
+            except Exception as e:
+                logger.error(f"Recording tiles for {filename} failed: {e}")
+            finally:
+                db.session.remove()
+
+    def record_result(future):
+        with app.app_context():
+            try:
+                values = _apply_result(filename, future)
+                db.session.commit()
+            except Exception as e:
+                logger.error(f"Recording metadata for {filename} failed: {e}")
+                return
+            finally:
+                db.session.remove()
+        if _needs_tiles(values):
+            get_tiling_pool().submit(build_pyramid, path, values['sha256'], DRONE_TILE_DIR).add_done_callback(
+                lambda done: _recorder().submit(record_tiles, done))
+
+    get_process_pool().submit(render_thumbnails, path, DRONE_THUMBNAIL_DIR).add_done_callback(
+        lambda done: _recorder().submit(record_result, done))
+    return image
+
+def _cursor_value(sort, value):
+    if sort in ('uploaded', 'captured'):
+        return datetime.fromisoformat(value)
+    if sort == 'size':
+        return int(value)
+    return value
+
+def gallery_page(sort='uploaded', after=None, search=None, captured_from=None, captured_to=None,
+                 with_gps=False, limit=DRONE_PAGE_SIZE):
+    """One page of catalog entries and the cursor for the next page (None on the last).
+
+    Pages are keyset-paginated on (sort column, id), so deep pages cost the
+    same as the first. Sorting by capture time lists only images whose EXIF
+    data has one. Raises ValueError on a bad sort or cursor.
+    """
+    if sort not in GALLERY_SORTS:
+        raise ValueError(f"sort must be one of: {', '.join(GALLERY_SORTS)}")
+    column, descending = GALLERY_SORTS[sort]
+    limit = max(1, min(limit, DRONE_MAX_PAGE_SIZE))
+
+    query = DroneImage.query
+    if sort == 'captured':
+        query = query.filter(DroneImage.captured_at.is_not(None))
+    if search:
+        query = query.filter(DroneImage.filename.ilike(f"%{search}%"))
+    if captured_from:
+        query = query.filter(DroneImage.captured_at >= captured_from)
+    if captured_to:
+        query = query.filter(DroneImage.captured_at < captured_to)
+    if with_gps:
+        query = query.filter(DroneImage.latitude.is_not(None), DroneImage.longitude.is_not(None))
+    if after:
+        value, _, last_id = after.rpartition('|')
+        value, last_id = _cursor_value(sort, value), int(last_id)
+        if descending:
+            query = query.filter(tuple_(column, DroneImage.id) < tuple_(value, last_id))
+        else:
+            query = query.filter(tuple_(column, DroneImage.id) > tuple_(value, last_id))
+    order = (column.desc(), DroneImage.id.desc()) if descending else (column, DroneImage.id)
+    rows = query.order_by(*order).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        value = getattr(last, column.key)
+        next_cursor = f"{value.isoformat() if isinstance(value, datetime) else value}|{last.id}"
+    return rows, next_cursor
+
+def images_in_area(bbox, captured_from=None, captured_to=None, limit=DRONE_AREA_MAX_RESULTS):
+    """Geotagged images inside a (min_lon, min_lat, max_lon, max_lat) box, newest capture first.
+
+    The box becomes a few geohash index range scans (see geo_index), so the
+    cost grows with the matches rather than the catalog. Returns (rows,
+    truncated).
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    cells = or_(*(and_(DroneImage.geohash >= low, DroneImage.geohash < high) if high else DroneImage.geohash >= low
+                  for low, high in bbox_ranges(bbox)))
+    if min_lon > max_lon:
+        longitude = or_(DroneImage.longitude >= min_lon, DroneImage.longitude <= max_lon)
+    else:
+        longitude = DroneImage.longitude.between(min_lon, max_lon)
+    query = DroneImage.query.filter(cells, longitude, DroneImage.latitude.between(min_lat, max_lat))
+    if captured_from:
+        query = query.filter(DroneImage.captured_at >= captured_from)
+    if captured_to:
+        query = query.filter(DroneImage.captured_at < captured_to)
+    rows = query.order_by(DroneImage.captured_at.desc(), DroneImage.id.desc()).limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
+
+def reindex_catalog(folder=DRONE_UPLOAD_FOLDER, full=False, prune=True, batch_size=200):
+    """Bring the catalog in line with the upload folder.
+
+    Files without an entry are added, and new, changed (by size) and
+    never-processed files are hashed and read in parallel in the process
+    pool; full re-reads everything. Large images without a tile pyramid
+    then get one. With prune, entries whose file is gone are removed.
+    Returns (added, processed, tiled, removed).
+    """
+    known = {filename: (size, processed_at) for filename, size, processed_at in
+             db.session.query(DroneImage.filename, DroneImage.size_bytes, DroneImage.processed_at)}
+    files = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file() and not entry.name.startswith('.'):
+                files[entry.name] = entry.stat()
+
+    new_rows = [dict(filename=filename, size_bytes=stat.st_size, uploaded_at=datetime.utcfromtimestamp(stat.st_mtime))
+                for filename, stat in files.items() if filename not in known]
+    for start in range(0, len(new_rows), batch_size):
+        db.session.execute(insert(DroneImage), new_rows[start:start + batch_size])
+    db.session.commit()
+
+    stale = [filename for filename, stat in files.items()
+             if full or filename not in known or known[filename][1] is None or known[filename][0] != stat.st_size]
+    pool = get_process_pool()
+    futures = {pool.submit(render_thumbnails, os.path.join(folder, filename), DRONE_THUMBNAIL_DIR): filename
+               for filename in stale}
+    for done, future in enumerate(as_completed(futures), 1):
+        _apply_result(futures[future], future)
+        if done % batch_size == 0:
+            db.session.commit()
+            logger.info(f"Processed {done}/{len(futures)} drone images")
+    db.session.commit()
+
+    untiled = db.session.query(DroneImage.filename, DroneImage.sha256).filter(
+        DroneImage.sha256.is_not(None), DroneImage.tiled_at.is_(None),
+        db.or_(DroneImage.width > DRONE_TILE_MIN_EDGE, DroneImage.height > DRONE_TILE_MIN_EDGE),
+        cast(DroneImage.width, BigInteger) * DroneImage.height <= DRONE_TILE_MAX_PIXELS
+    ).all()
+    tiling_pool = get_tiling_pool()
+    tile_futures = {tiling_pool.submit(build_pyramid, os.path.join(folder, filename), digest, DRONE_TILE_DIR): filename
+                    for filename, digest in untiled if filename in files}
+    for future in as_completed(tile_futures):
+        _apply_tiles(tile_futures[future], future)
+    db.session.commit()
+
+    # Catalogued before the geohash column existed
+    geohashes = [dict(id=image_id, geohash=_geohash(latitude, longitude)) for image_id, latitude, longitude in
+                 db.session.query(DroneImage.id, DroneImage.latitude, DroneImage.longitude).filter(
+                     DroneImage.latitude.is_not(None), DroneImage.longitude.is_not(None),
+                     DroneImage.geohash.is_(None))]
+    if geohashes:
+        db.session.execute(update(DroneImage), geohashes)
+    db.session.commit()
+
+    removed = 0
+    if prune:
+        missing = [filename for filename in known if filename not in files]
+        for start in range(0, len(missing), batch_size):
+            removed += DroneImage.query.filter(DroneImage.filename.in_(missing[start:start + batch_size])).delete(
+                synchronize_session=False)
+        db.session.commit()
+    return len(new_rows), len(futures), len(tile_futures), removed
+
+@app.cli.command('reindex-drone-images')
+@click.option('--full', is_flag=True, help='Re-read every image, not only new or changed ones.')
+@click.option('--prune/--no-prune', default=True, show_default=True,
+              help='Remove entries whose file no longer exists.')
+def reindex_drone_images_command(full, prune):
+    """Rebuild the drone image catalog from the upload folder."""
+    added, processed, tiled, removed = reindex_catalog(full=full, prune=prune)
+    print(f"Added {added}, processed {processed}, tiled {tiled}, removed {removed} drone images")
@@ -0,0 +1,207 @@
+import csv
+import io
+import json
+from datetime import date, datetime
+from sqlalchemy import select, func, tuple_
+from app import db
+from models import PurchaseRequest, CashDemand, ExpenseRecord, ExpenseItem, EmployeeRegistration
+
+# Rows fetched per round-trip from the server-side cursor
+STREAM_BATCH_SIZE = 1000
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson'
+}
+
+_expense_item_count = select(func.count(ExpenseItem.id)).where(
+    ExpenseItem.expense_record_id == ExpenseRecord.id
+).scalar_subquery()
+
+_expense_total_amount = select(func.coalesce(func.sum(ExpenseItem.amount), 0)).where(
+    ExpenseItem.expense_record_id == ExpenseRecord.id
+).scalar_subquery()
+
+# Column projections per export type. Every export is ordered by its
+# (submitted_at, id) keyset so an interrupted extract can resume from the
+# last row it received. Rows without submitted_at come first, by id.
+EXPORT_TYPES = {
+    'purchases': {
+        'keyset': (PurchaseRequest.submitted_at, PurchaseRequest.id),
+        'columns': [
+            PurchaseRequest.submitted_at,
+            PurchaseRequest.id,
+            PurchaseRequest.user_id,
+            PurchaseRequest.item_name,
+            PurchaseRequest.quantity,
+            PurchaseRequest.unit_price,
+            PurchaseRequest.total_amount,
+            PurchaseRequest.supplier,
+            PurchaseRequest.urgency,
+            PurchaseRequest.status,
+            PurchaseRequest.reviewed_at
+        ]
+    },
+    'demands': {
+        'keyset': (CashDemand.submitted_at, CashDemand.id),
+        'columns': [
+            CashDemand.submitted_at,
+            CashDemand.id,
+            CashDemand.user_id,
+            CashDemand.demander_name,
+            CashDemand.demander_id,
+            CashDemand.purpose,
+            CashDemand.amount,
+            CashDemand.department,
+            CashDemand.urgency,
+            CashDemand.payment_method,
+            CashDemand.status,
+            CashDemand.reviewed_at
+        ]
+    },
+    'expenses': {
+        'keyset': (ExpenseRecord.submitted_at, ExpenseRecord.id),
+        'columns': [
+            ExpenseRecord.submitted_at,
+            ExpenseRecord.id,
+            ExpenseRecord.expense_id,
+            ExpenseRecord.user_id,
+            ExpenseRecord.department,
+            _expense_item_count.label('item_count'),
+            _expense_total_amount.label('total_amount'),
+            ExpenseRecord.status,
+            ExpenseRecord.reviewed_at
+        ]
+    },
+    'registrations': {
+        'keyset': (EmployeeRegistration.submitted_at, EmployeeRegistration.id),
+        'columns': [
+            EmployeeRegistration.submitted_at,
+            EmployeeRegistration.id,
+            EmployeeRegistration.first_name,
+            EmployeeRegistration.last_name,
+            EmployeeRegistration.email,
+            EmployeeRegistration.department,
+            EmployeeRegistration.position,
+            EmployeeRegistration.start_date,
+            EmployeeRegistration.status,
+            EmployeeRegistration.reviewed_at
+        ]
+    }
+}
+
+def _parse_datetime(value, name):
+    """Parse an ISO date or datetime query parameter"""
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid {name}: expected an ISO date or datetime")
+
+def parse_export_filters(args):
+    """Turn export query parameters into keyword filters for stream_export"""
+    filters = {}
+    if args.get('start'):
+        filters['start'] = _parse_datetime(args['start'], 'start')
+    if args.get('end'):
+        filters['end'] = _parse_datetime(args['end'], 'end')
+
+    # Resume point: the submitted_at and id of the last row already received,
+    # or after_id alone when that row had no submitted_at
+    after_ts = args.get('after_submitted_at')
+    after_id = args.get('after_id')
+    if after_ts and not after_id:
+        raise ValueError("after_submitted_at requires after_id")
+    if after_id:
+        try:
+            after_id = int(after_id)
+        except ValueError:
+            raise ValueError("Invalid after_id")
+        filters['after'] = (_parse_datetime(after_ts, 'after_submitted_at') if after_ts else None, after_id)
+
+    if args.get('limit'):
+        try:
+            filters['limit'] = int(args['limit'])
+        except ValueError:
+            raise ValueError("Invalid limit")
+        if filters['limit'] < 1:
+            raise ValueError("limit must be positive")
+    return filters
+
+def build_export_queries(export_type, start=None, end=None, after=None):
+    """Build the keyset-ordered projection queries for an export type, read in turn.
+
+    NULL never compares in the (submitted_at, id) keyset, so rows without
+    submitted_at have their own query, by id, ahead of the keyset one. A
+    date range leaves them out.
+    """
+    spec = EXPORT_TYPES[export_type]
+    submitted_at, row_id = spec['keyset']
+    after_submitted_at, after_id = after or (None, None)
+
+    queries = []
+    if not start and not end and after_submitted_at is None:
+        undated = select(*spec['columns']).where(submitted_at.is_(None))
+        if after_id is not None:
+            undated = undated.where(row_id > after_id)
+        queries.append(undated.order_by(row_id))
+
+    query = select(*spec['columns']).where(submitted_at.is_not(None))
+    if start:
+        query = query.where(submitted_at >= start)
+    if end:
+        query = query.where(submitted_at < end)
+    if after_submitted_at is not None:
+        query = query.where(tuple_(submitted_at, row_id) > tuple_(*after))
+    queries.append(query.order_by(submitted_at, row_id))
+    return queries
+
+def _serialize(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+def iter_export_batches(export_type, limit=None, **filters):
+    """Yield lists of row tuples from a server-side cursor, at most limit rows in all"""
+    for query in build_export_queries(export_type, **filters):
+        if limit is not None:
+            if limit <= 0:
+                return
+            query = query.limit(limit)
+        result = db.session.execute(
+            query,
+            execution_options={'stream_results': True, 'yield_per': STREAM_BATCH_SIZE}
+        )
+        try:
+            for batch in result.partitions():
+                if limit is not None:
+                    limit -= len(batch)
+                yield batch
+        finally:
+            result.close()
+
+def export_columns(export_type):
+    """Get output column names for an export type"""
+    return [column.key for column in EXPORT_TYPES[export_type]['columns']]
+
+def stream_export(export_type, fmt, **filters):
+    """Generate CSV or NDJSON text chunks, one chunk per cursor batch"""
+    columns = export_columns(export_type)
+
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        yield buffer.getvalue()
+        for batch in iter_export_batches(export_type, **filters):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows([_serialize(value) for value in row] for row in batch)
+            yield buffer.getvalue()
+    elif fmt == 'ndjson':
+        for batch in iter_export_batches(export_type, **filters):
+            yield ''.join(
+                json.dumps(dict(zip(columns, row)), default=_serialize) + '\n'
+                for row in batch
+            )
+    else:
+        raise ValueError(f"Unsupported export format: {fmt}")
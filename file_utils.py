@@ -1,11 +1,52 @@
 import os
+import re
+import json
+import time
 import uuid
+import hashlib
 import logging
+import tempfile
+from collections import Counter
+from datetime import datetime, timedelta
+import click
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
 from werkzeug.utils import secure_filename
+from app import app, db
+from models import StoredBlob, ExpenseItem, EmployeeRegistration
+from storage import storage_from_env, open_range
+
+logger = logging.getLogger(__name__)
 
 # Define upload configurations
 UPLOAD_FOLDER = 'uploads'
 MAX_FILE_SIZE = 16 * 1024 * 1024  # 16MB
+
+# Uploads are stored once per distinct content, keyed by SHA-256, and
+# shared by every row that references them. Rows store "<sha256>.<ext>";
+# older rows hold uuid names under a per-record subfolder until
+# migrate-uploads moves them. The blob store is local (sharded under
+# BLOB_FOLDER) or S3-compatible, chosen by UPLOAD_STORAGE.
+BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, 'blobs')
+# Uploads are hashed here before they go to the blob store
+UPLOAD_STAGING = os.path.join(UPLOAD_FOLDER, 'staging')
+
+blob_storage = storage_from_env(BLOB_FOLDER)
+
+# Unreferenced blobs, and files without a StoredBlob row (an upload whose
+# transaction rolled back), are removed once this old
+BLOB_GRACE_HOURS = int(os.environ.get("BLOB_GRACE_HOURS", 24))
+
+_BLOB_NAME = re.compile(r'^([0-9a-f]{64})(?:\.([a-z0-9]+))?$')
+_COPY_BUFFER = 1024 * 1024
+
+# Columns holding blob names; the last flag marks a JSON list of names
+BLOB_REFERENCES = [
+    (ExpenseItem.voucher_filename, False),
+    (EmployeeRegistration.photo_filename, False),
+    (EmployeeRegistration.id_photo_filename, False),
+    (EmployeeRegistration.other_files, True),
+]
 ALLOWED_EXTENSIONS = {
     'images': {'jpg', 'jpeg', 'png', 'gif'},
     'documents': {'pdf', 'doc', 'docx', 'txt'},
@@ -14,7 +55,7 @@ ALLOWED_EXTENSIONS = {
 
 def init_upload_folders():
     """Initialize upload directories"""
-    folders = ['photos', 'id_photos', 'vouchers', 'documents']
+    folders = ['photos', 'id_photos', 'vouchers', 'documents', 'blobs', 'staging']
     for folder in folders:
         path = os.path.join(UPLOAD_FOLDER, folder)
         if not os.path.exists(path):
@@ -33,23 +74,77 @@ def generate_unique_filename(filename):
         return f"{unique_name}.{ext}" if ext else unique_name
     return None
 
+def blob_digest(filename):
+    """SHA-256 of a content-addressed stored name, or None for legacy names"""
+    match = _BLOB_NAME.match(filename or '')
+    return match.group(1) if match else None
+
+def _acquire_blob(sha256, size):
+    """Count one more reference in the caller's transaction"""
+    increment = (update(StoredBlob).where(StoredBlob.sha256 == sha256)
+                 .values(refcount=StoredBlob.refcount + 1, released_at=None))
+    if db.session.execute(increment).rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(StoredBlob(sha256=sha256, size_bytes=size, refcount=1, created_at=datetime.utcnow()))
+    except IntegrityError:
+        # Another worker stored the same content first
+        db.session.execute(increment)
+
+def _store_stream(stream):
+    """Copy a stream into the blob store, hashing as it goes; returns (sha256, size).
+
+    Content that is already stored is not written again.
+    """
+    os.makedirs(UPLOAD_STAGING, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, temporary = tempfile.mkstemp(dir=UPLOAD_STAGING)
+    try:
+        with os.fdopen(fd, 'wb') as handle:
+            for piece in iter(lambda: stream.read(_COPY_BUFFER), b''):
+                digest.update(piece)
+                handle.write(piece)
+                size += len(piece)
+        sha256 = digest.hexdigest()
+        _acquire_blob(sha256, size)
+        # Checked after the reference is taken: collect_blobs moves a file
+        # aside before dropping its row, so a blob it is collecting is
+        # missing here and gets rewritten
+        if blob_storage.exists(sha256):
+            os.remove(temporary)
+        else:
+            blob_storage.put_file(sha256, temporary)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return sha256, size
+
 def save_file(file, subfolder, file_type='documents'):
-    """Save uploaded file and return filename"""
+    """Store an uploaded file and return its name for the referencing row.
+
+    The name is "<sha256>.<ext>"; identical content is stored once and
+    reference-counted in the caller's transaction. subfolder only applies
+    to legacy names and is kept for callers.
+    """
     if file and file.filename:
         if allowed_file(file.filename, file_type):
             filename = secure_filename(file.filename)
-            unique_filename = generate_unique_filename(filename)
-            
-            # Create subfolder if it doesn't exist
-            folder_path = os.path.join(UPLOAD_FOLDER, subfolder)
-            if not os.path.exists(folder_path):
-                os.makedirs(folder_path)
-            
-            file_path = os.path.join(folder_path, unique_filename)
-            file.save(file_path)
-            return unique_filename
+            sha256, _ = _store_stream(file.stream)
+            ext = filename.rsplit('.', 1)[1].lower()
+            return f"{sha256}.{ext}"
     return None
 
+def release_file(filename):
+    """Drop one reference to a stored name in the caller's transaction; the blob is collected later"""
+    sha256 = blob_digest(filename)
+    if sha256:
+        db.session.execute(update(StoredBlob)
+                           .where(StoredBlob.sha256 == sha256, StoredBlob.refcount > 0)
+                           .values(refcount=StoredBlob.refcount - 1, released_at=datetime.utcnow()))
+
 def save_multiple_files(files, subfolder, file_type='documents'):
     """Save multiple files and return list of filenames"""
     saved_files = []
@@ -61,7 +156,10 @@ def save_multiple_files(files, subfolder, file_type='documents'):
     return saved_files
 
 def delete_file(filename, subfolder):
-    """Delete a file from uploads directory"""
+    """Delete a file from uploads directory (for stored blobs, release the reference)"""
+    if blob_digest(filename):
+        release_file(filename)
+        return True
     if filename:
         file_path = os.path.join(UPLOAD_FOLDER, subfolder, filename)
         if os.path.exists(file_path):
@@ -73,10 +171,195 @@ def delete_file(filename, subfolder):
     return False
 
 def get_file_path(filename, subfolder):
-    """Get full path to uploaded file"""
+    """Get full path to uploaded file (None for blobs kept in remote storage)"""
+    sha256 = blob_digest(filename)
+    if sha256:
+        return blob_storage.local_path(sha256)
     if filename:
         return os.path.join(UPLOAD_FOLDER, subfolder, filename)
     return None
 
+def open_file(filename, subfolder, start=0, length=None):
+    """Readable stream of a stored file, optionally a byte range; raises FileNotFoundError"""
+    sha256 = blob_digest(filename)
+    if sha256:
+        return blob_storage.open(sha256, start, length)
+    if not filename or secure_filename(filename) != filename or secure_filename(subfolder) != subfolder:
+        raise FileNotFoundError(filename)
+    return open_range(os.path.join(UPLOAD_FOLDER, subfolder, filename), start, length)
+
+def file_size(filename, subfolder):
+    """Size of a stored file, or None if it is missing"""
+    sha256 = blob_digest(filename)
+    if sha256:
+        return blob_storage.size(sha256)
+    path = get_file_path(filename, subfolder)
+    return os.path.getsize(path) if path and os.path.isfile(path) else None
+
+def count_blob_references():
+    """sha256 -> number of referencing rows, recounted from BLOB_REFERENCES"""
+    counts = Counter()
+    for column, is_list in BLOB_REFERENCES:
+        for (value,) in db.session.query(column).filter(column.is_not(None)).yield_per(1000):
+            names = json.loads(value) if is_list else [value]
+            counts.update(sha256 for sha256 in map(blob_digest, names) if sha256)
+    return counts
+
+def verify_blobs(repair=False):
+    """Compare stored refcounts with the referencing rows; returns the mismatched digests.
+
+    With repair, refcounts are set from the rows (rows are created for
+    referenced files that have none).
+    """
+    counts = count_blob_references()
+    stored = {blob.sha256: blob for blob in StoredBlob.query}
+    mismatched = sorted(sha256 for sha256 in set(counts) | set(stored)
+                        if counts.get(sha256, 0) != (stored[sha256].refcount if sha256 in stored else 0))
+    if repair:
+        now = datetime.utcnow()
+        for sha256 in mismatched:
+            blob = stored.get(sha256)
+            if blob is None:
+                size = blob_storage.size(sha256)
+                if size is None:
+                    logger.error(f"Referenced blob {sha256} is missing from storage")
+                    continue
+                blob = StoredBlob(sha256=sha256, size_bytes=size, created_at=now)
+                db.session.add(blob)
+            blob.refcount = counts.get(sha256, 0)
+            blob.released_at = None if blob.refcount else now
+        db.session.commit()
+    return mismatched
+
+def collect_blobs():
+    """Delete blobs unreferenced for BLOB_GRACE_HOURS and stale orphan files; returns how many blobs"""
+    cutoff = datetime.utcnow() - timedelta(hours=BLOB_GRACE_HOURS)
+    removed = 0
+    for (sha256,) in db.session.query(StoredBlob.sha256).filter(
+            StoredBlob.refcount <= 0, StoredBlob.released_at < cutoff).all():
+        # Moved aside first so a concurrent save of the same content rewrites it
+        aside = f"{sha256}.collect"
+        try:
+            blob_storage.rename(sha256, aside)
+        except FileNotFoundError:
+            aside = None
+        deleted = db.session.query(StoredBlob).filter(
+            StoredBlob.sha256 == sha256, StoredBlob.refcount <= 0).delete(synchronize_session=False)
+        db.session.commit()
+        if aside:
+            if deleted or blob_storage.exists(sha256):
+                blob_storage.delete_async(aside)
+            else:
+                blob_storage.rename(aside, sha256)
+        removed += deleted
+
+    # Content stored by uploads whose transaction never committed, and
+    # staging or partial writes left by interrupted uploads
+    expiry = time.time() - BLOB_GRACE_HOURS * 3600
+    known = None
+    for key, _, modified in blob_storage.list():
+        if modified >= expiry:
+            continue
+        if known is None:
+            known = {sha256 for (sha256,) in db.session.query(StoredBlob.sha256)}
+        if key not in known:
+            blob_storage.delete_async(key)
+    blob_storage.purge_partial(BLOB_GRACE_HOURS * 3600)
+    if os.path.isdir(UPLOAD_STAGING):
+        for name in os.listdir(UPLOAD_STAGING):
+            path = os.path.join(UPLOAD_STAGING, name)
+            try:
+                if os.path.getmtime(path) < expiry:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+    if removed:
+        logger.info(f"Collected {removed} unreferenced upload blobs")
+    return removed
+
+def migrate_uploads(batch_size=200):
+    """Move files from per-record upload folders into the blob store; returns (files, rows) moved.
+
+    Legacy uuid names are globally unique, so they are found by name
+    anywhere under UPLOAD_FOLDER and rows are rewritten to "<sha256>.<ext>".
+    Blobs in the earlier blobs/<sha[:2]>/<sha> layout are moved too.
+    """
+    files = 0
+    for first in os.listdir(BLOB_FOLDER) if os.path.isdir(BLOB_FOLDER) else []:
+        directory = os.path.join(BLOB_FOLDER, first)
+        if len(first) != 2 or not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if _BLOB_NAME.match(name) and name.startswith(first) and os.path.isfile(path):
+                if blob_storage.exists(name):
+                    os.remove(path)
+                else:
+                    blob_storage.put_file(name, path)
+                files += 1
+
+    legacy = {}
+    for column, is_list in BLOB_REFERENCES:
+        for (value,) in db.session.query(column).filter(column.is_not(None)).yield_per(1000):
+            legacy.update((name, None) for name in (json.loads(value) if is_list else [value])
+                          if name and not blob_digest(name))
+    skip = {os.path.abspath(BLOB_FOLDER), os.path.abspath(UPLOAD_STAGING)}
+    for directory, subdirectories, names in os.walk(UPLOAD_FOLDER):
+        subdirectories[:] = [d for d in subdirectories if os.path.abspath(os.path.join(directory, d)) not in skip]
+        for name in names:
+            if name in legacy:
+                legacy[name] = os.path.join(directory, name)
+
+    stored = {}
+    moved = []
+    rows = 0
+
+    def stored_name(name):
+        if name in stored:
+            _acquire_blob(blob_digest(stored[name]), os.path.getsize(legacy[name]))
+            return stored[name]
+        if not legacy.get(name):
+            return name
+        with open(legacy[name], 'rb') as handle:
+            sha256, _ = _store_stream(handle)
+        stored[name] = f"{sha256}.{name.rsplit('.', 1)[1].lower()}" if '.' in name else sha256
+        moved.append(legacy[name])
+        return stored[name]
+
+    for column, is_list in BLOB_REFERENCES:
+        model = column.class_
+        for row in db.session.query(model).filter(column.is_not(None)).all():
+            value = getattr(row, column.key)
+            names = json.loads(value) if is_list else [value]
+            renamed = [stored_name(name) for name in names]
+            if renamed != names:
+                setattr(row, column.key, json.dumps(renamed) if is_list else renamed[0])
+                rows += 1
+                if rows % batch_size == 0:
+                    db.session.commit()
+    db.session.commit()
+    # Only after the rows point at the blobs
+    for path in moved:
+        os.remove(path)
+    return files + len(moved), rows
+
+@app.cli.command('verify-blobs')
+@click.option('--repair', is_flag=True, help='Reset refcounts from the referencing rows.')
+def verify_blobs_command(repair):
+    """Check upload blob refcounts against the rows that reference them."""
+    mismatched = verify_blobs(repair)
+    print(f"{len(mismatched)} blobs with a wrong refcount{' (repaired)' if repair and mismatched else ''}")
+
+@app.cli.command('collect-blobs')
+def collect_blobs_command():
+    """Delete upload blobs that nothing references any more."""
+    print(f"Collected {collect_blobs()} blobs")
+
+@app.cli.command('migrate-uploads')
+def migrate_uploads_command():
+    """Move per-record upload folders into the blob store."""
+    files, rows = migrate_uploads()
+    print(f"Moved {files} files, updated {rows} rows")
+
 # Initialize upload folders when module is imported
 init_upload_folders()
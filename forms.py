@@ -1,7 +1,18 @@
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileAllowed, MultipleFileField
 from wtforms import StringField, TextAreaField, FloatField, IntegerField, SelectField, DateField, PasswordField
-from wtforms.validators import DataRequired, Email, NumberRange, Length
+from wtforms.validators import DataRequired, Email, NumberRange, Length, Optional
+
+DEPARTMENT_CHOICES = [
+    ('Finance', 'Finance'),
+    ('HR', 'Human Resources'),
+    ('IT', 'Information Technology'),
+    ('Marketing', 'Marketing'),
+    ('Operations', 'Operations'),
+    ('Sales', 'Sales'),
+    ('Legal', 'Legal'),
+    ('Administration', 'Administration')
+]
 
 class LoginForm(FlaskForm):
     username = StringField('Username', validators=[DataRequired()])
@@ -13,6 +24,7 @@ class PurchaseRequestForm(FlaskForm):
     quantity = IntegerField('Quantity', validators=[DataRequired(), NumberRange(min=1)])
     unit_price = FloatField('Unit Price', validators=[DataRequired(), NumberRange(min=0.01)])
     supplier = StringField('Supplier', validators=[Length(max=200)])
+    department = SelectField('Department', choices=DEPARTMENT_CHOICES)
     justification = TextAreaField('Business Justification', validators=[DataRequired()])
     urgency = SelectField('Urgency', choices=[
         ('Low', 'Low'),
@@ -27,16 +39,7 @@ class CashDemandForm(FlaskForm):
     purpose = StringField('Purpose', validators=[DataRequired(), Length(max=200)])
     description = TextAreaField('Description', validators=[DataRequired()])
     amount = FloatField('Amount', validators=[DataRequired(), NumberRange(min=0.01)])
-    department = SelectField('Department', choices=[
-        ('Finance', 'Finance'),
-        ('HR', 'Human Resources'),
-        ('IT', 'Information Technology'),
-        ('Marketing', 'Marketing'),
-        ('Operations', 'Operations'),
-        ('Sales', 'Sales'),
-        ('Legal', 'Legal'),
-        ('Administration', 'Administration')
-    ])
+    department = SelectField('Department', choices=DEPARTMENT_CHOICES)
     urgency = SelectField('Urgency', choices=[
         ('Low', 'Low'),
         ('Normal', 'Normal'),
@@ -55,16 +58,7 @@ class EmployeeRegistrationForm(FlaskForm):
     last_name = StringField('Last Name', validators=[DataRequired(), Length(max=100)])
     email = StringField('Email', validators=[DataRequired(), Email(), Length(max=120)])
     phone = StringField('Phone Number', validators=[Length(max=20)])
-    department = SelectField('Department', choices=[
-        ('Finance', 'Finance'),
-        ('HR', 'Human Resources'),
-        ('IT', 'Information Technology'),
-        ('Marketing', 'Marketing'),
-        ('Operations', 'Operations'),
-        ('Sales', 'Sales'),
-        ('Legal', 'Legal'),
-        ('Administration', 'Administration')
-    ])
+    department = SelectField('Department', choices=DEPARTMENT_CHOICES)
     position = StringField('Position', validators=[DataRequired(), Length(max=100)])
     start_date = DateField('Start Date', validators=[DataRequired()])
     salary = FloatField('Salary', validators=[NumberRange(min=0)])
@@ -76,16 +70,7 @@ class EmployeeRegistrationForm(FlaskForm):
 
 class ExpenseRecordForm(FlaskForm):
     expense_id = StringField('Expense ID', validators=[DataRequired(), Length(max=50)])
-    department = SelectField('Department', choices=[
-        ('Finance', 'Finance'),
-        ('HR', 'Human Resources'),
-        ('IT', 'Information Technology'),
-        ('Marketing', 'Marketing'),
-        ('Operations', 'Operations'),
-        ('Sales', 'Sales'),
-        ('Legal', 'Legal'),
-        ('Administration', 'Administration')
-    ])
+    department = SelectField('Department', choices=DEPARTMENT_CHOICES)
 
 class ApprovalForm(FlaskForm):
     status = SelectField('Status', choices=[
@@ -94,6 +79,13 @@ class ApprovalForm(FlaskForm):
     ])
     admin_notes = TextAreaField('Admin Notes')
 
+class TimesheetForm(FlaskForm):
+    project = StringField('Project', validators=[DataRequired(), Length(max=200)])
+    hours = FloatField('Hours', validators=[DataRequired(), NumberRange(min=0.25, max=24)])
+    work_date = DateField('Work Date', validators=[DataRequired()])
+    latitude = FloatField('Latitude', validators=[Optional()], render_kw={'readonly': True, 'id': 'latitude'})
+    longitude = FloatField('Longitude', validators=[Optional()], render_kw={'readonly': True, 'id': 'longitude'})
+
 # GPS fields fallback
 
 # === GPS Fields ===
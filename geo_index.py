@@ -0,0 +1,101 @@
+# Geohash spatial index
+#
+# A geohash interleaves longitude and latitude bits into a base-32 string,
+# so points that are close share a prefix and every geohash cell is a
+# contiguous key range. Storing the geohash in an ordinary B-tree index
+# turns a bounding-box query into a handful of range scans: the box is
+# covered with at most MAX_COVER_CELLS cells at the finest precision that
+# allows, adjacent cells are merged into one range, and the exact
+# latitude/longitude test then drops the few points in the cells' margins.
+# Like tile_pyramid, this module must not import the Flask app.
+
+import json
+
+GEOHASH_PRECISION = 12
+
+MAX_COVER_CELLS = 32
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def _bits(precision):
+    """(longitude bits, latitude bits) of a geohash of this length"""
+    total = 5 * precision
+    return (total + 1) // 2, total // 2
+
+def _cell_code(lon_index, lat_index, precision):
+    lon_bits, lat_bits = _bits(precision)
+    code = 0
+    # Bits alternate starting with longitude, most significant first
+    for bit in range(5 * precision):
+        if bit % 2 == 0:
+            lon_bits -= 1
+            code = (code << 1) | ((lon_index >> lon_bits) & 1)
+        else:
+            lat_bits -= 1
+            code = (code << 1) | ((lat_index >> lat_bits) & 1)
+    return ''.join(_BASE32[(code >> shift) & 31] for shift in range(5 * (precision - 1), -1, -5))
+
+def _index(value, low, span, bits):
+    return min(int((value - low) / span * (1 << bits)), (1 << bits) - 1)
+
+def encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    """Geohash of a point"""
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError(f"({latitude}, {longitude}) is not a valid position")
+    lon_bits, lat_bits = _bits(precision)
+    return _cell_code(_index(longitude, -180, 360, lon_bits), _index(latitude, -90, 180, lat_bits), precision)
+
+def parse_bbox(value):
+    """(min_lon, min_lat, max_lon, max_lat) from 'min_lon,min_lat,max_lon,max_lat'; raises ValueError"""
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(part) for part in value.split(','))
+    except (AttributeError, ValueError):
+        raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+    if not (-180 <= min_lon <= 180 and -180 <= max_lon <= 180 and -90 <= min_lat <= max_lat <= 90):
+        raise ValueError("bbox is outside -180..180 longitude / -90..90 latitude")
+    return min_lon, min_lat, max_lon, max_lat
+
+def _cover(min_lon, min_lat, max_lon, max_lat, max_cells):
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        lon_bits, lat_bits = _bits(precision)
+        lon_first, lon_last = _index(min_lon, -180, 360, lon_bits), _index(max_lon, -180, 360, lon_bits)
+        lat_first, lat_last = _index(min_lat, -90, 180, lat_bits), _index(max_lat, -90, 180, lat_bits)
+        if (lon_last - lon_first + 1) * (lat_last - lat_first + 1) <= max_cells or precision == 1:
+            return {_cell_code(lon, lat, precision)
+                    for lon in range(lon_first, lon_last + 1) for lat in range(lat_first, lat_last + 1)}
+
+def _successor(prefix):
+    """Smallest string greater than every string starting with prefix, or None"""
+    while prefix:
+        position = _BASE32.index(prefix[-1])
+        if position < 31:
+            return prefix[:-1] + _BASE32[position + 1]
+        prefix = prefix[:-1]
+    return None
+
+def bbox_ranges(bbox, max_cells=MAX_COVER_CELLS):
+    """Sorted, merged [low, high) geohash ranges covering a bounding box; high None means unbounded.
+
+    A box whose min_lon is greater than its max_lon crosses the antimeridian.
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    if min_lon > max_lon:
+        cells = _cover(min_lon, min_lat, 180, max_lat, max_cells // 2) | _cover(-180, min_lat, max_lon, max_lat, max_cells // 2)
+    else:
+        cells = _cover(min_lon, min_lat, max_lon, max_lat, max_cells)
+    ranges = []
+    for cell in sorted(cells):
+        high = _successor(cell)
+        if ranges and ranges[-1][1] == cell:
+            ranges[-1][1] = high
+        else:
+            ranges.append([cell, high])
+    return [tuple(item) for item in ranges]
+
+def load_zones(path=None):
+    """Site zone name -> bbox from a JSON file of {"Zone A": [min_lon, min_lat, max_lon, max_lat]}"""
+    if not path:
+        return {}
+    with open(path) as handle:
+        zones = json.load(handle)
+    return {name: parse_bbox(','.join(str(part) for part in bbox)) for name, bbox in zones.items()}
@@ -0,0 +1,16 @@
+# Gunicorn configuration for Alpha Ultimate Workdesk
+#
+# gevent workers hold the dashboards' idle event streams without tying up a
+# worker each. gevent patches the socket module, but psycopg2 talks to
+# PostgreSQL through libpq in C and would block the whole worker on every
+# query; post_fork gives it a wait callback that yields to the hub instead.
+bind = "0.0.0.0:8000"
+workers = 4
+worker_class = "gevent"
+worker_connections = 1000
+
+
+def post_fork(server, worker):
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+    worker.log.info("psycopg2 made gevent-cooperative")
@@ -0,0 +1,512 @@
+# Sensor ingest gateway
+#
+# Standalone asyncio process that accepts readings from field devices over
+# TCP and UDP, buffers them in memory and writes them through
+# iot_ingest.ingest_readings in large batches, one transaction per batch.
+#
+# Line protocol, one reading per line (spaces in tags escaped as "\ "):
+#   a-01,zone=Zone\ A temperature=41.2,humidity=38 1718000000.5
+# The trailing epoch timestamp is optional (receipt time is used).
+#
+# Binary protocol, big-endian frames:
+#   0xA7, version 1, uint16 body length, then the body:
+#   float64 epoch timestamp (0 = receipt time), uint8 sensor id length +
+#   bytes, uint8 zone length + bytes, uint8 count, count x (uint8 metric
+#   code, float32 value)
+#
+# Devices authenticate with the same shared key as the HTTP ingest API
+# (IOT_GATEWAY_KEY, falling back to IOT_INGEST_KEY): a TCP connection starts
+# with the line "AUTH <key>", and every UDP datagram starts with that line
+# too. Anything else is dropped. After the AUTH line a TCP connection uses
+# the binary protocol when its next byte is 0xA7 and the line protocol
+# otherwise; so does the rest of each UDP datagram. Metrics are served as
+# JSON over HTTP on the metrics port.
+#
+# The key travels in clear text and UDP readings can be replayed, so the
+# gateway listens on localhost unless IOT_GATEWAY_HOST says otherwise, and
+# must only be exposed on a trusted device network (or behind a TLS/VPN
+# terminator).
+#
+#   python iot_gateway.py serve                    # needs DATABASE_URL and a key
+#   python iot_gateway.py serve --dry-run          # count only, no database
+#   python iot_gateway.py simulate --devices 500 --rate 2 --duration 30 --protocol binary --transport udp
+
+import os
+import re
+import hmac
+import json
+import time
+import random
+import signal
+import struct
+import asyncio
+import logging
+import argparse
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+GATEWAY_HOST = os.environ.get("IOT_GATEWAY_HOST", "127.0.0.1")
+GATEWAY_TCP_PORT = int(os.environ.get("IOT_GATEWAY_TCP_PORT", 7070))
+GATEWAY_UDP_PORT = int(os.environ.get("IOT_GATEWAY_UDP_PORT", 7071))
+GATEWAY_METRICS_PORT = int(os.environ.get("IOT_GATEWAY_METRICS_PORT", 7072))
+
+# Shared device key; the gateway does not start without one
+GATEWAY_KEY = os.environ.get("IOT_GATEWAY_KEY") or os.environ.get("IOT_INGEST_KEY")
+
+# Readings per ingest transaction, and the longest a reading waits for one
+GATEWAY_BATCH = int(os.environ.get("IOT_GATEWAY_BATCH", 5000))
+GATEWAY_FLUSH_SECONDS = float(os.environ.get("IOT_GATEWAY_FLUSH_SECONDS", 1))
+
+# Buffered readings at which TCP devices are paused and UDP datagrams dropped
+GATEWAY_MAX_BUFFER = int(os.environ.get("IOT_GATEWAY_MAX_BUFFER", 100000))
+
+# TCP connections silent this long are closed
+GATEWAY_IDLE_SECONDS = int(os.environ.get("IOT_GATEWAY_IDLE_SECONDS", 300))
+
+GATEWAY_MAX_LINE = 1024
+
+FRAME_MAGIC = 0xA7
+FRAME_VERSION = 1
+_FRAME_HEADER = struct.Struct('>BBH')
+_FRAME_VALUE = struct.Struct('>Bf')
+
+# Binary protocol metric codes; devices depend on them, so never renumber
+METRIC_CODES = {1: 'temperature', 2: 'humidity', 3: 'noise'}
+METRIC_NUMBERS = {name: code for code, name in METRIC_CODES.items()}
+
+_UNESCAPED_SPACE = re.compile(r'(?<!\\) ')
+
+def auth_line(key):
+    return f"AUTH {key}\n".encode('utf-8')
+
+def parse_line(line, received_at):
+    """Reading payload (as accepted by ingest_readings) from one protocol line"""
+    parts = _UNESCAPED_SPACE.split(line.strip())
+    if len(parts) not in (2, 3):
+        raise ValueError('expected "<sensor>,zone=<zone> <metric>=<value>[,...] [<timestamp>]"')
+    tags = parts[0].split(',')
+    reading = {'sensor_id': tags[0].replace('\\ ', ' ')}
+    for tag in tags[1:]:
+        key, _, value = tag.partition('=')
+        if key == 'zone':
+            reading['zone'] = value.replace('\\ ', ' ')
+    for field in parts[1].split(','):
+        key, _, value = field.partition('=')
+        reading[key] = float(value)
+    reading['recorded_at'] = float(parts[2]) if len(parts) == 3 else received_at
+    return reading
+
+def format_line(reading):
+    tags = f"{reading['sensor_id']},zone={reading['zone']}".replace(' ', '\\ ')
+    fields = ','.join(f"{metric}={reading[metric]}" for metric in METRIC_NUMBERS if metric in reading)
+    timestamp = f" {reading['recorded_at']}" if reading.get('recorded_at') else ''
+    return f"{tags} {fields}{timestamp}\n"
+
+def encode_frame(reading):
+    sensor_id = reading['sensor_id'].encode('utf-8')
+    zone = reading['zone'].encode('utf-8')
+    values = [(code, reading[metric]) for metric, code in METRIC_NUMBERS.items() if metric in reading]
+    body = (struct.pack('>dB', reading.get('recorded_at') or 0, len(sensor_id)) + sensor_id
+            + struct.pack('>B', len(zone)) + zone + struct.pack('>B', len(values))
+            + b''.join(_FRAME_VALUE.pack(code, value) for code, value in values))
+    return _FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, len(body)) + body
+
+def decode_frame_body(body, received_at):
+    """Reading payload from a frame body; raises ValueError when malformed"""
+    try:
+        timestamp, length = struct.unpack_from('>dB', body, 0)
+        offset = 9
+        sensor_id = body[offset:offset + length].decode('utf-8')
+        offset += length
+        length = body[offset]
+        zone = body[offset + 1:offset + 1 + length].decode('utf-8')
+        offset += 1 + length
+        count = body[offset]
+        offset += 1
+        reading = {'sensor_id': sensor_id, 'zone': zone, 'recorded_at': timestamp or received_at}
+        for _ in range(count):
+            code, value = _FRAME_VALUE.unpack_from(body, offset)
+            offset += _FRAME_VALUE.size
+            if code in METRIC_CODES:
+                # float32 on the wire; keep the precision the device sent
+                reading[METRIC_CODES[code]] = round(value, 4)
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError(f"malformed frame: {e}")
+    return reading
+
+def decode_frames(data, received_at):
+    """Readings from a buffer of whole frames (one UDP datagram)"""
+    readings, offset = [], 0
+    while offset < len(data):
+        if len(data) - offset < _FRAME_HEADER.size:
+            raise ValueError("truncated frame header")
+        magic, version, length = _FRAME_HEADER.unpack_from(data, offset)
+        if magic != FRAME_MAGIC or version != FRAME_VERSION:
+            raise ValueError("bad frame magic or version")
+        offset += _FRAME_HEADER.size
+        if len(data) - offset < length:
+            raise ValueError("truncated frame body")
+        readings.append(decode_frame_body(data[offset:offset + length], received_at))
+        offset += length
+    return readings
+
+class GatewayMetrics:
+    """Counters plus message rate and flush latency"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.connections_open = 0
+        self.connections_total = 0
+        self.messages = 0
+        self.parse_errors = 0
+        self.auth_failures = 0
+        self.dropped = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.flushes = 0
+        self.flush_failures = 0
+        self.flush_seconds_total = 0.0
+        self.flush_seconds_max = 0.0
+        self.flush_seconds_last = 0.0
+        self._marks = deque(maxlen=11)
+
+    def mark(self):
+        """Sample the message counter; called once a second"""
+        self._marks.append((time.monotonic(), self.messages))
+
+    def messages_per_second(self):
+        if len(self._marks) < 2:
+            return 0.0
+        (start, first), (end, last) = self._marks[0], self._marks[-1]
+        return (last - first) / (end - start) if end > start else 0.0
+
+    def record_flush(self, seconds, accepted, rejected):
+        self.flushes += 1
+        self.accepted += accepted
+        self.rejected += rejected
+        self.flush_seconds_total += seconds
+        self.flush_seconds_last = seconds
+        self.flush_seconds_max = max(self.flush_seconds_max, seconds)
+
+    def snapshot(self, buffered):
+        return {
+            'uptime_seconds': round(time.time() - self.started),
+            'connections_open': self.connections_open,
+            'connections_total': self.connections_total,
+            'messages': self.messages,
+            'messages_per_second': round(self.messages_per_second(), 1),
+            'parse_errors': self.parse_errors,
+            'auth_failures': self.auth_failures,
+            'dropped': self.dropped,
+            'buffered': buffered,
+            'readings_accepted': self.accepted,
+            'readings_rejected': self.rejected,
+            'flushes': self.flushes,
+            'flush_failures': self.flush_failures,
+            'flush_ms_last': round(self.flush_seconds_last * 1000, 1),
+            'flush_ms_avg': round(self.flush_seconds_total * 1000 / self.flushes, 1) if self.flushes else 0.0,
+            'flush_ms_max': round(self.flush_seconds_max * 1000, 1),
+        }
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, gateway):
+        self.gateway = gateway
+
+    def datagram_received(self, data, addr):
+        gateway = self.gateway
+        received_at = time.time()
+        first, newline, data = data.partition(b'\n')
+        if not newline or not gateway.authorized(first):
+            gateway.metrics.auth_failures += 1
+            return
+        try:
+            if data[:1] == bytes([FRAME_MAGIC]):
+                readings = decode_frames(data, received_at)
+            else:
+                readings = [parse_line(line, received_at)
+                            for line in data.decode('utf-8').splitlines() if line.strip()]
+        except (ValueError, UnicodeDecodeError):
+            gateway.metrics.parse_errors += 1
+            return
+        gateway.metrics.messages += len(readings)
+        if len(gateway.buffer) + len(readings) > gateway.max_buffer:
+            gateway.metrics.dropped += len(readings)
+            return
+        gateway.add(readings)
+
+class Gateway:
+    """Receives readings, buffers them and hands batches to sink(readings) -> (accepted, rejected).
+
+    The sink runs in a worker thread, one batch at a time, so the event
+    loop keeps reading from devices while a transaction is in flight.
+    """
+
+    def __init__(self, sink, key=GATEWAY_KEY, batch_size=GATEWAY_BATCH, flush_seconds=GATEWAY_FLUSH_SECONDS,
+                 max_buffer=GATEWAY_MAX_BUFFER):
+        if not key:
+            raise ValueError("The gateway needs a device key (IOT_GATEWAY_KEY or IOT_INGEST_KEY)")
+        self.sink = sink
+        self.key = key.encode('utf-8')
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_buffer = max_buffer
+        self.buffer = []
+        self.metrics = GatewayMetrics()
+        self._flush_now = asyncio.Event()
+        self._room = asyncio.Event()
+        self._room.set()
+        self._stopping = asyncio.Event()
+        self._failures = 0
+
+    def authorized(self, line):
+        """Whether line is "AUTH <key>" with the gateway's key"""
+        line = line.rstrip(b'\r\n')
+        return line.startswith(b'AUTH ') and hmac.compare_digest(line[5:], self.key)
+
+    def add(self, readings):
+        self.buffer.extend(readings)
+        if len(self.buffer) >= self.batch_size:
+            self._flush_now.set()
+        if len(self.buffer) >= self.max_buffer:
+            self._room.clear()
+
+    async def _accept(self, readings):
+        self.metrics.messages += len(readings)
+        self.add(readings)
+        if not self._room.is_set():
+            # Backpressure: stop reading from this device until a flush makes room
+            await self._room.wait()
+
+    async def _handle_tcp(self, reader, writer):
+        metrics = self.metrics
+        metrics.connections_open += 1
+        metrics.connections_total += 1
+        try:
+            if not self.authorized(await asyncio.wait_for(reader.readline(), GATEWAY_IDLE_SECONDS)):
+                metrics.auth_failures += 1
+                return
+            first = await asyncio.wait_for(reader.readexactly(1), GATEWAY_IDLE_SECONDS)
+            if first[0] == FRAME_MAGIC:
+                header = first + await reader.readexactly(_FRAME_HEADER.size - 1)
+                while True:
+                    magic, version, length = _FRAME_HEADER.unpack(header)
+                    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+                        metrics.parse_errors += 1
+                        break  # the stream is out of sync; the device reconnects
+                    body = await reader.readexactly(length)
+                    try:
+                        await self._accept([decode_frame_body(body, time.time())])
+                    except ValueError:
+                        metrics.parse_errors += 1
+                    header = await asyncio.wait_for(reader.readexactly(_FRAME_HEADER.size), GATEWAY_IDLE_SECONDS)
+            else:
+                pending = first
+                while True:
+                    line = pending + await asyncio.wait_for(reader.readline(), GATEWAY_IDLE_SECONDS)
+                    pending = b''
+                    if not line:
+                        break
+                    if len(line) > GATEWAY_MAX_LINE:
+                        metrics.parse_errors += 1
+                        break
+                    if not line.strip():
+                        continue
+                    try:
+                        await self._accept([parse_line(line.decode('utf-8'), time.time())])
+                    except (ValueError, UnicodeDecodeError):
+                        metrics.parse_errors += 1
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, asyncio.LimitOverrunError,
+                ValueError, ConnectionError):
+            pass
+        finally:
+            metrics.connections_open -= 1
+            writer.close()
+
+    async def _handle_metrics(self, reader, writer):
+        try:
+            await asyncio.wait_for(reader.readline(), 5)
+            body = json.dumps(self.metrics.snapshot(len(self.buffer))).encode()
+            writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: application/json\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def flush(self):
+        """Write everything buffered, in batches; on failure the batch is kept for the next try"""
+        loop = asyncio.get_running_loop()
+        while self.buffer:
+            batch = self.buffer[:self.batch_size]
+            del self.buffer[:self.batch_size]
+            if len(self.buffer) < self.max_buffer:
+                self._room.set()
+            started = time.perf_counter()
+            try:
+                accepted, rejected = await loop.run_in_executor(None, self.sink, batch)
+            except Exception as e:
+                self.metrics.flush_failures += 1
+                self._failures += 1
+                self.buffer[:0] = batch
+                if len(self.buffer) > self.max_buffer:
+                    # Bounded memory during a long outage: shed the oldest readings
+                    excess = len(self.buffer) - self.max_buffer
+                    del self.buffer[:excess]
+                    self.metrics.dropped += excess
+                logger.error(f"Gateway flush of {len(batch)} readings failed: {e}")
+                return False
+            self._failures = 0
+            self.metrics.record_flush(time.perf_counter() - started, accepted, rejected)
+        return True
+
+    async def _flusher(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            if not await self.flush():
+                await asyncio.sleep(min(2 ** self._failures, 30))
+
+    async def _reporter(self, interval=10):
+        ticks = 0
+        while not self._stopping.is_set():
+            await asyncio.sleep(1)
+            self.metrics.mark()
+            ticks += 1
+            if ticks % interval == 0:
+                snapshot = self.metrics.snapshot(len(self.buffer))
+                logger.info(f"Gateway: {snapshot['connections_open']} connections, "
+                            f"{snapshot['messages_per_second']} msg/s, {snapshot['buffered']} buffered, "
+                            f"flush avg {snapshot['flush_ms_avg']} ms")
+
+    def stop(self):
+        self._stopping.set()
+
+    async def run(self, host=GATEWAY_HOST, tcp_port=GATEWAY_TCP_PORT, udp_port=GATEWAY_UDP_PORT,
+                  metrics_port=GATEWAY_METRICS_PORT):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        tcp = await asyncio.start_server(self._handle_tcp, host, tcp_port, limit=GATEWAY_MAX_LINE * 2)
+        udp, _ = await loop.create_datagram_endpoint(lambda: _DatagramProtocol(self), local_addr=(host, udp_port))
+        metrics = await asyncio.start_server(self._handle_metrics, host, metrics_port)
+        logger.info(f"Gateway listening on tcp/{tcp_port}, udp/{udp_port}, metrics on {metrics_port}")
+
+        tasks = [asyncio.create_task(self._flusher()), asyncio.create_task(self._reporter())]
+        await self._stopping.wait()
+
+        tcp.close()
+        metrics.close()
+        udp.close()
+        for task in tasks:
+            task.cancel()
+        await self.flush()
+        logger.info(f"Gateway stopped: {self.metrics.snapshot(len(self.buffer))}")
+
+def database_sink():
+    """Sink writing batches with ingest_readings inside an app context"""
+    from app import app, db
+    from iot_ingest import ingest_readings
+
+    def write(readings):
+        with app.app_context():
+            try:
+                written, errors = ingest_readings(readings)
+                return len(readings) - len(errors), len(errors)
+            except Exception:
+                db.session.rollback()
+                raise
+            finally:
+                db.session.remove()
+    return write
+
+def null_sink(readings):
+    return len(readings), 0
+
+# --- simulated fleet ---
+
+async def _device(index, args, counter, deadline):
+    rng = random.Random(index)
+    sensor_id = f"sim-{index:05d}"
+    zone = f"Zone {'ABCD'[index % 4]}"
+    values = {'temperature': rng.uniform(20, 35), 'humidity': rng.uniform(30, 60), 'noise': rng.uniform(50, 75)}
+    interval = 1 / args.rate
+    encode = encode_frame if args.protocol == 'binary' else (lambda reading: format_line(reading).encode())
+
+    auth = auth_line(args.key)
+    if args.transport == 'tcp':
+        _, writer = await asyncio.open_connection(args.host, args.tcp_port)
+        writer.write(auth)
+        send = writer.write
+    else:
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol,
+                                                           remote_addr=(args.host, args.udp_port))
+        send = lambda payload: transport.sendto(auth + payload)
+
+    await asyncio.sleep(rng.random() * interval)
+    try:
+        while time.monotonic() < deadline:
+            for metric in values:
+                values[metric] += rng.gauss(0, 0.2)
+            reading = {'sensor_id': sensor_id, 'zone': zone, 'recorded_at': round(time.time(), 3),
+                       **{metric: round(value, 1) for metric, value in values.items()}}
+            send(encode(reading))
+            counter[0] += 1
+            if args.transport == 'tcp':
+                await writer.drain()
+            await asyncio.sleep(interval)
+    finally:
+        if args.transport == 'tcp':
+            writer.close()
+        else:
+            transport.close()
+
+async def simulate(args):
+    counter = [0]
+    started = time.monotonic()
+    deadline = started + args.duration
+    results = await asyncio.gather(*(_device(index, args, counter, deadline) for index in range(args.devices)),
+                                   return_exceptions=True)
+    failures = [result for result in results if isinstance(result, Exception)]
+    elapsed = time.monotonic() - started
+    print(f"{args.devices} devices ({args.protocol}/{args.transport}) sent {counter[0]:,} readings "
+          f"in {elapsed:.1f}s ({counter[0] / elapsed:,.0f}/s), {len(failures)} device errors")
+    if failures:
+        print(f"first error: {failures[0]!r}")
+
+def main():
+    parser = argparse.ArgumentParser(description="IoT ingest gateway")
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help='run the gateway')
+    serve.add_argument('--dry-run', action='store_true', help='count readings without writing them')
+    sim = commands.add_parser('simulate', help='run a simulated device fleet against a gateway')
+    sim.add_argument('--host', default='127.0.0.1')
+    sim.add_argument('--tcp-port', type=int, default=GATEWAY_TCP_PORT)
+    sim.add_argument('--udp-port', type=int, default=GATEWAY_UDP_PORT)
+    sim.add_argument('--devices', type=int, default=100)
+    sim.add_argument('--rate', type=float, default=1, help='readings per device per second')
+    sim.add_argument('--duration', type=float, default=10)
+    sim.add_argument('--protocol', choices=['line', 'binary'], default='line')
+    sim.add_argument('--transport', choices=['tcp', 'udp'], default='tcp')
+    sim.add_argument('--key', default=GATEWAY_KEY, help='device key (default IOT_GATEWAY_KEY / IOT_INGEST_KEY)')
+    args = parser.parse_args()
+    if not (GATEWAY_KEY if args.command == 'serve' else args.key):
+        parser.error("set IOT_GATEWAY_KEY or IOT_INGEST_KEY to the shared device key")
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    if args.command == 'serve':
+        asyncio.run(Gateway(null_sink if args.dry_run else database_sink()).run())
+    else:
+        asyncio.run(simulate(args))
+
+if __name__ == '__main__':
+    main()
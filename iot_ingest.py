@@ -0,0 +1,400 @@
+import os
+import io
+import atexit
+import csv
+import hmac
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import insert
+from sqlalchemy.dialects import postgresql, sqlite
+from app import db
+from models import SensorReading, SensorLatest, SensorAlertState, Notification
+from timeseries_store import TimeSeriesStore
+from alert_engine import AlertEngine, load_rules
+from notifications import record_sensor_alerts
+from downsampling import TileCache
+
+logger = logging.getLogger(__name__)
+
+# Accepted metrics and their plausible ranges
+IOT_METRICS = {
+    'temperature': (-40.0, 85.0),
+    'humidity': (0.0, 100.0),
+    'noise': (0.0, 160.0)
+}
+
+# Shared secret sensors send in the X-IoT-Key header; ingest is off without it
+IOT_INGEST_KEY = os.environ.get("IOT_INGEST_KEY")
+
+# Optional comma-separated list of known zones, e.g. "Zone A,Zone B,Zone C"
+IOT_ZONES = {zone.strip() for zone in os.environ.get("IOT_ZONES", "").split(',') if zone.strip()}
+
+IOT_MAX_BATCH = int(os.environ.get("IOT_MAX_BATCH", 5000))
+
+# Readings stamped further than this in the future are rejected
+IOT_MAX_CLOCK_SKEW = int(os.environ.get("IOT_MAX_CLOCK_SKEW", 300))
+
+# Batches at least this large are written with COPY on PostgreSQL
+IOT_COPY_THRESHOLD = int(os.environ.get("IOT_COPY_THRESHOLD", 500))
+
+# How often a worker pulls other workers' latest values, and when a sensor is
+# considered silent and left out of the dashboard averages
+IOT_LATEST_REFRESH = float(os.environ.get("IOT_LATEST_REFRESH", 2))
+IOT_STALE_SECONDS = int(os.environ.get("IOT_STALE_SECONDS", 600))
+
+# Directory of the compressed time-series store; when set, every accepted
+# reading is also appended there for range scans and window aggregates
+IOT_TIMESERIES_DIR = os.environ.get("IOT_TIMESERIES_DIR")
+
+# JSON file of alert rule specs (see alert_engine); the built-in rules otherwise
+IOT_ALERT_RULES = os.environ.get("IOT_ALERT_RULES")
+
+# Largest raw (unaggregated) range the series API returns
+IOT_SERIES_MAX_POINTS = int(os.environ.get("IOT_SERIES_MAX_POINTS", 10000))
+
+# Downsampled chart tiles ending this long ago are treated as final and
+# cached; it covers unsealed store heads and clock skew. Late readings
+# older than this do not show in already cached tiles.
+IOT_SERIES_SETTLE_SECONDS = int(os.environ.get("IOT_SERIES_SETTLE_SECONDS", 900))
+IOT_SERIES_CACHE_TILES = int(os.environ.get("IOT_SERIES_CACHE_TILES", 4096))
+
+def ingest_key_valid(key):
+    return bool(IOT_INGEST_KEY) and hmac.compare_digest(key or '', IOT_INGEST_KEY)
+
+def parse_timestamp(value):
+    """Naive UTC datetime from an ISO 8601 string or epoch seconds"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return datetime.fromtimestamp(value, tz=timezone.utc).replace(tzinfo=None)
+    if isinstance(value, str):
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if parsed.tzinfo:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        return parsed
+    raise ValueError("recorded_at must be an ISO 8601 string or epoch seconds")
+
+def validate_batch(readings, now=None):
+    """Turn a batch of sensor payloads into reading rows plus per-item errors.
+
+    Each payload names a sensor, a zone, an optional recorded_at and one or
+    more metric values, e.g. {"sensor_id": "a-01", "zone": "Zone A",
+    "temperature": 41.2, "humidity": 38}.
+    """
+    now = now or datetime.utcnow()
+    latest_allowed = now + timedelta(seconds=IOT_MAX_CLOCK_SKEW)
+    rows, errors = [], []
+
+    for index, reading in enumerate(readings):
+        if not isinstance(reading, dict):
+            errors.append({'index': index, 'error': 'reading must be an object'})
+            continue
+        sensor_id = str(reading.get('sensor_id') or '').strip()
+        zone = str(reading.get('zone') or '').strip()
+        if not sensor_id or len(sensor_id) > 64:
+            errors.append({'index': index, 'error': 'sensor_id is required (max 64 characters)'})
+            continue
+        if not zone or len(zone) > 50 or (IOT_ZONES and zone not in IOT_ZONES):
+            errors.append({'index': index, 'error': f'unknown zone: {zone or "(missing)"}'})
+            continue
+        try:
+            recorded_at = parse_timestamp(reading['recorded_at']) if reading.get('recorded_at') is not None else now
+        except ValueError as e:
+            errors.append({'index': index, 'error': str(e)})
+            continue
+        if recorded_at > latest_allowed:
+            errors.append({'index': index, 'error': 'recorded_at is in the future'})
+            continue
+
+        values = []
+        for metric, (low, high) in IOT_METRICS.items():
+            value = reading.get(metric)
+            if value is None:
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not low <= value <= high:
+                values = None
+                errors.append({'index': index, 'error': f'{metric} must be a number between {low} and {high}'})
+                break
+            values.append((metric, float(value)))
+        if values is None:
+            continue
+        if not values:
+            errors.append({'index': index, 'error': f'no metric values ({", ".join(IOT_METRICS)})'})
+            continue
+
+        for metric, value in values:
+            rows.append(dict(sensor_id=sensor_id, zone=zone, metric=metric, value=value,
+                             recorded_at=recorded_at, received_at=now))
+    return rows, errors
+
+_store = None
+_store_pid = None
+
+def get_timeseries_store():
+    """This worker's time-series store, or None when IOT_TIMESERIES_DIR is unset.
+
+    Opened lazily so each gunicorn worker writes its own chunk file after fork.
+    """
+    global _store, _store_pid
+    if not IOT_TIMESERIES_DIR:
+        return None
+    if _store is None or _store_pid != os.getpid():
+        _store = TimeSeriesStore(IOT_TIMESERIES_DIR)
+        _store_pid = os.getpid()
+        atexit.register(_store.close)
+    return _store
+
+def series_key(sensor_id, metric):
+    return f"{sensor_id}/{metric}"
+
+def epoch_ms(moment):
+    """Milliseconds since the epoch for a naive UTC datetime"""
+    return int(moment.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+def from_epoch_ms(value):
+    return datetime.fromtimestamp(value / 1000, tz=timezone.utc).replace(tzinfo=None)
+
+def _copy_readings(rows):
+    """Stream rows into the readings table with COPY; False when the driver cannot"""
+    cursor = db.session.connection().connection.cursor()
+    if not hasattr(cursor, 'copy_expert'):
+        cursor.close()
+        return False
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row['sensor_id'], row['zone'], row['metric'], repr(row['value']),
+                         row['recorded_at'].isoformat(), row['received_at'].isoformat()])
+    buffer.seek(0)
+    try:
+        cursor.copy_expert(
+            f"COPY {SensorReading.__table__.name} (sensor_id, zone, metric, value, recorded_at, received_at) "
+            "FROM STDIN WITH (FORMAT csv)", buffer
+        )
+    finally:
+        cursor.close()
+    return True
+
+def _newest_per_sensor(rows):
+    newest = {}
+    for row in rows:
+        key = (row['sensor_id'], row['metric'])
+        if key not in newest or row['recorded_at'] >= newest[key]['recorded_at']:
+            newest[key] = row
+    return list(newest.values())
+
+def _upsert_latest(rows, chunk_size=1000):
+    """Move SensorLatest forward for every sensor in the batch, never backwards"""
+    dialect = db.session.get_bind().dialect.name
+    now = datetime.utcnow()
+    latest = [dict(sensor_id=row['sensor_id'], metric=row['metric'], zone=row['zone'], value=row['value'],
+                   recorded_at=row['recorded_at'], updated_at=now) for row in rows]
+
+    if dialect in ('postgresql', 'sqlite'):
+        dialect_insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        for start in range(0, len(latest), chunk_size):
+            statement = dialect_insert(SensorLatest).values(latest[start:start + chunk_size])
+            statement = statement.on_conflict_do_update(
+                index_elements=['sensor_id', 'metric'],
+                set_={name: statement.excluded[name] for name in ('zone', 'value', 'recorded_at', 'updated_at')},
+                where=SensorLatest.recorded_at <= statement.excluded.recorded_at
+            )
+            db.session.execute(statement)
+        return
+
+    for values in latest:
+        current = db.session.get(SensorLatest, (values['sensor_id'], values['metric']))
+        if current is None:
+            db.session.add(SensorLatest(**values))
+        elif current.recorded_at <= values['recorded_at']:
+            for name, value in values.items():
+                setattr(current, name, value)
+
+def ingest_readings(readings):
+    """Validate and store a batch; returns (rows written, errors)"""
+    rows, errors = validate_batch(readings)
+    if not rows:
+        return 0, errors
+
+    copied = False
+    if len(rows) >= IOT_COPY_THRESHOLD and db.session.get_bind().dialect.name == 'postgresql':
+        copied = _copy_readings(rows)
+    if not copied:
+        db.session.execute(insert(SensorReading), rows)
+
+    newest = _newest_per_sensor(rows)
+    _upsert_latest(newest)
+    db.session.commit()
+    latest_cache.apply(newest)
+
+    store = get_timeseries_store()
+    if store is not None:
+        for row in rows:
+            store.append(series_key(row['sensor_id'], row['metric']), epoch_ms(row['recorded_at']), row['value'])
+
+    _evaluate_alerts(rows)
+    db.session.commit()
+    return len(rows), errors
+
+def _alert_states(keys, readings, chunk_size=1000):
+    """Shared alert state of the (sensor_id, metric) keys, locked until the caller commits"""
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        dialect_insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        missing = [dict(sensor_id=sensor_id, metric=metric) for sensor_id, metric in sorted(keys)]
+        for start in range(0, len(missing), chunk_size):
+            db.session.execute(dialect_insert(SensorAlertState).values(missing[start:start + chunk_size])
+                               .on_conflict_do_nothing(index_elements=['sensor_id', 'metric']))
+    else:
+        known = {(row.sensor_id, row.metric) for row in SensorAlertState.query.filter(
+            SensorAlertState.sensor_id.in_({sensor_id for sensor_id, _ in keys}))}
+        db.session.add_all(SensorAlertState(sensor_id=sensor_id, metric=metric)
+                           for sensor_id, metric in keys if (sensor_id, metric) not in known)
+        db.session.flush()
+
+    # Locked in key order, so concurrent batches over the same sensors wait rather than deadlock
+    stored = {(row.sensor_id, row.metric): row for row in (
+        SensorAlertState.query
+        .filter(SensorAlertState.sensor_id.in_({sensor_id for sensor_id, _ in keys}))
+        .order_by(SensorAlertState.sensor_id, SensorAlertState.metric)
+        .with_for_update().all()
+    ) if (row.sensor_id, row.metric) in keys}
+
+    states, unseen = {}, []
+    for key, row in stored.items():
+        state = json.loads(row.state) if row.state else None
+        rules = len([rule for rule in sensor_alerts.rules if rule.metric == key[1]])
+        if state is None or len(state) != 1 + 4 * rules:
+            unseen.append(key)
+        else:
+            states[key] = state
+
+    if unseen:
+        # Sensors new to the shared state (or to a changed rule set) pick up
+        # alerts still open from before, so those can resolve
+        source_keys = {f"sensor:{rule.name}:{sensor_id}": rule.name
+                       for sensor_id, metric in unseen for rule in sensor_alerts.rules if rule.metric == metric}
+        open_keys = {row.source_key for row in db.session.query(Notification.source_key).filter(
+            Notification.source_key.in_(source_keys), Notification.resolved_at.is_(None))}
+        first = {}
+        for sensor_id, _, metric, _, timestamp in readings:
+            first.setdefault((sensor_id, metric), timestamp)
+        for sensor_id, metric in unseen:
+            firing = {rule.name for rule in sensor_alerts.rules
+                      if rule.metric == metric and f"sensor:{rule.name}:{sensor_id}" in open_keys}
+            states[(sensor_id, metric)] = sensor_alerts.new_state(metric, first[(sensor_id, metric)], firing)
+    return stored, states
+
+def _evaluate_alerts(rows):
+    """Run a stored batch through the alert rules; the caller commits.
+
+    Rule state lives in SensorAlertState, so rate and sustained rules see
+    a sensor's consecutive readings whichever worker or gateway took them.
+    """
+    readings = sorted(
+        ((row['sensor_id'], row['zone'], row['metric'], row['value'], epoch_ms(row['recorded_at']) / 1000)
+         for row in rows if row['metric'] in sensor_alerts.metrics),
+        key=lambda reading: reading[4]
+    )
+    if not readings:
+        return
+    keys = {(sensor_id, metric) for sensor_id, _, metric, _, _ in readings}
+    stored, states = _alert_states(keys, readings)
+
+    alerts = sensor_alerts.process(readings, states)
+    now = datetime.utcnow()
+    for key, row in stored.items():
+        row.state = json.dumps(states[key])
+        row.updated_at = now
+    if alerts:
+        record_sensor_alerts(alerts)
+
+class LatestValueCache:
+    """Latest value per sensor and metric held in this worker.
+
+    Ingest in this worker updates it directly; changes from other workers
+    are pulled from SensorLatest at most every IOT_LATEST_REFRESH seconds
+    by updated_at, so dashboard reads never touch the readings table.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._watermark = None
+        self._checked_at = 0
+        self._summary = None
+
+    def apply(self, rows):
+        with self._lock:
+            for row in rows:
+                key = (row['sensor_id'], row['metric'])
+                current = self._values.get(key)
+                if current is None or current['recorded_at'] <= row['recorded_at']:
+                    self._values[key] = {'sensor_id': row['sensor_id'], 'metric': row['metric'], 'zone': row['zone'],
+                                         'value': row['value'], 'recorded_at': row['recorded_at']}
+            self._summary = None
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._checked_at < IOT_LATEST_REFRESH:
+            return
+        self._checked_at = now
+        query = SensorLatest.query
+        if self._watermark is not None:
+            # Overlap the window so rows committed late with an older stamp are not missed
+            query = query.filter(SensorLatest.updated_at > self._watermark - timedelta(seconds=30))
+        changed = query.all()
+        if changed:
+            self._watermark = max(row.updated_at for row in changed)
+            self.apply([{'sensor_id': row.sensor_id, 'metric': row.metric, 'zone': row.zone,
+                         'value': row.value, 'recorded_at': row.recorded_at} for row in changed])
+        elif self._watermark is None:
+            self._watermark = datetime.utcnow() - timedelta(seconds=30)
+        # Staleness depends on the clock, so summaries expire with each refresh
+        self._summary = None
+
+    def sensors(self, zone=None):
+        self.refresh()
+        with self._lock:
+            values = list(self._values.values())
+        return [value for value in values if zone is None or value['zone'] == zone]
+
+    def summary(self):
+        """Dashboard view: average of live sensors per metric, overall and per zone"""
+        self.refresh()
+        summary = self._summary
+        if summary is not None:
+            return summary
+
+        cutoff = datetime.utcnow() - timedelta(seconds=IOT_STALE_SECONDS)
+        totals, zones, newest = {}, {}, None
+        with self._lock:
+            values = list(self._values.values())
+        for value in values:
+            if value['recorded_at'] < cutoff:
+                continue
+            for bucket in (totals, zones.setdefault(value['zone'], {})):
+                metric_total = bucket.setdefault(value['metric'], [0.0, 0])
+                metric_total[0] += value['value']
+                metric_total[1] += 1
+            newest = max(newest, value['recorded_at']) if newest else value['recorded_at']
+
+        def averages(bucket):
+            return {metric: round(bucket[metric][0] / bucket[metric][1], 1) if metric in bucket else None
+                    for metric in IOT_METRICS}
+
+        summary = {
+            **averages(totals),
+            'zones': {zone: averages(bucket) for zone, bucket in sorted(zones.items())},
+            'sensors': len({value['sensor_id'] for value in values if value['recorded_at'] >= cutoff}),
+            'updated_at': newest.isoformat() + 'Z' if newest else None
+        }
+        self._summary = summary
+        return summary
+
+latest_cache = LatestValueCache()
+
+sensor_alerts = AlertEngine(load_rules(IOT_ALERT_RULES))
+
+series_tiles = TileCache(IOT_SERIES_CACHE_TILES)
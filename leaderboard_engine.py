@@ -0,0 +1,332 @@
+import os
+import math
+import random
+import logging
+import threading
+import time
+import click
+from sqlalchemy import update, text
+from sqlalchemy.exc import IntegrityError
+from app import app, db
+from models import LeaderboardEntry, TeamLeaderboard, LeaderboardClock
+from badges import BADGES_BY_KEY, decode_badges, badge_index_condition, parse_legacy_badges
+from schema_upgrade import upgrade_schema
+
+logger = logging.getLogger(__name__)
+
+# How often a worker checks the shared clock for changes made elsewhere
+LEADERBOARD_SYNC_SECONDS = float(os.environ.get("LEADERBOARD_SYNC_SECONDS", 1))
+
+# Full reload interval; also picks up deleted rows, which deltas cannot see
+LEADERBOARD_REBUILD_SECONDS = int(os.environ.get("LEADERBOARD_REBUILD_SECONDS", 3600))
+
+# Deltas larger than this trigger a rebuild instead
+LEADERBOARD_DELTA_LIMIT = int(os.environ.get("LEADERBOARD_DELTA_LIMIT", 5000))
+
+class _Node:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key, levels):
+        self.key = key
+        self.next = [None] * levels
+        self.width = [1] * levels
+
+class IndexableSkipList:
+    """Sorted sequence of unique keys with O(log n) insert, remove, rank and index lookup.
+
+    Each link stores how many positions it skips, so positions are found by
+    summing widths on the way down instead of walking the bottom level.
+    """
+
+    def __init__(self, max_levels=24):
+        self._max_levels = max_levels
+        self._nil = _Node(None, 0)
+        self._head = _Node(None, max_levels)
+        self._head.next = [self._nil] * max_levels
+        self._levels = 1  # Levels in use; higher head links are untouched
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _random_levels(self):
+        return min(self._max_levels, 1 - int(math.log(random.random() or 1e-12, 2)))
+
+    def _chain(self, key):
+        """Last node before key on every level, and the position of each"""
+        chain = [None] * self._levels
+        positions = [0] * self._levels
+        node, position = self._head, 0
+        for level in reversed(range(self._levels)):
+            while node.next[level] is not self._nil and node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+            positions[level] = position
+        return chain, positions
+
+    def insert(self, key):
+        levels = self._random_levels()
+        if levels > self._levels:
+            for level in range(self._levels, levels):
+                self._head.width[level] = self._size + 1
+            self._levels = levels
+        chain, positions = self._chain(key)
+        node = _Node(key, levels)
+        for level in range(levels):
+            prev = chain[level]
+            skipped = positions[0] - positions[level]
+            node.next[level] = prev.next[level]
+            prev.next[level] = node
+            node.width[level] = prev.width[level] - skipped
+            prev.width[level] = skipped + 1
+        for level in range(levels, self._levels):
+            chain[level].width[level] += 1
+        self._size += 1
+
+    def remove(self, key):
+        chain, _ = self._chain(key)
+        node = chain[0].next[0]
+        if node is self._nil or node.key != key:
+            raise KeyError(key)
+        for level in range(len(node.next)):
+            prev = chain[level]
+            prev.width[level] += node.width[level] - 1
+            prev.next[level] = node.next[level]
+        for level in range(len(node.next), self._levels):
+            chain[level].width[level] -= 1
+        self._size -= 1
+
+    def index(self, key):
+        """Zero-based position of key"""
+        chain, positions = self._chain(key)
+        node = chain[0].next[0]
+        if node is self._nil or node.key != key:
+            raise KeyError(key)
+        return positions[0]
+
+    def _node_at(self, index):
+        node, remaining = self._head, index + 1
+        for level in reversed(range(self._levels)):
+            while node.next[level] is not self._nil and node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        return node
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError(index)
+        return self._node_at(index).key
+
+    def slice(self, start, stop):
+        """Keys from position start up to (not including) stop"""
+        start, stop = max(start, 0), min(stop, self._size)
+        keys = []
+        if start >= stop:
+            return keys
+        node = self._node_at(start)
+        for _ in range(stop - start):
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+def current_version():
+    return db.session.query(LeaderboardClock.version).filter_by(id=1).scalar() or 0
+
+def next_version():
+    """Advance the shared leaderboard clock; the caller commits.
+
+    The clock row stays locked until the caller's commit, so stamps become
+    visible in order and a worker syncing up to version v never misses a
+    change with a lower stamp.
+    """
+    statement = (update(LeaderboardClock).where(LeaderboardClock.id == 1)
+                 .values(version=LeaderboardClock.version + 1)
+                 .returning(LeaderboardClock.version))
+    version = db.session.execute(statement).scalar()
+    if version is None:
+        try:
+            with db.session.begin_nested():
+                db.session.add(LeaderboardClock(id=1, version=1))
+            version = 1
+        except IntegrityError:
+            version = db.session.execute(statement).scalar()
+    return version
+
+class RankedBoard:
+    """One leaderboard table held in rank order in this worker.
+
+    Rows are ranked by score descending, ties by member id. The board
+    applies rows whose version stamp is newer than the last one it saw and
+    reloads the table when it falls too far behind.
+    """
+
+    def __init__(self, model, member_attr, score_attr, serialize):
+        self.model = model
+        self.member_attr = member_attr
+        self.score_attr = score_attr
+        self.serialize = serialize
+        self._lock = threading.RLock()
+        self._ranking = IndexableSkipList()
+        self._keys = {}
+        self._rows = {}
+        self._version = None
+        self._checked_at = 0
+        self._rebuilt_at = 0
+
+    def _key(self, row):
+        return (-(getattr(row, self.score_attr) or 0), getattr(row, self.member_attr))
+
+    def _apply(self, ranking, keys, rows, row):
+        member = getattr(row, self.member_attr)
+        if member is None:
+            return
+        old_key = keys.get(member)
+        new_key = self._key(row)
+        if old_key != new_key:
+            if old_key is not None:
+                ranking.remove(old_key)
+            ranking.insert(new_key)
+            keys[member] = new_key
+        rows[member] = self.serialize(row)
+
+    def rebuild(self):
+        """Reload the whole board from its table"""
+        version = current_version()
+        ranking, keys, rows = IndexableSkipList(), {}, {}
+        for row in self.model.query.yield_per(1000):
+            self._apply(ranking, keys, rows, row)
+        with self._lock:
+            self._ranking, self._keys, self._rows = ranking, keys, rows
+            self._version = version
+            self._rebuilt_at = time.monotonic()
+        logger.info(f"Leaderboard {self.model.__tablename__} rebuilt with {len(rows)} rows at version {version}")
+
+    def sync(self, force=False):
+        """Apply changes stamped since the last sync, at most every LEADERBOARD_SYNC_SECONDS"""
+        now = time.monotonic()
+        if not force and now - self._checked_at < LEADERBOARD_SYNC_SECONDS:
+            return
+        self._checked_at = now
+        if self._version is None or now - self._rebuilt_at > LEADERBOARD_REBUILD_SECONDS:
+            self.rebuild()
+            return
+
+        version = current_version()
+        if version == self._version:
+            return
+        changed = self.model.query.filter(self.model.version > self._version).limit(LEADERBOARD_DELTA_LIMIT + 1).all()
+        if len(changed) > LEADERBOARD_DELTA_LIMIT:
+            self.rebuild()
+            return
+        with self._lock:
+            for row in changed:
+                self._apply(self._ranking, self._keys, self._rows, row)
+            self._version = version
+
+    def mark_stale(self):
+        """Make the next query sync, e.g. after this worker committed a change"""
+        self._checked_at = 0
+
+    def __len__(self):
+        self.sync()
+        return len(self._ranking)
+
+    def _entry(self, position, key):
+        return {"rank": position + 1, **self._rows[key[1]]}
+
+    def top(self, limit=10):
+        self.sync()
+        with self._lock:
+            return [self._entry(position, key) for position, key in enumerate(self._ranking.slice(0, limit))]
+
+    def rank(self, member):
+        """One-based rank of a member, or None when not on the board"""
+        self.sync()
+        with self._lock:
+            key = self._keys.get(member)
+            return None if key is None else self._ranking.index(key) + 1
+
+    def around(self, member, radius=5):
+        """The member with up to radius neighbours above and below"""
+        self.sync()
+        with self._lock:
+            key = self._keys.get(member)
+            if key is None:
+                return []
+            start = max(self._ranking.index(key) - radius, 0)
+            keys = self._ranking.slice(start, start + 2 * radius + 1)
+            return [self._entry(start + offset, key) for offset, key in enumerate(keys)]
+
+def _user_payload(entry):
+    return {
+        "user_id": entry.user_id,
+        "username": entry.username,
+        "xp": entry.xp or 0,
+        "level": entry.level,
+        "badges": list(decode_badges(entry.badge_mask)),
+        "streak": entry.streak
+    }
+
+def _team_payload(team):
+    return {
+        "team_id": team.id,
+        "team_name": team.team_name,
+        "total_xp": team.total_xp or 0,
+        "average_level": team.average_level,
+        "member_count": team.member_count
+    }
+
+user_board = RankedBoard(LeaderboardEntry, 'user_id', 'xp', _user_payload)
+team_board = RankedBoard(TeamLeaderboard, 'id', 'total_xp', _team_payload)
+
+def badge_holders(badge_key, limit=50):
+    """Users holding a badge, highest XP first"""
+    badge = BADGES_BY_KEY[badge_key]
+    # Same predicate text as the partial index so the planner can use it
+    return LeaderboardEntry.query.filter(text(badge_index_condition(badge))).order_by(
+        LeaderboardEntry.xp.desc()
+    ).limit(limit).all()
+
+def migrate_legacy_badges(batch_size=1000):
+    """Bring the schema up to date, then fold legacy badge strings into badge_mask.
+
+    upgrade_schema() adds badge_mask, the version column written here and
+    the badge indexes. Returns (entries converted, unknown badge names).
+    """
+    upgrade_schema()
+
+    converted, unknown = 0, set()
+    last_id = 0
+    while True:
+        rows = db.session.query(LeaderboardEntry.id, LeaderboardEntry.badges, LeaderboardEntry.badge_mask).filter(
+            LeaderboardEntry.id > last_id,
+            LeaderboardEntry.badges.is_not(None),
+            LeaderboardEntry.badges != ''
+        ).order_by(LeaderboardEntry.id).limit(batch_size).all()
+        if not rows:
+            break
+        version = next_version()
+        updates = []
+        for entry_id, badges, badge_mask in rows:
+            mask, names = parse_legacy_badges(badges)
+            unknown.update(names)
+            updates.append(dict(id=entry_id, badge_mask=(badge_mask or 0) | mask, version=version))
+        db.session.execute(update(LeaderboardEntry), updates)
+        db.session.commit()
+        converted += len(rows)
+        last_id = rows[-1][0]
+
+    user_board.mark_stale()
+    return converted, sorted(unknown)
+
+@app.cli.command('migrate-badges')
+@click.option('--batch-size', default=1000, show_default=True)
+def migrate_badges_command(batch_size):
+    """Convert legacy comma-separated badges to badge_mask bits."""
+    converted, unknown = migrate_legacy_badges(batch_size)
+    print(f"Converted badges for {converted} entries")
+    if unknown:
+        print(f"Not in the badge registry (dropped): {', '.join(unknown)}")
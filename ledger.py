@@ -0,0 +1,205 @@
+import os
+import logging
+from datetime import datetime, timedelta
+from itertools import groupby
+import click
+from sqlalchemy import select, insert, update, func, and_
+from sqlalchemy.exc import IntegrityError
+from app import app, db
+from models import PurchaseRequest, CashDemand, ExpenseRecord, ExpenseItem, LedgerEntry, BalanceSnapshot
+from rollups import SPEND_CATEGORIES, UNASSIGNED_DEPARTMENT
+
+logger = logging.getLogger(__name__)
+
+# Snapshots are taken at midnight UTC once this many seconds have passed, so
+# approvals still committing around midnight land before the snapshot is cut
+LEDGER_SETTLE_SECONDS = int(os.environ.get("LEDGER_SETTLE_SECONDS", 900))
+
+# Rows fetched per round trip while verifying
+LEDGER_VERIFY_BATCH = int(os.environ.get("LEDGER_VERIFY_BATCH", 5000))
+
+def post_entry(source_type, source_id, department, account, amount, posted_at=None, entry_type='approval'):
+    """Append a journal entry; runs inside the caller's transaction"""
+    entry = LedgerEntry(source_type=source_type, source_id=source_id,
+                        department=department or UNASSIGNED_DEPARTMENT, account=account,
+                        amount=amount, posted_at=posted_at or datetime.utcnow(), entry_type=entry_type)
+    db.session.add(entry)
+    return entry
+
+def _apply_filters(query, model, department=None, account=None):
+    if department:
+        query = query.filter(model.department == department)
+    if account:
+        query = query.filter(model.account == account)
+    return query
+
+def _latest_snapshot_time(moment):
+    return db.session.query(func.max(BalanceSnapshot.as_of)).filter(BalanceSnapshot.as_of <= moment).scalar()
+
+def _totals_as_of(moment, department=None, account=None):
+    """{(department, account): [balance, entry_count]} from the latest snapshot plus the entries after it"""
+    snapshot_time = _latest_snapshot_time(moment)
+    totals = {}
+
+    if snapshot_time:
+        snapshots = _apply_filters(BalanceSnapshot.query.filter_by(as_of=snapshot_time),
+                                   BalanceSnapshot, department, account)
+        for snapshot in snapshots:
+            totals[(snapshot.department, snapshot.account)] = [snapshot.balance, snapshot.entry_count]
+
+    tail = db.session.query(
+        LedgerEntry.department, LedgerEntry.account, func.sum(LedgerEntry.amount), func.count(LedgerEntry.id)
+    ).filter(LedgerEntry.posted_at < moment)
+    if snapshot_time:
+        tail = tail.filter(LedgerEntry.posted_at >= snapshot_time)
+    tail = _apply_filters(tail, LedgerEntry, department, account)
+    for entry_department, entry_account, amount, count in tail.group_by(LedgerEntry.department, LedgerEntry.account):
+        total = totals.setdefault((entry_department, entry_account), [0.0, 0])
+        total[0] += amount or 0
+        total[1] += count
+    return totals
+
+def balances_as_of(moment, department=None, account=None):
+    """Balances from all entries posted before moment, keyed by (department, account)"""
+    return {key: round(balance, 2) for key, (balance, _) in _totals_as_of(moment, department, account).items()}
+
+def snapshot_cutoff(now=None):
+    """Most recent midnight that is old enough to snapshot"""
+    settled = (now or datetime.utcnow()) - timedelta(seconds=LEDGER_SETTLE_SECONDS)
+    return datetime.combine(settled.date(), datetime.min.time())
+
+def take_snapshots(now=None):
+    """Snapshot every account balance at the latest settled midnight, if not taken yet"""
+    as_of = snapshot_cutoff(now)
+    if db.session.query(BalanceSnapshot.id).filter_by(as_of=as_of).first():
+        return None
+
+    totals = _totals_as_of(as_of)
+    try:
+        if totals:
+            db.session.execute(insert(BalanceSnapshot), [
+                dict(as_of=as_of, department=department, account=account,
+                     balance=round(balance, 2), entry_count=count, created_at=datetime.utcnow())
+                for (department, account), (balance, count) in totals.items()
+            ])
+        db.session.commit()
+    except IntegrityError:
+        # Another node took the same snapshot
+        db.session.rollback()
+        return None
+    logger.info(f"Ledger snapshot at {as_of:%Y-%m-%d} for {len(totals)} accounts")
+    return as_of
+
+def verify_snapshots(repair=False):
+    """Re-derive every snapshot from the journal and report the ones that differ.
+
+    Walks the journal once in posting order alongside the snapshots in
+    as_of order, so the whole history is checked in a single pass.
+    """
+    entries = db.session.execute(
+        select(LedgerEntry.posted_at, LedgerEntry.department, LedgerEntry.account, LedgerEntry.amount)
+        .order_by(LedgerEntry.posted_at, LedgerEntry.id)
+        .execution_options(stream_results=True, yield_per=LEDGER_VERIFY_BATCH)
+    )
+    snapshots = db.session.execute(
+        select(BalanceSnapshot.as_of, BalanceSnapshot.department, BalanceSnapshot.account,
+               BalanceSnapshot.balance, BalanceSnapshot.entry_count)
+        .order_by(BalanceSnapshot.as_of)
+        .execution_options(stream_results=True, yield_per=LEDGER_VERIFY_BATCH)
+    )
+
+    running = {}
+    next_entry = next(entries, None)
+    mismatches = []
+    for as_of, rows in groupby(snapshots, key=lambda row: row.as_of):
+        while next_entry is not None and next_entry.posted_at < as_of:
+            total = running.setdefault((next_entry.department, next_entry.account), [0.0, 0])
+            total[0] += next_entry.amount
+            total[1] += 1
+            next_entry = next(entries, None)
+
+        stored = {(row.department, row.account): row for row in rows}
+        for key in stored.keys() | running.keys():
+            expected_balance, expected_count = running.get(key, (0.0, 0))
+            row = stored.get(key)
+            if row is None or abs(row.balance - expected_balance) > 0.005 or row.entry_count != expected_count:
+                mismatches.append({
+                    'as_of': as_of,
+                    'department': key[0],
+                    'account': key[1],
+                    'stored': row.balance if row else None,
+                    'expected': round(expected_balance, 2),
+                    'entry_count': expected_count
+                })
+    entries.close()
+
+    if repair and mismatches:
+        for mismatch in mismatches:
+            values = dict(balance=mismatch['expected'], entry_count=mismatch['entry_count'])
+            if mismatch['stored'] is None:
+                db.session.add(BalanceSnapshot(as_of=mismatch['as_of'], department=mismatch['department'],
+                                               account=mismatch['account'], **values))
+            else:
+                db.session.execute(update(BalanceSnapshot).where(
+                    BalanceSnapshot.as_of == mismatch['as_of'],
+                    BalanceSnapshot.department == mismatch['department'],
+                    BalanceSnapshot.account == mismatch['account']
+                ).values(**values))
+        db.session.commit()
+    return mismatches
+
+def backfill_ledger():
+    """Post opening entries for approved requests that predate the journal.
+
+    Existing snapshots are dropped because the new entries are back-dated;
+    the next take_snapshots() recomputes them.
+    """
+    expense_totals = select(
+        ExpenseItem.expense_record_id, func.sum(ExpenseItem.amount).label('amount')
+    ).group_by(ExpenseItem.expense_record_id).subquery()
+    sources = {
+        'purchase': (PurchaseRequest, PurchaseRequest.total_amount, None),
+        'demand': (CashDemand, CashDemand.amount, None),
+        'expense': (ExpenseRecord, expense_totals.c.amount, expense_totals)
+    }
+
+    posted = 0
+    for source_type, (model, amount, join) in sources.items():
+        query = select(model.id, model.department, amount,
+                       func.coalesce(model.reviewed_at, model.submitted_at))
+        if join is not None:
+            query = query.join(join, join.c.expense_record_id == model.id)
+        query = query.outerjoin(LedgerEntry, and_(
+            LedgerEntry.source_type == source_type, LedgerEntry.source_id == model.id
+        )).where(model.status == 'Approved', LedgerEntry.id.is_(None))
+
+        rows = [
+            dict(source_type=source_type, source_id=source_id,
+                 department=department or UNASSIGNED_DEPARTMENT, account=SPEND_CATEGORIES[source_type],
+                 amount=value or 0, posted_at=posted_at or datetime.utcnow(), entry_type='opening')
+            for source_id, department, value, posted_at in db.session.execute(query)
+        ]
+        if rows:
+            db.session.execute(insert(LedgerEntry), rows)
+            posted += len(rows)
+
+    if posted:
+        db.session.query(BalanceSnapshot).delete()
+    db.session.commit()
+    logger.info(f"Backfilled {posted} ledger entries")
+    return posted
+
+@app.cli.command('backfill-ledger')
+def backfill_ledger_command():
+    """Post opening ledger entries for approved requests."""
+    print(f"Posted {backfill_ledger()} opening entries")
+
+@app.cli.command('verify-ledger')
+@click.option('--repair', is_flag=True, help='Rewrite snapshots that do not match the journal.')
+def verify_ledger_command(repair):
+    """Re-derive balance snapshots from the ledger journal."""
+    mismatches = verify_snapshots(repair=repair)
+    for mismatch in mismatches:
+        print(f"{mismatch['as_of']:%Y-%m-%d} {mismatch['department']}/{mismatch['account']}: "
+              f"stored {mismatch['stored']}, expected {mismatch['expected']}")
+    print(f"{len(mismatches)} mismatched snapshots" + (" repaired" if repair and mismatches else ""))
@@ -42,6 +42,19 @@ def init_database():
 # Initialize database and import routes
 init_database()
 import routes  # Import routes after app and database setup
+import schema_upgrade  # noqa: F401  (registers 'flask upgrade-schema')
+
+# Pre-render recurring reports, take ledger snapshots, drop stale uploads and
+# collect unreferenced upload blobs during off-hours
+from report_cache import start_report_scheduler
+from ledger import take_snapshots
+from chunked_upload import purge_stale_uploads
+from file_utils import collect_blobs
+scheduler = start_report_scheduler(app)
+if scheduler:
+    for job in (take_snapshots, purge_stale_uploads, collect_blobs):
+        if job not in scheduler.jobs:
+            scheduler.jobs.append(job)
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -1,5 +1,6 @@
 from datetime import datetime
 from app import db
+from badges import BADGES, badge_index_condition
 from werkzeug.security import generate_password_hash, check_password_hash
 
 class User(db.Model):
@@ -26,6 +27,7 @@ class PurchaseRequest(db.Model):
     unit_price = db.Column(db.Float, nullable=False)
     total_amount = db.Column(db.Float, nullable=False)
     supplier = db.Column(db.String(200))
+    department = db.Column(db.String(100))
     justification = db.Column(db.Text, nullable=False)
     urgency = db.Column(db.String(50), default='Normal')
     status = db.Column(db.String(50), default='Pending')
@@ -35,6 +37,8 @@ class PurchaseRequest(db.Model):
     
     user = db.relationship('User', backref=db.backref('purchase_requests', lazy=True))
 
+    __table_args__ = (db.Index('ix_purchase_request_submitted_at_id', 'submitted_at', 'id'),)
+
 class ExpenseRecord(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     expense_id = db.Column(db.String(50), unique=True, nullable=False)
@@ -47,9 +51,11 @@ class ExpenseRecord(db.Model):
     
     user = db.relationship('User', backref=db.backref('expense_records', lazy=True))
 
+    __table_args__ = (db.Index('ix_expense_record_submitted_at_id', 'submitted_at', 'id'),)
+
 class ExpenseItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    expense_record_id = db.Column(db.Integer, db.ForeignKey('expense_record.id'), nullable=False)
+    expense_record_id = db.Column(db.Integer, db.ForeignKey('expense_record.id'), nullable=False, index=True)
     description = db.Column(db.String(500), nullable=False)
     purpose = db.Column(db.String(300), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
@@ -78,6 +84,8 @@ class CashDemand(db.Model):
     
     user = db.relationship('User', backref=db.backref('cash_demands', lazy=True))
 
+    __table_args__ = (db.Index('ix_cash_demand_submitted_at_id', 'submitted_at', 'id'),)
+
 class EmployeeRegistration(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     first_name = db.Column(db.String(100), nullable=False)
@@ -98,19 +106,96 @@ class EmployeeRegistration(db.Model):
     submitted_at = db.Column(db.DateTime, default=datetime.utcnow)
     reviewed_at = db.Column(db.DateTime)
 
+    __table_args__ = (db.Index('ix_employee_registration_submitted_at_id', 'submitted_at', 'id'),)
+
 class AppSettings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     setting_key = db.Column(db.String(100), unique=True, nullable=False)
     setting_value = db.Column(db.Text)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+class CachedReport(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    report_key = db.Column(db.String(50), unique=True, nullable=False)  # e.g. monthly_20250101
+    report_type = db.Column(db.String(20), nullable=False)
+    period_start = db.Column(db.Date, nullable=False)
+    filename = db.Column(db.String(255))
+    pdf_data = db.Column(db.LargeBinary)
+    status = db.Column(db.String(20), default='Pending')  # Pending, Rendering, Ready
+    lease_owner = db.Column(db.String(100))
+    lease_expires_at = db.Column(db.DateTime)
+    generated_at = db.Column(db.DateTime)
 
-# === Leaderboard Models ===
+class JobLease(db.Model):
+    """Which node may run a scheduled job until expires_at"""
+    name = db.Column(db.String(100), primary_key=True)
+    owner = db.Column(db.String(100))
+    expires_at = db.Column(db.DateTime)
 
-from datetime import datetime
-from flask_sqlalchemy import SQLAlchemy
+class Budget(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    department = db.Column(db.String(100), nullable=False)
+    category = db.Column(db.String(50), nullable=False)
+    period_start = db.Column(db.Date, nullable=False)  # First day of the budget month
+    amount = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint('department', 'category', 'period_start', name='uq_budget_period'),)
+
+class BudgetCounter(db.Model):
+    """Running total of submitted (non-rejected) amounts against a monthly budget"""
+    id = db.Column(db.Integer, primary_key=True)
+    department = db.Column(db.String(100), nullable=False)
+    category = db.Column(db.String(50), nullable=False)
+    period_start = db.Column(db.Date, nullable=False)
+    reserved = db.Column(db.Float, nullable=False, default=0)
+    soft_limit = db.Column(db.Float, nullable=False)  # Submissions beyond this are flagged
+    hard_limit = db.Column(db.Float, nullable=False)  # Submissions beyond this are refused
 
-db = SQLAlchemy()
+    __table_args__ = (db.UniqueConstraint('department', 'category', 'period_start', name='uq_budget_counter_period'),)
+
+class SpendRollup(db.Model):
+    """Approved spend per day, department and category, maintained at approval time"""
+    id = db.Column(db.Integer, primary_key=True)
+    bucket_date = db.Column(db.Date, nullable=False)
+    period_start = db.Column(db.Date, nullable=False, index=True)  # First day of the bucket's month
+    department = db.Column(db.String(100), nullable=False)
+    category = db.Column(db.String(50), nullable=False)
+    amount = db.Column(db.Float, nullable=False, default=0)
+    item_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (db.UniqueConstraint('bucket_date', 'department', 'category', name='uq_spend_rollup_bucket'),)
+
+class LedgerEntry(db.Model):
+    """Append-only journal of approved financial movements; rows are never updated"""
+    id = db.Column(db.Integer, primary_key=True)
+    posted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    department = db.Column(db.String(100), nullable=False)
+    account = db.Column(db.String(50), nullable=False)
+    amount = db.Column(db.Float, nullable=False)  # Negative for reversed approvals
+    source_type = db.Column(db.String(20), nullable=False)
+    source_id = db.Column(db.Integer, nullable=False)
+    entry_type = db.Column(db.String(20), nullable=False, default='approval')  # approval, reversal, opening
+
+    __table_args__ = (
+        db.Index('ix_ledger_entry_account_posted', 'department', 'account', 'posted_at'),
+        db.Index('ix_ledger_entry_source', 'source_type', 'source_id'),
+    )
+
+class BalanceSnapshot(db.Model):
+    """Account balance from all ledger entries posted before as_of"""
+    id = db.Column(db.Integer, primary_key=True)
+    as_of = db.Column(db.DateTime, nullable=False, index=True)
+    department = db.Column(db.String(100), nullable=False)
+    account = db.Column(db.String(50), nullable=False)
+    balance = db.Column(db.Float, nullable=False, default=0)
+    entry_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint('as_of', 'department', 'account', name='uq_balance_snapshot'),)
+
+
+# === Leaderboard Models ===
 
 class LeaderboardEntry(db.Model):
     __tablename__ = 'leaderboard_entries'
@@ -119,9 +204,24 @@ class LeaderboardEntry(db.Model):
     username = db.Column(db.String(50))
     xp = db.Column(db.Integer, default=0)
     level = db.Column(db.Integer, default=1)
-    badges = db.Column(db.String(200))  # Comma-separated badge names
+    badges = db.Column(db.String(200))  # Legacy comma-separated names; converted by 'flask migrate-badges'
+    badge_mask = db.Column(db.BigInteger, nullable=False, default=0)  # Bits from badges.BADGES
     streak = db.Column(db.Integer, default=0)
+    last_active_date = db.Column(db.Date)  # Day of the last XP event, for streaks
+    team_id = db.Column(db.Integer, db.ForeignKey('team_leaderboard.id'), index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    version = db.Column(db.BigInteger, default=0, index=True)  # Leaderboard clock value of the last change
+
+    # One entry per user, so concurrent first events cannot create two; and one
+    # partial index per badge (PostgreSQL and SQLite) so "holders of X by XP"
+    # reads only the holders; other databases get a plain XP index
+    __table_args__ = (
+        db.Index('ux_leaderboard_entries_user_id', 'user_id', unique=True),
+        *(db.Index(f'ix_leaderboard_badge_{badge.key}', 'xp',
+                   postgresql_where=db.text(badge_index_condition(badge)),
+                   sqlite_where=db.text(badge_index_condition(badge)))
+          for badge in BADGES),
+    )
 
 class TeamLeaderboard(db.Model):
     __tablename__ = 'team_leaderboard'
@@ -130,10 +230,119 @@ class TeamLeaderboard(db.Model):
     total_xp = db.Column(db.Integer)
     average_level = db.Column(db.Float)
     member_count = db.Column(db.Integer)
+    level_total = db.Column(db.Integer, default=0)  # Sum of member levels, for average_level
     last_updated = db.Column(db.DateTime, default=datetime.utcnow)
+    version = db.Column(db.BigInteger, default=0, index=True)
+
+class XpGrant(db.Model):
+    """XP that is awarded once per source row, e.g. 'approval:purchase:12'"""
+    __tablename__ = 'xp_grants'
+    source_key = db.Column(db.String(100), primary_key=True)
+    user_id = db.Column(db.Integer)
+    granted_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class LeaderboardClock(db.Model):
+    """Single-row counter stamped on every leaderboard change"""
+    __tablename__ = 'leaderboard_clock'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+class SensorReading(db.Model):
+    """One IoT measurement; append-only"""
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    sensor_id = db.Column(db.String(64), nullable=False)
+    zone = db.Column(db.String(50), nullable=False)
+    metric = db.Column(db.String(30), nullable=False)  # temperature, humidity, noise
+    value = db.Column(db.Float, nullable=False)
+    recorded_at = db.Column(db.DateTime, nullable=False)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_sensor_reading_sensor_metric_time', 'sensor_id', 'metric', 'recorded_at'),
+        db.Index('ix_sensor_reading_zone_time', 'zone', 'recorded_at'),
+    )
+
+class SensorLatest(db.Model):
+    """Most recent reading per sensor and metric, upserted on ingest"""
+    sensor_id = db.Column(db.String(64), primary_key=True)
+    metric = db.Column(db.String(30), primary_key=True)
+    zone = db.Column(db.String(50), nullable=False)
+    value = db.Column(db.Float, nullable=False)
+    recorded_at = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class SensorAlertState(db.Model):
+    """alert_engine state for one sensor metric as JSON, shared by every ingesting process"""
+    sensor_id = db.Column(db.String(64), primary_key=True)
+    metric = db.Column(db.String(30), primary_key=True)
+    state = db.Column(db.Text)  # None until the first reading is evaluated
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Notification(db.Model):
+    """Notification center entry; source_key identifies what raised it so it is raised once while open"""
+    id = db.Column(db.Integer, primary_key=True)
+    category = db.Column(db.String(30), nullable=False)  # sensor_alert, ...
+    severity = db.Column(db.String(10), nullable=False, default='info')  # info, warning, critical
+    title = db.Column(db.String(120), nullable=False)
+    message = db.Column(db.Text)
+    source_key = db.Column(db.String(200))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # None for everyone
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    resolved_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ux_notification_open_source', 'source_key', unique=True,
+                 postgresql_where=db.text('resolved_at IS NULL'),
+                 sqlite_where=db.text('resolved_at IS NULL')),
+    )
+
+class StoredBlob(db.Model):
+    """Content-addressed upload in file_utils' blob store, with the number of rows referencing it"""
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size_bytes = db.Column(db.BigInteger, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    released_at = db.Column(db.DateTime, index=True)  # When refcount last dropped; collected after a grace period
+
+class DroneImage(db.Model):
+    """Catalog entry for an image in the drone upload folder; metadata is filled in by the thumbnail job"""
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(255), unique=True, nullable=False)
+    size_bytes = db.Column(db.BigInteger, nullable=False)
+    sha256 = db.Column(db.String(64), index=True)  # None until processed
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    captured_at = db.Column(db.DateTime)  # EXIF DateTimeOriginal, camera local time
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    altitude = db.Column(db.Float)
+    geohash = db.Column(db.String(12))  # Of latitude/longitude; see geo_index
+    camera = db.Column(db.String(120))
+    uploaded_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    uploaded_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime)
+    error = db.Column(db.String(200))  # Why metadata could not be read
+    tiled_at = db.Column(db.DateTime)  # Deep Zoom pack built (large images only)
+
+    __table_args__ = (
+        db.Index('ix_drone_image_uploaded_at_id', 'uploaded_at', 'id'),
+        db.Index('ix_drone_image_captured_at_id', 'captured_at', 'id'),
+        db.Index('ix_drone_image_size_bytes_id', 'size_bytes', 'id'),
+        db.Index('ix_drone_image_geohash', 'geohash'),
+    )
 
 # GPS Timesheet fallback placeholder
 
+class TimesheetEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    project = db.Column(db.String(200), nullable=False)
+    hours = db.Column(db.Float, nullable=False)
+    work_date = db.Column(db.Date, nullable=False)
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    submitted_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 # === GPS-Enabled Fields for Mobile ===
 latitude = db.Column(db.Float)
 longitude = db.Column(db.Float)
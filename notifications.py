@@ -0,0 +1,76 @@
+import os
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import update, or_
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import Notification
+
+logger = logging.getLogger(__name__)
+
+# Resolved notifications stay in the feed this long
+NOTIFICATION_RESOLVED_HOURS = int(os.environ.get("NOTIFICATION_RESOLVED_HOURS", 24))
+
+NOTIFICATION_FEED_LIMIT = int(os.environ.get("NOTIFICATION_FEED_LIMIT", 50))
+
+SEVERITY_ICONS = {'info': 'ℹ️', 'warning': '⚠️', 'critical': '🚨'}
+
+def raise_notification(category, title, message=None, severity='info', source_key=None, user_id=None):
+    """Open a notification in the caller's transaction.
+
+    Returns None when one for the same source_key is still open; the unique
+    partial index makes that hold across workers.
+    """
+    notification = Notification(category=category, severity=severity, title=title, message=message,
+                                source_key=source_key, user_id=user_id, created_at=datetime.utcnow())
+    try:
+        with db.session.begin_nested():
+            db.session.add(notification)
+    except IntegrityError:
+        return None
+    return notification
+
+def resolve_notification(source_key, resolved_at=None):
+    """Mark the open notification for source_key resolved; returns whether there was one"""
+    return bool(db.session.execute(
+        update(Notification)
+        .where(Notification.source_key == source_key, Notification.resolved_at.is_(None))
+        .values(resolved_at=resolved_at or datetime.utcnow())
+    ).rowcount)
+
+def record_sensor_alerts(alerts):
+    """Open or resolve notifications for alert_engine transitions; the caller commits"""
+    for alert in alerts:
+        source_key = f"sensor:{alert.rule}:{alert.sensor_id}"
+        if alert.state == 'fired':
+            notification = raise_notification(
+                'sensor_alert', f"{alert.label} in {alert.zone}",
+                f"{alert.sensor_id} reported {alert.metric} {alert.value:.1f}", alert.severity, source_key
+            )
+            if notification is not None:
+                logger.warning(f"Sensor alert: {alert.label} ({alert.sensor_id}, {alert.zone}, {alert.value:.1f})")
+        else:
+            resolve_notification(source_key)
+
+def notification_feed(user_id=None):
+    """Open and recently resolved notifications for everyone (plus user_id's own), keyed by id"""
+    cutoff = datetime.utcnow() - timedelta(hours=NOTIFICATION_RESOLVED_HOURS)
+    audience = Notification.user_id.is_(None)
+    if user_id:
+        audience = or_(audience, Notification.user_id == user_id)
+    rows = (Notification.query
+            .filter(audience, or_(Notification.resolved_at.is_(None), Notification.resolved_at >= cutoff))
+            .order_by(Notification.created_at.desc())
+            .limit(NOTIFICATION_FEED_LIMIT).all())
+    return {
+        str(row.id): {
+            "category": row.category,
+            "severity": row.severity,
+            "icon": SEVERITY_ICONS.get(row.severity, ''),
+            "title": row.title,
+            "message": row.message,
+            "created_at": row.created_at.isoformat() + 'Z',
+            "resolved_at": row.resolved_at.isoformat() + 'Z' if row.resolved_at else None
+        }
+        for row in rows
+    }
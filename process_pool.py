@@ -0,0 +1,39 @@
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_pid = None
+
+def get_process_pool():
+    """Shared process pool for CPU-bound work (PDF rendering, image processing).
+
+    Created lazily so each gunicorn worker gets its own pool after fork.
+    Jobs submitted here must only take and return plain picklable data.
+    """
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        workers = int(os.environ.get("WORKER_POOL_SIZE", 0)) or os.cpu_count() or 1
+        _pool = ProcessPoolExecutor(max_workers=workers)
+        _pool_pid = os.getpid()
+        logger.info(f"Process pool started with {workers} workers")
+    return _pool
+
+_tiling_pool = None
+_tiling_pool_pid = None
+
+def get_tiling_pool():
+    """Small pool for building tile pyramids, kept apart from the shared pool.
+
+    A pyramid build holds the whole decoded image in memory, so
+    TILING_POOL_SIZE (default 1) bounds how many run at once in this worker.
+    """
+    global _tiling_pool, _tiling_pool_pid
+    if _tiling_pool is None or _tiling_pool_pid != os.getpid():
+        workers = int(os.environ.get("TILING_POOL_SIZE", 1))
+        _tiling_pool = ProcessPoolExecutor(max_workers=workers)
+        _tiling_pool_pid = os.getpid()
+        logger.info(f"Tiling pool started with {workers} workers")
+    return _tiling_pool
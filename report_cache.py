@@ -0,0 +1,231 @@
+import os
+import socket
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import update, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import defer
+from app import db
+from models import CachedReport, JobLease
+from report_generator import ReportGenerator
+
+logger = logging.getLogger(__name__)
+
+REPORT_TYPES = ('daily', 'weekly', 'monthly')
+
+# How long a node may hold a render lease before another node takes over
+REPORT_LEASE_SECONDS = int(os.environ.get("REPORT_LEASE_SECONDS", 900))
+
+# Scheduler settings: pre-render only between these hours (server local time)
+REPORT_PREGEN_HOURS = os.environ.get("REPORT_PREGEN_HOURS", "0-6")
+REPORT_PREGEN_INTERVAL = int(os.environ.get("REPORT_PREGEN_INTERVAL", 300))
+
+NODE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+def period_start_for(report_type, date):
+    """Normalize a date to the start of its report period"""
+    if report_type == 'weekly':
+        return date - timedelta(days=date.weekday())
+    if report_type == 'monthly':
+        return date.replace(day=1)
+    return date
+
+def report_key(report_type, period_start):
+    return f"{report_type}_{period_start.strftime('%Y%m%d')}"
+
+def report_filename(report_type, period_start):
+    if report_type == 'monthly':
+        return f"monthly_report_{period_start.strftime('%Y%m')}.pdf"
+    return f"{report_type}_report_{period_start.strftime('%Y%m%d')}.pdf"
+
+def previous_periods(today=None):
+    """The most recently closed day, week and month"""
+    today = today or datetime.now().date()
+    yesterday = today - timedelta(days=1)
+    last_week = period_start_for('weekly', today) - timedelta(days=7)
+    last_month = period_start_for('monthly', period_start_for('monthly', today) - timedelta(days=1))
+    return [('daily', yesterday), ('weekly', last_week), ('monthly', last_month)]
+
+def render_report(report_type, period_start):
+    """Render a report to PDF bytes.
+
+    The layout runs in the shared process pool: it is CPU-bound and would
+    otherwise freeze every request and event stream on this gevent worker.
+    """
+    return ReportGenerator().render_in_pool(report_type, period_start).result()
+
+def get_cached_report(report_type, period_start):
+    """Get a ready cached report, or None"""
+    return CachedReport.query.filter_by(
+        report_key=report_key(report_type, period_start), status='Ready'
+    ).first()
+
+def list_cached_reports(limit=30):
+    """Ready cached reports, newest period first, without loading the PDFs"""
+    return CachedReport.query.options(defer(CachedReport.pdf_data)).filter_by(
+        status='Ready'
+    ).order_by(CachedReport.period_start.desc(), CachedReport.report_type).limit(limit).all()
+
+def acquire_lease(report_type, period_start):
+    """Try to claim the right to render a report; True if this node holds the lease"""
+    key = report_key(report_type, period_start)
+    now = datetime.utcnow()
+
+    # Make sure the row exists; a concurrent insert from another node is fine
+    if not db.session.query(CachedReport.id).filter_by(report_key=key).first():
+        try:
+            with db.session.begin_nested():
+                db.session.add(CachedReport(report_key=key, report_type=report_type,
+                                            period_start=period_start, status='Pending'))
+        except IntegrityError:
+            pass
+
+    # Single conditional UPDATE: only one node can win an unleased or expired row
+    result = db.session.execute(
+        update(CachedReport)
+        .where(
+            CachedReport.report_key == key,
+            CachedReport.status != 'Ready',
+            or_(CachedReport.lease_expires_at.is_(None), CachedReport.lease_expires_at < now)
+        )
+        .values(status='Rendering', lease_owner=NODE_ID,
+                lease_expires_at=now + timedelta(seconds=REPORT_LEASE_SECONDS))
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+def acquire_job_lease(name, seconds):
+    """Try to claim a scheduled job for the next seconds; True if this node may run it"""
+    now = datetime.utcnow()
+    if not db.session.query(JobLease.name).filter_by(name=name).first():
+        try:
+            with db.session.begin_nested():
+                db.session.add(JobLease(name=name))
+        except IntegrityError:
+            pass
+
+    result = db.session.execute(
+        update(JobLease)
+        .where(JobLease.name == name, or_(JobLease.expires_at.is_(None), JobLease.expires_at < now))
+        .values(owner=NODE_ID, expires_at=now + timedelta(seconds=seconds))
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+def store_report(report_type, period_start, pdf_data):
+    """Publish a rendered report if this node still holds its lease"""
+    result = db.session.execute(
+        update(CachedReport)
+        .where(CachedReport.report_key == report_key(report_type, period_start),
+               CachedReport.lease_owner == NODE_ID)
+        .values(status='Ready', pdf_data=pdf_data,
+                filename=report_filename(report_type, period_start),
+                generated_at=datetime.utcnow(), lease_owner=None, lease_expires_at=None)
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+def release_lease(report_type, period_start):
+    """Give up a lease after a failed render so another node can retry"""
+    db.session.execute(
+        update(CachedReport)
+        .where(CachedReport.report_key == report_key(report_type, period_start),
+               CachedReport.lease_owner == NODE_ID)
+        .values(status='Pending', lease_owner=None, lease_expires_at=None)
+    )
+    db.session.commit()
+
+def invalidate_cached_reports(moment):
+    """Mark cached reports covering a submission time as stale.
+
+    Reports being rendered lose their lease as well, so store_report
+    refuses the render started before the change.
+    """
+    if not moment:
+        return
+    keys = [report_key(report_type, period_start_for(report_type, moment.date()))
+            for report_type in REPORT_TYPES]
+    db.session.execute(
+        update(CachedReport)
+        .where(CachedReport.report_key.in_(keys), CachedReport.status.in_(('Ready', 'Rendering')))
+        .values(status='Pending', pdf_data=None, lease_owner=None, lease_expires_at=None)
+    )
+
+def pregenerate_due_reports(today=None):
+    """Render and cache the previous day's, week's and month's reports if missing"""
+    rendered = []
+    for report_type, period_start in previous_periods(today):
+        if get_cached_report(report_type, period_start):
+            continue
+        if not acquire_lease(report_type, period_start):
+            continue
+        try:
+            started = time.perf_counter()
+            pdf_data = render_report(report_type, period_start)
+            if store_report(report_type, period_start, pdf_data):
+                rendered.append(report_key(report_type, period_start))
+                logger.info(f"Pre-generated {report_key(report_type, period_start)} "
+                            f"in {time.perf_counter() - started:.1f}s")
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Failed to pre-generate {report_key(report_type, period_start)}: {e}")
+            release_lease(report_type, period_start)
+    return rendered
+
+def _in_off_hours(hour):
+    start, end = (int(part) for part in REPORT_PREGEN_HOURS.split('-'))
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end  # window wraps midnight, e.g. 22-5
+
+class ReportScheduler(threading.Thread):
+    """Background thread that pre-renders recurring reports during off-hours.
+
+    Every gunicorn worker may run one; the DB lease ensures each report is
+    rendered by a single node. Other jobs appended to jobs are leased for
+    one interval, so a single worker in the cluster runs each per interval.
+    """
+
+    def __init__(self, app, interval=REPORT_PREGEN_INTERVAL):
+        super().__init__(name='report-scheduler', daemon=True)
+        self.app = app
+        self.interval = interval
+        self.jobs = [pregenerate_due_reports]
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            if _in_off_hours(datetime.now().hour):
+                with self.app.app_context():
+                    for job in self.jobs:
+                        try:
+                            self._run_job(job)
+                        except Exception as e:
+                            logger.error(f"Scheduled job {job.__name__} failed: {e}")
+                        finally:
+                            db.session.remove()
+            self._stop_event.wait(self.interval)
+
+    def _run_job(self, job):
+        # pregenerate_due_reports leases each report itself
+        if job is not pregenerate_due_reports and not acquire_job_lease(job.__name__, self.interval):
+            return
+        job()
+
+    def stop(self):
+        self._stop_event.set()
+
+_scheduler = None
+
+def start_report_scheduler(app):
+    """Start the scheduler once per process unless disabled with REPORT_PREGEN_ENABLED=0"""
+    global _scheduler
+    if os.environ.get("REPORT_PREGEN_ENABLED", "1") == "0":
+        return None
+    if _scheduler is None or not _scheduler.is_alive():
+        _scheduler = ReportScheduler(app)
+        _scheduler.start()
+        logger.info(f"Report scheduler started on {NODE_ID} (hours {REPORT_PREGEN_HOURS})")
+    return _scheduler
@@ -1,198 +1,355 @@
 import os
+import logging
+import zipfile
+from concurrent.futures import as_completed
+from functools import partial
+from itertools import islice
 from datetime import datetime, timedelta
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
 from io import BytesIO
+from sqlalchemy import func, select
 from models import User, PurchaseRequest, CashDemand, EmployeeRegistration, ExpenseRecord, ExpenseItem
+from forms import DEPARTMENT_CHOICES
 from app import db
+from process_pool import get_process_pool
+from report_layout import (report_styles, render_summary_report, render_detail_report, detail_section, stream_rows,
+                           truncate, DETAIL_CHUNK_ROWS)
+
+logger = logging.getLogger(__name__)
 
 class ReportGenerator:
-    def __init__(self):
-        self.styles = getSampleStyleSheet()
-        self.title_style = ParagraphStyle(
-            'CustomTitle',
-            parent=self.styles['Heading1'],
-            fontSize=24,
-            spaceAfter=30,
-            textColor=colors.HexColor('#1A1A1A'),
-            fontName='Helvetica-Bold'
-        )
-        self.heading_style = ParagraphStyle(
-            'CustomHeading',
-            parent=self.styles['Heading2'],
-            fontSize=16,
-            spaceAfter=12,
-            textColor=colors.HexColor('#2D2D2D'),
-            fontName='Helvetica-Bold'
-        )
-        self.normal_style = ParagraphStyle(
-            'CustomNormal',
-            parent=self.styles['Normal'],
-            fontSize=11,
-            spaceAfter=6,
-            textColor=colors.HexColor('#1A1A1A')
-        )
+    def __init__(self, max_rows_per_section=None, chunk_rows=DETAIL_CHUNK_ROWS):
+        # Optional cap on detail rows per section; extra rows are summarized
+        if max_rows_per_section is None and os.environ.get("REPORT_MAX_ROWS_PER_SECTION"):
+            max_rows_per_section = int(os.environ["REPORT_MAX_ROWS_PER_SECTION"])
+        self.max_rows_per_section = max_rows_per_section
+        self.chunk_rows = chunk_rows
+        styles = report_styles()
+        self.title_style = styles['title']
+        self.heading_style = styles['heading']
+        self.normal_style = styles['normal']
 
     def generate_daily_report(self, date=None):
         """Generate daily report for a specific date"""
-        if not date:
-            date = datetime.now().date()
-        
-        # Get data for the specific date
-        start_date = datetime.combine(date, datetime.min.time())
-        end_date = start_date + timedelta(days=1)
-        
-        purchases = PurchaseRequest.query.filter(
-            PurchaseRequest.submitted_at >= start_date,
-            PurchaseRequest.submitted_at < end_date
-        ).all()
-        
-        demands = CashDemand.query.filter(
-            CashDemand.submitted_at >= start_date,
-            CashDemand.submitted_at < end_date
-        ).all()
-        
-        registrations = EmployeeRegistration.query.filter(
-            EmployeeRegistration.submitted_at >= start_date,
-            EmployeeRegistration.submitted_at < end_date
-        ).all()
-        
-        expenses = ExpenseRecord.query.filter(
-            ExpenseRecord.submitted_at >= start_date,
-            ExpenseRecord.submitted_at < end_date
-        ).all()
-        
-        return self._create_report(
-            f"Daily Report - {date.strftime('%B %d, %Y')}",
-            purchases, demands, registrations, expenses
-        )
+        return self._create_report(*_report_period('daily', date or datetime.now().date()))
 
     def generate_weekly_report(self, week_start=None):
         """Generate weekly report"""
         if not week_start:
             today = datetime.now().date()
             week_start = today - timedelta(days=today.weekday())
-        
-        week_end = week_start + timedelta(days=7)
-        
-        start_date = datetime.combine(week_start, datetime.min.time())
-        end_date = datetime.combine(week_end, datetime.min.time())
-        
-        purchases = PurchaseRequest.query.filter(
-            PurchaseRequest.submitted_at >= start_date,
-            PurchaseRequest.submitted_at < end_date
-        ).all()
-        
-        demands = CashDemand.query.filter(
-            CashDemand.submitted_at >= start_date,
-            CashDemand.submitted_at < end_date
-        ).all()
-        
-        registrations = EmployeeRegistration.query.filter(
-            EmployeeRegistration.submitted_at >= start_date,
-            EmployeeRegistration.submitted_at < end_date
-        ).all()
-        
-        expenses = ExpenseRecord.query.filter(
-            ExpenseRecord.submitted_at >= start_date,
-            ExpenseRecord.submitted_at < end_date
-        ).all()
-        
-        return self._create_report(
-            f"Weekly Report - {week_start.strftime('%B %d')} to {(week_end - timedelta(days=1)).strftime('%B %d, %Y')}",
-            purchases, demands, registrations, expenses
-        )
+        return self._create_report(*_report_period('weekly', week_start))
 
     def generate_monthly_report(self, year=None, month=None):
         """Generate monthly report"""
-        if not year:
-            year = datetime.now().year
-        if not month:
-            month = datetime.now().month
-        
-        start_date = datetime(year, month, 1)
-        if month == 12:
-            end_date = datetime(year + 1, 1, 1)
-        else:
-            end_date = datetime(year, month + 1, 1)
+        start_date, _ = _month_bounds(year, month)
+        return self._create_report(*_report_period('monthly', start_date.date()))
+
+    def render_in_pool(self, report_type, period_start):
+        """Render a daily, weekly or monthly report in the shared process pool.
+
+        The data is read here and the PDF is laid out in a worker process, so
+        a long render does not hold the calling gevent worker. Detail rows are
+        fetched up front, cut to max_rows_per_section. Returns a Future of
+        the PDF bytes.
+        """
+        title, start_date, end_date = _report_period(report_type, period_start)
+        summaries = self._department_summaries(start_date, end_date)
+        summary = _merge_summaries(summaries.values(), start_date, end_date)
+        sections = [(section_title, header, _take(rows, self.max_rows_per_section), col_widths, header_color, total)
+                    for section_title, header, rows, col_widths, header_color, total
+                    in self._detail_specs(summary, start_date, end_date)]
+        return get_process_pool().submit(render_detail_report, title, summary, sections, self.chunk_rows)
+
+    def generate_department_bundle(self, year=None, month=None):
+        """Generate one monthly report per department as a streamed ZIP.
+
+        Totals for every department come from a single grouped fetch; the
+        PDFs are rendered in parallel in the shared process pool. Returns the
+        ZIP filename and a generator of ZIP bytes.
+        """
+        start_date, end_date = _month_bounds(year, month)
+        summaries = self._department_summaries(start_date, end_date)
         
-        purchases = PurchaseRequest.query.filter(
-            PurchaseRequest.submitted_at >= start_date,
-            PurchaseRequest.submitted_at < end_date
-        ).all()
+        pool = get_process_pool()
+        futures = {}
+        for department, label in DEPARTMENT_CHOICES:
+            title = f"{label} Monthly Report - {start_date.strftime('%B %Y')}"
+            summary = summaries.get(department) or _merge_summaries([], start_date, end_date)
+            future = pool.submit(render_summary_report, title, summary)
+            futures[future] = f"{department.lower()}_report_{start_date.strftime('%Y%m')}.pdf"
         
-        demands = CashDemand.query.filter(
-            CashDemand.submitted_at >= start_date,
-            CashDemand.submitted_at < end_date
-        ).all()
+        return f"department_reports_{start_date.strftime('%Y%m')}.zip", _stream_zip(futures)
+
+    def _create_report(self, title, start_date, end_date):
+        """Create PDF report with data, streaming detail rows into the document"""
+        summaries = self._department_summaries(start_date, end_date)
+        summary = _merge_summaries(summaries.values(), start_date, end_date)
         
-        registrations = EmployeeRegistration.query.filter(
-            EmployeeRegistration.submitted_at >= start_date,
-            EmployeeRegistration.submitted_at < end_date
-        ).all()
+        return BytesIO(render_summary_report(title, summary, self._detail_sections(summary, start_date, end_date)))
+
+    def _detail_sections(self, summary, start_date, end_date):
+        """Yield detail flowables; rows are only fetched as the PDF is laid out"""
+        section = partial(detail_section, heading_style=self.heading_style, note_style=self.normal_style,
+                          chunk_rows=self.chunk_rows, max_rows=self.max_rows_per_section)
+        for title, header, rows, col_widths, header_color, total in self._detail_specs(summary, start_date, end_date):
+            yield from section(title, header, rows, col_widths, header_color, total_rows=total)
+
+    def _detail_specs(self, summary, start_date, end_date):
+        """Yield (title, header, row stream, column widths, header color, total rows) per detail section"""
+        rows_of = partial(stream_rows, db.session, chunk_rows=self.chunk_rows)
+        # Purchase Requests Details
+        if summary['purchase_count']:
+            rows = rows_of(
+                select(PurchaseRequest.item_name, PurchaseRequest.quantity, PurchaseRequest.unit_price,
+                       PurchaseRequest.total_amount, PurchaseRequest.status, PurchaseRequest.urgency)
+                .where(*_in_period(PurchaseRequest, start_date, end_date))
+                .order_by(PurchaseRequest.submitted_at, PurchaseRequest.id),
+                lambda p: [
+                    truncate(p.item_name, 30),
+                    str(p.quantity),
+                    f"${p.unit_price:.2f}",
+                    f"${p.total_amount:.2f}",
+                    p.status,
+                    p.urgency
+                ]
+            )
+            yield ("Purchase Requests", ['Item', 'Quantity', 'Unit Price', 'Total', 'Status', 'Urgency'],
+                   rows, [2, 0.7, 0.8, 0.8, 0.8, 0.7], '#00D4AA', summary['purchase_count'])
         
-        expenses = ExpenseRecord.query.filter(
-            ExpenseRecord.submitted_at >= start_date,
-            ExpenseRecord.submitted_at < end_date
-        ).all()
+        # Cash Demands Details
+        if summary['demand_count']:
+            rows = rows_of(
+                select(CashDemand.purpose, CashDemand.amount, CashDemand.department,
+                       CashDemand.payment_method, CashDemand.status)
+                .where(*_in_period(CashDemand, start_date, end_date))
+                .order_by(CashDemand.submitted_at, CashDemand.id),
+                lambda d: [
+                    truncate(d.purpose, 35),
+                    f"${d.amount:.2f}",
+                    d.department,
+                    d.payment_method,
+                    d.status
+                ]
+            )
+            yield ("Cash Demands", ['Purpose', 'Amount', 'Department', 'Payment Method', 'Status'],
+                   rows, [2.2, 1, 1.2, 1.2, 0.8], '#FFB347', summary['demand_count'])
         
-        return self._create_report(
-            f"Monthly Report - {start_date.strftime('%B %Y')}",
-            purchases, demands, registrations, expenses
-        )
-
-    def _create_report(self, title, purchases, demands, registrations, expenses):
-        """Create PDF report with data"""
-        buffer = BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=1*inch)
-        story = []
+        # Employee Registrations
+        if summary['registration_count']:
+            rows = rows_of(
+                select(EmployeeRegistration.first_name, EmployeeRegistration.last_name,
+                       EmployeeRegistration.position, EmployeeRegistration.department,
+                       EmployeeRegistration.start_date, EmployeeRegistration.status)
+                .where(*_in_period(EmployeeRegistration, start_date, end_date))
+                .order_by(EmployeeRegistration.submitted_at, EmployeeRegistration.id),
+                lambda r: [
+                    f"{r.first_name} {r.last_name}",
+                    truncate(r.position, 20),
+                    r.department,
+                    r.start_date.strftime('%m/%d/%Y'),
+                    r.status
+                ]
+            )
+            yield ("Employee Registrations", ['Name', 'Position', 'Department', 'Start Date', 'Status'],
+                   rows, [1.5, 1.5, 1.2, 1, 0.8], '#00C851', summary['registration_count'])
         
-        # Title
-        story.append(Paragraph(title, self.title_style))
-        story.append(Paragraph(f"Generated on {datetime.now().strftime('%B %d, %Y at %I:%M %p')}", self.normal_style))
-        story.append(Spacer(1, 20))
+        # Expense Records
+        if summary['expense_count']:
+            rows = rows_of(
+                select(ExpenseRecord.expense_id, ExpenseRecord.department,
+                       func.count(ExpenseItem.id).label('item_count'),
+                       func.coalesce(func.sum(ExpenseItem.amount), 0).label('total_amount'),
+                       ExpenseRecord.status)
+                .outerjoin(ExpenseItem, ExpenseItem.expense_record_id == ExpenseRecord.id)
+                .where(*_in_period(ExpenseRecord, start_date, end_date))
+                .group_by(ExpenseRecord.id)
+                .order_by(ExpenseRecord.submitted_at, ExpenseRecord.id),
+                lambda e: [
+                    e.expense_id,
+                    e.department,
+                    str(e.item_count),
+                    f"${e.total_amount:.2f}",
+                    e.status
+                ]
+            )
+            yield ("Expense Records", ['Expense ID', 'Department', 'Items', 'Total Amount', 'Status'],
+                   rows, [1.5, 1.2, 0.8, 1.2, 0.8], '#FF6B35', summary['expense_count'])
+
+    def _department_summaries(self, start_date, end_date):
+        """Period totals, status counts and daily spend per department, one grouped query per table"""
+        summaries = {}
+        trends = {}
         
-        # Summary Statistics
-        story.append(Paragraph("Executive Summary", self.heading_style))
+        def totals(department):
+            if department not in summaries:
+                summaries[department] = _empty_summary()
+                trends[department] = dict.fromkeys(_period_days(start_date, end_date), 0)
+            return summaries[department]
         
-        total_purchase_amount = sum(p.total_amount for p in purchases if p.status == 'Approved')
-        total_demand_amount = sum(d.amount for d in demands if d.status == 'Approved')
-        total_expense_amount = 0
-        for expense in expenses:
-            if expense.status == 'Approved':
-                total_expense_amount += sum(item.amount for item in expense.expense_items)
+        for prefix, model, department_column, amount_column in (
+                ('purchase', PurchaseRequest, PurchaseRequest.department, PurchaseRequest.total_amount),
+                ('demand', CashDemand, CashDemand.department, CashDemand.amount)):
+            for department, status, count, amount in self._status_totals(
+                    model, department_column, amount_column, start_date, end_date):
+                summary = totals(department)
+                summary[f'{prefix}_count'] += count
+                summary['status_counts'][status] = summary['status_counts'].get(status, 0) + count
+                if status == 'Approved':
+                    summary[f'{prefix}_amount'] = amount
+            for department, day, amount in self._daily_spend(
+                    db.session.query(department_column, func.date(model.submitted_at), func.sum(amount_column)),
+                    model, department_column, start_date, end_date):
+                trends[department][str(day)[:10]] += amount
         
-        summary_data = [
-            ['Metric', 'Count', 'Amount (USD)'],
-            ['Purchase Requests', str(len(purchases)), f"${total_purchase_amount:,.2f}"],
-            ['Cash Demands', str(len(demands)), f"${total_demand_amount:,.2f}"],
-            ['Expense Records', str(len(expenses)), f"${total_expense_amount:,.2f}"],
-            ['Employee Registrations', str(len(registrations)), 'N/A'],
-            ['Total Financial Impact', '-', f"${total_purchase_amount + total_demand_amount + total_expense_amount:,.2f}"]
-        ]
+        expense_counts = db.session.query(ExpenseRecord.department, ExpenseRecord.status, func.count(ExpenseRecord.id)).filter(
+            *_in_period(ExpenseRecord, start_date, end_date)
+        ).group_by(ExpenseRecord.department, ExpenseRecord.status)
+        for department, status, count in expense_counts:
+            summary = totals(department)
+            summary['expense_count'] += count
+            summary['status_counts'][status] = summary['status_counts'].get(status, 0) + count
         
-        summary_table = Table(summary_data, colWidths=[2.5*inch, 1*inch, 1.5*inch])
-        summary_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#2D2D2D')),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 12),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-        ]))
+        expense_spend = db.session.query(
+            ExpenseRecord.department, func.date(ExpenseRecord.submitted_at), func.sum(ExpenseItem.amount)
+        ).join(ExpenseItem, ExpenseItem.expense_record_id == ExpenseRecord.id)
+        for department, day, amount in self._daily_spend(
+                expense_spend, ExpenseRecord, ExpenseRecord.department, start_date, end_date):
+            totals(department)['expense_amount'] += amount
+            trends[department][str(day)[:10]] += amount
         
-        story.append(summary_table)
-        story.append(Spacer(1, 20))
+        registration_counts = db.session.query(EmployeeRegistration.department, func.count(EmployeeRegistration.id)).filter(
+            *_in_period(EmployeeRegistration, start_date, end_date)
+        ).group_by(EmployeeRegistration.department)
+        for department, count in registration_counts:
+            totals(department)['registration_count'] = count
         
-        # Build PDF
-        doc.build(story)
-        buffer.seek(0)
-        return buffer
+        for department, trend in trends.items():
+            summaries[department]['spend_trend'] = [(day[5:], amount) for day, amount in trend.items()]
+        return summaries
+
+    @staticmethod
+    def _status_totals(model, department_column, amount_column, start_date, end_date):
+        """Request count and amount per department and status"""
+        return db.session.query(
+            department_column,
+            model.status,
+            func.count(model.id),
+            func.coalesce(func.sum(amount_column), 0)
+        ).filter(*_in_period(model, start_date, end_date)).group_by(department_column, model.status)
+
+    @staticmethod
+    def _daily_spend(query, model, department_column, start_date, end_date):
+        """Approved amount per department and day for a (department, day, amount) query"""
+        day = func.date(model.submitted_at)
+        return query.filter(
+            model.status == 'Approved',
+            *_in_period(model, start_date, end_date)
+        ).group_by(department_column, day)
+
+def _report_period(report_type, day):
+    """Title and [start, end) datetimes of the daily, weekly or monthly report starting on day"""
+    start_date = datetime.combine(day, datetime.min.time())
+    if report_type == 'daily':
+        return f"Daily Report - {day.strftime('%B %d, %Y')}", start_date, start_date + timedelta(days=1)
+    if report_type == 'weekly':
+        week_end = day + timedelta(days=7)
+        title = f"Weekly Report - {day.strftime('%B %d')} to {(week_end - timedelta(days=1)).strftime('%B %d, %Y')}"
+        return title, start_date, datetime.combine(week_end, datetime.min.time())
+    if report_type == 'monthly':
+        start_date, end_date = _month_bounds(day.year, day.month)
+        return f"Monthly Report - {start_date.strftime('%B %Y')}", start_date, end_date
+    raise ValueError(f"Unknown report type: {report_type}")
+
+def _take(rows, limit):
+    """Up to limit rows of a row stream as a list, releasing the stream"""
+    try:
+        return list(rows if limit is None else islice(rows, limit))
+    finally:
+        rows.close()
+
+def _empty_summary():
+    return {
+        'purchase_count': 0,
+        'purchase_amount': 0,
+        'demand_count': 0,
+        'demand_amount': 0,
+        'expense_count': 0,
+        'expense_amount': 0,
+        'registration_count': 0,
+        'status_counts': {},
+        'spend_trend': []
+    }
+
+def _merge_summaries(summaries, start_date, end_date):
+    """Combine department summaries into company-wide totals"""
+    total = _empty_summary()
+    trend = dict.fromkeys((day[5:] for day in _period_days(start_date, end_date)), 0)
+    for summary in summaries:
+        for key in ('purchase_count', 'purchase_amount', 'demand_count', 'demand_amount',
+                    'expense_count', 'expense_amount', 'registration_count'):
+            total[key] += summary[key]
+        for status, count in summary['status_counts'].items():
+            total['status_counts'][status] = total['status_counts'].get(status, 0) + count
+        for label, amount in summary['spend_trend']:
+            trend[label] += amount
+    total['spend_trend'] = list(trend.items())
+    return total
+
+def _period_days(start_date, end_date):
+    """ISO dates of every day in a period"""
+    return [(start_date + timedelta(days=i)).strftime('%Y-%m-%d') for i in range((end_date - start_date).days)]
+
+def _in_period(model, start_date, end_date):
+    return (model.submitted_at >= start_date, model.submitted_at < end_date)
+
+def _month_bounds(year=None, month=None):
+    if not year:
+        year = datetime.now().year
+    if not month:
+        month = datetime.now().month
+    
+    start_date = datetime(year, month, 1)
+    if month == 12:
+        end_date = datetime(year + 1, 1, 1)
+    else:
+        end_date = datetime(year, month + 1, 1)
+    return start_date, end_date
+
+class _ZipStream:
+    """Write-only file object that hands ZIP bytes to a generator as they are produced"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def _stream_zip(futures):
+    """Yield a ZIP archive, adding each rendered PDF as soon as its job finishes.
+
+    The response is already under way when a render fails, so the failure is
+    written into the archive as <name>.ERROR.txt and the archive is completed.
+    """
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as bundle:
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                bundle.writestr(name, future.result())
+            except Exception as e:
+                logger.error(f"Rendering {name} for the department bundle failed: {e}")
+                bundle.writestr(f"{os.path.splitext(name)[0]}.ERROR.txt", f"{name} could not be generated: {e}\n")
+            yield stream.drain()
+    yield stream.drain()
 
 def create_reports_directory():
     """Create reports directory if it doesn't exist"""
@@ -0,0 +1,276 @@
+# Report layout helpers
+#
+# Pure reportlab building blocks shared by the report generators. This module
+# must not import the Flask app or models so it can be used from benchmarks
+# and worker processes.
+
+from datetime import datetime
+from functools import lru_cache
+from io import BytesIO
+from itertools import chain, islice
+from reportlab.graphics.charts.barcharts import VerticalBarChart
+from reportlab.graphics.charts.piecharts import Pie
+from reportlab.graphics.renderPDF import GraphicsFlowable
+from reportlab.graphics.shapes import Drawing, String
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import inch
+from reportlab.platypus import SimpleDocTemplate, LongTable, Table, TableStyle, Paragraph, Spacer
+
+# Detail rows per LongTable flowable
+DETAIL_CHUNK_ROWS = 250
+
+STATUS_COLORS = {
+    'Pending': '#FFB347',
+    'Approved': '#00C851',
+    'Rejected': '#FF4444'
+}
+
+def report_styles():
+    """Paragraph styles shared by all reports"""
+    styles = getSampleStyleSheet()
+    return {
+        'title': ParagraphStyle(
+            'CustomTitle',
+            parent=styles['Heading1'],
+            fontSize=24,
+            spaceAfter=30,
+            textColor=colors.HexColor('#1A1A1A'),
+            fontName='Helvetica-Bold'
+        ),
+        'heading': ParagraphStyle(
+            'CustomHeading',
+            parent=styles['Heading2'],
+            fontSize=16,
+            spaceAfter=12,
+            textColor=colors.HexColor('#2D2D2D'),
+            fontName='Helvetica-Bold'
+        ),
+        'normal': ParagraphStyle(
+            'CustomNormal',
+            parent=styles['Normal'],
+            fontSize=11,
+            spaceAfter=6,
+            textColor=colors.HexColor('#1A1A1A')
+        )
+    }
+
+class FlowableStream(list):
+    """Story that pulls flowables from an iterator as the document consumes them.
+
+    BaseDocTemplate.build checks len() before handling each flowable, so the
+    buffer is topped up there and only a small window of flowables (and the
+    rows behind them) is ever alive at once.
+    """
+
+    def __init__(self, flowables, lookahead=4):
+        super().__init__()
+        self._source = iter(flowables)
+        self._lookahead = lookahead
+
+    def __len__(self):
+        while self._source is not None and super().__len__() < self._lookahead:
+            try:
+                self.append(next(self._source))
+            except StopIteration:
+                self._source = None
+        return super().__len__()
+
+def detail_table_style(header_color):
+    """Table style used by all detail sections"""
+    return TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor(header_color)),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 0), 10),
+        ('FONTSIZE', (0, 1), (-1, -1), 9),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+        ('GRID', (0, 0), (-1, -1), 1, colors.black),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+    ])
+
+def detail_section(title, header, rows, col_widths, header_color, heading_style, note_style,
+                   chunk_rows=DETAIL_CHUNK_ROWS, max_rows=None, total_rows=None):
+    """Yield the flowables for one detail section from a stream of row tuples.
+
+    Rows are packed into LongTables of at most chunk_rows rows, each repeating
+    the header row across page breaks. When max_rows is set the remaining rows
+    are not read and an overflow note is added instead.
+    """
+    yield Paragraph(title, heading_style)
+
+    style = detail_table_style(header_color)
+    widths = [width * inch for width in col_widths]
+    limited = rows if max_rows is None else islice(rows, max_rows)
+
+    shown = 0
+    chunk = [header]
+    for row in limited:
+        chunk.append(row)
+        if len(chunk) > chunk_rows:
+            shown += len(chunk) - 1
+            yield LongTable(chunk, colWidths=widths, repeatRows=1, style=style)
+            chunk = [header]
+    if len(chunk) > 1:
+        shown += len(chunk) - 1
+        yield LongTable(chunk, colWidths=widths, repeatRows=1, style=style)
+
+    # Release the server-side cursor when the section stopped early
+    close = getattr(rows, 'close', None)
+    if close:
+        close()
+
+    if total_rows is not None and total_rows > shown:
+        yield Paragraph(
+            f"Showing the first {shown:,} of {total_rows:,} rows. "
+            f"{total_rows - shown:,} further rows are not listed.",
+            note_style
+        )
+    yield Spacer(1, 20)
+
+def stream_rows(session, query, format_row, chunk_rows=DETAIL_CHUNK_ROWS):
+    """Yield formatted row lists for detail_section from a server-side cursor"""
+    result = session.execute(query, execution_options={'stream_results': True, 'yield_per': chunk_rows})
+    try:
+        for row in result:
+            yield format_row(row)
+    finally:
+        result.close()
+
+def truncate(text, length):
+    return text[:length] + ('...' if len(text) > length else '')
+
+def summary_table(summary):
+    """Executive summary table from period totals"""
+    total_amount = summary['purchase_amount'] + summary['demand_amount'] + summary['expense_amount']
+    summary_data = [
+        ['Metric', 'Count', 'Amount (USD)'],
+        ['Purchase Requests', str(summary['purchase_count']), f"${summary['purchase_amount']:,.2f}"],
+        ['Cash Demands', str(summary['demand_count']), f"${summary['demand_amount']:,.2f}"],
+        ['Expense Records', str(summary['expense_count']), f"${summary['expense_amount']:,.2f}"],
+        ['Employee Registrations', str(summary['registration_count']), 'N/A'],
+        ['Total Financial Impact', '-', f"${total_amount:,.2f}"]
+    ]
+
+    table = Table(summary_data, colWidths=[2.5*inch, 1*inch, 1.5*inch])
+    table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#2D2D2D')),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 0), 12),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+        ('GRID', (0, 0), (-1, -1), 1, colors.black)
+    ]))
+    return table
+
+def status_chart(status_counts):
+    """Status distribution pie chart as a vector drawing"""
+    counts = tuple(sorted((status, count) for status, count in status_counts.items() if count))
+    return GraphicsFlowable(_status_chart(counts))
+
+def spend_trend_chart(spend_trend):
+    """Approved spend per bucket as a vector bar chart; spend_trend is [(label, amount), ...]"""
+    points = tuple((label, round(float(amount), 2)) for label, amount in spend_trend)
+    return GraphicsFlowable(_spend_trend_chart(points))
+
+# Drawings are cached per data fingerprint, so identical data (the same
+# period re-requested, or departments with the same figures) is only laid
+# out once. Callers get a fresh GraphicsFlowable around the shared drawing
+# because flowables carry per-document layout state.
+@lru_cache(maxsize=256)
+def _status_chart(counts):
+    drawing = Drawing(5*inch, 3*inch)
+    drawing.add(String(2.5*inch, 2.8*inch, 'Request Status Distribution',
+                       fontName='Helvetica-Bold', fontSize=14, textAnchor='middle'))
+
+    pie = Pie()
+    pie.x = 1.6*inch
+    pie.y = 0.2*inch
+    pie.width = pie.height = 2.3*inch
+    pie.data = [count for _, count in counts]
+    pie.labels = [f"{status} ({count})" for status, count in counts]
+    pie.startAngle = 90
+    pie.direction = 'clockwise'
+    pie.slices.strokeColor = colors.white
+    pie.slices.fontName = 'Helvetica'
+    pie.slices.fontSize = 9
+    pie.slices.labelRadius = 1.15
+    for i, (status, _) in enumerate(counts):
+        pie.slices[i].fillColor = colors.HexColor(STATUS_COLORS.get(status, '#9E9E9E'))
+    drawing.add(pie)
+    return drawing
+
+@lru_cache(maxsize=256)
+def _spend_trend_chart(points):
+    drawing = Drawing(5.5*inch, 3*inch)
+    drawing.add(String(2.75*inch, 2.8*inch, 'Approved Spend Trend',
+                       fontName='Helvetica-Bold', fontSize=14, textAnchor='middle'))
+
+    chart = VerticalBarChart()
+    chart.x = 0.7*inch
+    chart.y = 0.5*inch
+    chart.width = 4.6*inch
+    chart.height = 2*inch
+    chart.data = [[amount for _, amount in points]]
+    chart.categoryAxis.categoryNames = [label for label, _ in points]
+    chart.categoryAxis.labels.fontName = 'Helvetica'
+    chart.categoryAxis.labels.fontSize = 7
+    chart.categoryAxis.labels.angle = 45 if len(points) > 8 else 0
+    chart.categoryAxis.labels.boxAnchor = 'ne' if len(points) > 8 else 'n'
+    chart.valueAxis.valueMin = 0
+    chart.valueAxis.labels.fontName = 'Helvetica'
+    chart.valueAxis.labels.fontSize = 8
+    chart.valueAxis.labelTextFormat = lambda value: f"${value:,.0f}"
+    chart.bars[0].fillColor = colors.HexColor('#00D4AA')
+    chart.bars[0].strokeColor = None
+    drawing.add(chart)
+    return drawing
+
+def chart_flowables(summary):
+    """Chart flowables for a summary, skipping charts with no data"""
+    flowables = []
+    if any(summary.get('status_counts', {}).values()):
+        flowables += [status_chart(summary['status_counts']), Spacer(1, 20)]
+    if any(amount for _, amount in summary.get('spend_trend', [])):
+        flowables += [spend_trend_chart(summary['spend_trend']), Spacer(1, 20)]
+    return flowables
+
+def render_detail_report(title, summary, sections, chunk_rows=DETAIL_CHUNK_ROWS):
+    """render_summary_report with detail sections given as plain data, for a worker process.
+
+    sections are (title, header, rows, col_widths, header_color, total_rows)
+    tuples whose rows are lists, already cut to any row cap.
+    """
+    styles = report_styles()
+    details = chain.from_iterable(
+        detail_section(section_title, header, rows, col_widths, header_color, styles['heading'], styles['normal'],
+                       chunk_rows=chunk_rows, total_rows=total_rows)
+        for section_title, header, rows, col_widths, header_color, total_rows in sections
+    )
+    return render_summary_report(title, summary, details)
+
+def render_summary_report(title, summary, details=()):
+    """Render a summary report to PDF bytes, followed by any detail flowables.
+
+    Without details it takes only plain data, so it can run in a worker
+    process. details may be a generator that streams rows from the database;
+    it is only pulled as the document is laid out.
+    """
+    styles = report_styles()
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=1*inch)
+    story = [
+        Paragraph(title, styles['title']),
+        Paragraph(f"Generated on {datetime.now().strftime('%B %d, %Y at %I:%M %p')}", styles['normal']),
+        Spacer(1, 20),
+        Paragraph("Executive Summary", styles['heading']),
+        summary_table(summary),
+        Spacer(1, 20)
+    ]
+    story += chart_flowables(summary)
+    doc.build(FlowableStream(chain(story, details)))
+    return buffer.getvalue()
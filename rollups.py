@@ -0,0 +1,219 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import update, insert, func
+from sqlalchemy.exc import IntegrityError
+from app import app, db
+from models import PurchaseRequest, CashDemand, ExpenseRecord, ExpenseItem, SpendRollup, AppSettings
+
+logger = logging.getLogger(__name__)
+
+# Spend category per approvable request type
+SPEND_CATEGORIES = {
+    'purchase': 'Purchases',
+    'demand': 'Cash Demands',
+    'expense': 'Expenses'
+}
+
+# Department used for requests submitted without one
+UNASSIGNED_DEPARTMENT = 'Unassigned'
+
+def month_start(day):
+    return day.replace(day=1)
+
+def approved_amount(request_type, item):
+    """Spend amount of an approvable request"""
+    if request_type == 'purchase':
+        return item.total_amount or 0
+    if request_type == 'demand':
+        return item.amount or 0
+    if request_type == 'expense':
+        return db.session.query(func.coalesce(func.sum(ExpenseItem.amount), 0)).filter(
+            ExpenseItem.expense_record_id == item.id
+        ).scalar()
+    return 0
+
+def add_to_bucket(bucket_date, department, category, amount, count=1):
+    """Atomically increment a rollup bucket, creating it on first use"""
+    bucket = (
+        SpendRollup.bucket_date == bucket_date,
+        SpendRollup.department == department,
+        SpendRollup.category == category
+    )
+    increment = dict(amount=SpendRollup.amount + amount, item_count=SpendRollup.item_count + count)
+
+    if db.session.execute(update(SpendRollup).where(*bucket).values(**increment)).rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(SpendRollup(bucket_date=bucket_date, period_start=month_start(bucket_date),
+                                       department=department, category=category,
+                                       amount=amount, item_count=count))
+    except IntegrityError:
+        # Another transaction created the bucket first
+        db.session.execute(update(SpendRollup).where(*bucket).values(**increment))
+
+# Time-series granularities over the daily rollup buckets
+GRANULARITIES = ('day', 'week', 'month')
+
+TIMESERIES_MAX_BUCKETS = 400
+
+# Totals of closed buckets, keyed by (granularity, bucket start). Closed
+# buckets never change because rollups are keyed by approval date; only
+# rebuild_rollups() rewrites them, and it bumps the generation stored in
+# AppSettings so every worker drops its copy on its next read.
+ROLLUP_GENERATION_KEY = 'spend_rollup_generation'
+_closed_buckets = {}
+_closed_generation = None
+_closed_lock = threading.Lock()
+
+def rollup_generation():
+    """Number of times the rollups have been rebuilt"""
+    value = db.session.query(AppSettings.setting_value).filter_by(setting_key=ROLLUP_GENERATION_KEY).scalar()
+    return int(value) if value else 0
+
+def _bump_rollup_generation():
+    setting = AppSettings.query.filter_by(setting_key=ROLLUP_GENERATION_KEY).first()
+    if setting is None:
+        setting = AppSettings(setting_key=ROLLUP_GENERATION_KEY)
+        db.session.add(setting)
+    setting.setting_value = str(int(setting.setting_value or 0) + 1)
+
+def bucket_start(day, granularity):
+    if granularity == 'month':
+        return month_start(day)
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    return day
+
+def next_bucket(start, granularity):
+    if granularity == 'month':
+        return (start + timedelta(days=32)).replace(day=1)
+    return start + timedelta(days=7 if granularity == 'week' else 1)
+
+def bucket_label(start, granularity):
+    if granularity == 'month':
+        return start.strftime('%Y-%m')
+    if granularity == 'week':
+        year, week, _ = start.isocalendar()
+        return f"{year}-W{week:02d}"
+    return start.isoformat()
+
+def _spend_by_department(start, end, granularity):
+    """{bucket start: {department: amount}} for approvals in [start, end)"""
+    # Months group on the stored month column; days and weeks fold daily buckets
+    column = SpendRollup.period_start if granularity == 'month' else SpendRollup.bucket_date
+    rows = db.session.query(column, SpendRollup.department, func.sum(SpendRollup.amount)).filter(
+        SpendRollup.bucket_date >= start,
+        SpendRollup.bucket_date < end
+    ).group_by(column, SpendRollup.department)
+
+    buckets = {}
+    for day, department, amount in rows:
+        if isinstance(day, str):
+            day = datetime.strptime(day[:10], '%Y-%m-%d').date()
+        spend = buckets.setdefault(bucket_start(day, granularity), {})
+        spend[department] = spend.get(department, 0) + (amount or 0)
+    return buckets
+
+def spend_timeseries(granularity='month', start=None, end=None, today=None):
+    """Approved spend per bucket and department from start to end (inclusive).
+
+    Closed buckets come from the in-process cache after their first read,
+    for as long as the rollup generation is unchanged; only missing closed
+    buckets and the open bucket hit the database.
+    Returns a list of (bucket start, closed, {department: amount}).
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {', '.join(GRANULARITIES)}")
+    current = bucket_start(today or datetime.utcnow().date(), granularity)
+    end = bucket_start(end, granularity) if end else current
+    start = bucket_start(start, granularity) if start else end
+    if start > end:
+        raise ValueError("start must not be after end")
+
+    starts = [start]
+    while starts[-1] < end:
+        if len(starts) >= TIMESERIES_MAX_BUCKETS:
+            raise ValueError(f"at most {TIMESERIES_MAX_BUCKETS} buckets can be requested")
+        starts.append(next_bucket(starts[-1], granularity))
+
+    global _closed_generation
+    generation = rollup_generation()
+    with _closed_lock:
+        if generation != _closed_generation:
+            _closed_buckets.clear()
+            _closed_generation = generation
+        closed = {bucket: _closed_buckets.get((granularity, bucket)) for bucket in starts if bucket < current}
+
+    missing = [bucket for bucket, spend in closed.items() if spend is None]
+    if missing:
+        loaded = _spend_by_department(missing[0], next_bucket(missing[-1], granularity), granularity)
+        with _closed_lock:
+            for bucket in missing:
+                closed[bucket] = loaded.get(bucket, {})
+                if _closed_generation == generation:
+                    _closed_buckets[(granularity, bucket)] = closed[bucket]
+
+    open_spend = {}
+    if end >= current:
+        open_spend = _spend_by_department(current, next_bucket(current, granularity), granularity).get(current, {})
+
+    return [
+        (bucket, bucket < current,
+         closed[bucket] if bucket < current else open_spend if bucket == current else {})
+        for bucket in starts
+    ]
+
+def rebuild_rollups():
+    """Recompute every rollup bucket from the approved request tables"""
+    day_expr = {
+        'purchase': func.date(PurchaseRequest.reviewed_at),
+        'demand': func.date(CashDemand.reviewed_at),
+        'expense': func.date(ExpenseRecord.reviewed_at)
+    }
+    sources = {
+        'purchase': db.session.query(
+            day_expr['purchase'], PurchaseRequest.department,
+            func.sum(PurchaseRequest.total_amount), func.count(PurchaseRequest.id)
+        ).filter(PurchaseRequest.status == 'Approved').group_by(day_expr['purchase'], PurchaseRequest.department),
+        'demand': db.session.query(
+            day_expr['demand'], CashDemand.department,
+            func.sum(CashDemand.amount), func.count(CashDemand.id)
+        ).filter(CashDemand.status == 'Approved').group_by(day_expr['demand'], CashDemand.department),
+        'expense': db.session.query(
+            day_expr['expense'], ExpenseRecord.department,
+            func.sum(ExpenseItem.amount), func.count(func.distinct(ExpenseRecord.id))
+        ).join(ExpenseItem, ExpenseItem.expense_record_id == ExpenseRecord.id).filter(
+            ExpenseRecord.status == 'Approved'
+        ).group_by(day_expr['expense'], ExpenseRecord.department)
+    }
+
+    buckets = {}
+    for request_type, query in sources.items():
+        for day, department, amount, count in query:
+            if day is None:
+                continue
+            if isinstance(day, str):
+                day = datetime.strptime(day[:10], '%Y-%m-%d').date()
+            key = (day, department or UNASSIGNED_DEPARTMENT, SPEND_CATEGORIES[request_type])
+            total = buckets.setdefault(key, [0, 0])
+            total[0] += amount or 0
+            total[1] += count
+
+    db.session.query(SpendRollup).delete()
+    if buckets:
+        db.session.execute(insert(SpendRollup), [
+            dict(bucket_date=day, period_start=month_start(day), department=department,
+                 category=category, amount=amount, item_count=count)
+            for (day, department, category), (amount, count) in buckets.items()
+        ])
+    _bump_rollup_generation()
+    db.session.commit()
+    logger.info(f"Rebuilt {len(buckets)} spend rollup buckets")
+    return len(buckets)
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recompute spend rollups from approved requests."""
+    print(f"Rebuilt {rebuild_rollups()} rollup buckets")
@@ -1,17 +1,23 @@
 import os
 import json
 from datetime import datetime, timedelta
+from io import BytesIO
 from functools import wraps
-from flask import render_template, request, redirect, url_for, session, flash, jsonify, send_file
+from flask import render_template, request, redirect, url_for, session, flash, jsonify, send_file, Response
 from werkzeug.utils import secure_filename
 from app import app, db
-from models import User, PurchaseRequest, CashDemand, ExpenseRecord, ExpenseItem, EmployeeRegistration, AppSettings
+from models import User, PurchaseRequest, CashDemand, ExpenseRecord, ExpenseItem, EmployeeRegistration, AppSettings, CachedReport
 from forms import LoginForm, PurchaseRequestForm, CashDemandForm, ExpenseRecordForm, EmployeeRegistrationForm, ApprovalForm
 from file_utils import save_file, save_multiple_files, init_upload_folders, get_file_path
 from ai_assistant import AIAssistant
 from sms_service import SMSService
 from api_key_manager import APIKeyManager
 from report_generator import ReportGenerator, create_reports_directory
+from accounting import record_status_change
+from budget_guard import BudgetExceeded, reserve, sync_reservation
+from xp_pipeline import record_event, timesheet_event, approval_key
+from report_cache import (REPORT_TYPES, period_start_for, report_filename, render_report,
+                          get_cached_report, list_cached_reports, invalidate_cached_reports)
 
 # Initialize upload folders and reports directory
 init_upload_folders()
@@ -138,6 +144,7 @@ def purchase_request():
         purchase.unit_price = form.unit_price.data
         purchase.total_amount = total_amount
         purchase.supplier = form.supplier.data
+        purchase.department = form.department.data
         purchase.justification = form.justification.data
         purchase.urgency = form.urgency.data
         
@@ -150,8 +157,18 @@ def purchase_request():
         except Exception:
             pass  # Graceful fallback if AI service unavailable
         
+        try:
+            budget = reserve('purchase', purchase.department, total_amount)
+        except BudgetExceeded as e:
+            db.session.rollback()
+            flash(f'Purchase request exceeds the department budget: {e}', 'error')
+            return render_template('purchase_request.html', form=form)
+        
         db.session.add(purchase)
+        record_event('submission', purchase.user_id, purchase.department)
         db.session.commit()
+        if budget and budget['over_soft_limit']:
+            flash(f'{purchase.department} is now over its monthly purchase budget; this request will be reviewed against it.', 'warning')
         
         # Send SMS notification to admin if configured
         try:
@@ -182,8 +199,18 @@ def cash_demand():
         demand.urgency = form.urgency.data
         demand.payment_method = form.payment_method.data
         
+        try:
+            budget = reserve('demand', demand.department, demand.amount)
+        except BudgetExceeded as e:
+            db.session.rollback()
+            flash(f'Cash demand exceeds the department budget: {e}', 'error')
+            return render_template('cash_demand.html', form=form)
+        
         db.session.add(demand)
+        record_event('submission', demand.user_id, demand.department)
         db.session.commit()
+        if budget and budget['over_soft_limit']:
+            flash(f'{demand.department} is now over its monthly cash budget; this demand will be reviewed against it.', 'warning')
         
         # Send SMS notification to admin if configured
         try:
@@ -231,6 +258,7 @@ def expense_record():
                 
                 db.session.add(item)
         
+        record_event('submission', expense.user_id, expense.department)
         db.session.commit()
         flash('Expense record submitted successfully!', 'success')
         return redirect(url_for('dashboard'))
@@ -362,6 +390,7 @@ def approve_request(type, id):
             item = ExpenseRecord.query.get_or_404(id)
         
         if item:
+            previous_status = item.status
             item.status = form.status.data
             # Ensure admin_notes is always a string
             admin_notes = form.admin_notes.data
@@ -370,6 +399,12 @@ def approve_request(type, id):
             else:
                 item.admin_notes = str(admin_notes) if admin_notes else ''
             item.reviewed_at = datetime.utcnow()
+            invalidate_cached_reports(item.submitted_at)
+            record_status_change(type, item, previous_status)
+            sync_reservation(type, item, previous_status)
+            if item.status == 'Approved' and previous_status != 'Approved':
+                record_event('approval', getattr(item, 'user_id', None), item.department, item.reviewed_at,
+                             approval_key(type, item.id))
             db.session.commit()
             
             # Send SMS notification to user if configured
@@ -418,7 +453,7 @@ def ai_query():
 @app.route('/admin_reports')
 @admin_required
 def admin_reports():
-    return render_template('admin_reports.html')
+    return render_template('admin_reports.html', cached_reports=list_cached_reports())
 
 @app.route('/generate_report', methods=['POST'])
 @admin_required
@@ -426,34 +461,52 @@ def generate_report():
     report_type = request.form.get('report_type')
     date_input = request.form.get('date')
     
+    if report_type not in REPORT_TYPES:
+        flash('Invalid report type selected.', 'error')
+        return redirect(url_for('admin_reports'))
+    
     try:
-        generator = ReportGenerator()
+        date = datetime.strptime(date_input, '%Y-%m-%d').date() if date_input else datetime.now().date()
+        period_start = period_start_for(report_type, date)
         
-        if report_type == 'daily':
-            date = datetime.strptime(date_input, '%Y-%m-%d').date() if date_input else None
-            report_path = generator.generate_daily_report(date)
-        elif report_type == 'weekly':
-            week_start = datetime.strptime(date_input, '%Y-%m-%d').date() if date_input else None
-            report_path = generator.generate_weekly_report(week_start)
-        elif report_type == 'monthly':
-            if date_input:
-                date = datetime.strptime(date_input, '%Y-%m-%d').date()
-                report_path = generator.generate_monthly_report(date.year, date.month)
-            else:
-                report_path = generator.generate_monthly_report()
-        else:
-            flash('Invalid report type selected.', 'error')
-            return redirect(url_for('admin_reports'))
+        # Closed periods are normally pre-rendered by the report scheduler
+        cached = get_cached_report(report_type, period_start)
+        pdf_data = cached.pdf_data if cached else render_report(report_type, period_start)
         
-        if report_path and os.path.exists(report_path):
-            return send_file(report_path, as_attachment=True)
-        else:
-            flash('Error generating report.', 'error')
+        return send_file(BytesIO(pdf_data), as_attachment=True, mimetype='application/pdf',
+                         download_name=report_filename(report_type, period_start))
     except Exception as e:
         flash(f'Error generating report: {str(e)}', 'error')
     
     return redirect(url_for('admin_reports'))
 
+@app.route('/reports/cached/<report_key>')
+@admin_required
+def download_cached_report(report_key):
+    report = CachedReport.query.filter_by(report_key=report_key, status='Ready').first_or_404()
+    return send_file(BytesIO(report.pdf_data), as_attachment=True, mimetype='application/pdf',
+                     download_name=report.filename)
+
+@app.route('/generate_report/departments', methods=['POST'])
+@admin_required
+def generate_department_reports():
+    """Stream a ZIP with one monthly report per department"""
+    date_input = request.form.get('date')
+    
+    try:
+        generator = ReportGenerator()
+        if date_input:
+            date = datetime.strptime(date_input, '%Y-%m-%d').date()
+            filename, bundle = generator.generate_department_bundle(date.year, date.month)
+        else:
+            filename, bundle = generator.generate_department_bundle()
+    except Exception as e:
+        flash(f'Error generating department reports: {str(e)}', 'error')
+        return redirect(url_for('admin_reports'))
+    
+    return Response(bundle, mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('404.html'), 404
@@ -466,8 +519,9 @@ def internal_error(error):
 # === Leaderboard Routes ===
 
 from flask import render_template, jsonify
-from models import LeaderboardEntry, TeamLeaderboard
 from app import app, db
+from leaderboard_engine import user_board, team_board, badge_holders
+from badges import BADGES_BY_KEY
 
 @app.route('/leaderboard')
 def leaderboard_page():
@@ -475,28 +529,37 @@ def leaderboard_page():
 
 @app.route('/api/leaderboard')
 def get_leaderboard_data():
-    # Fetch top individual performers
-    top_users = LeaderboardEntry.query.order_by(LeaderboardEntry.xp.desc()).limit(10).all()
-    top_teams = TeamLeaderboard.query.order_by(TeamLeaderboard.total_xp.desc()).limit(5).all()
-
-    user_data = [{
-        "username": u.username,
-        "xp": u.xp,
-        "level": u.level,
-        "badges": u.badges,
-        "streak": u.streak
-    } for u in top_users]
-
-    team_data = [{
-        "team_name": t.team_name,
-        "total_xp": t.total_xp,
-        "average_level": t.average_level,
-        "member_count": t.member_count
-    } for t in top_teams]
+    return jsonify({
+        "users": user_board.top(10),
+        "teams": team_board.top(5)
+    })
 
+@app.route('/api/leaderboard/rank/<int:user_id>')
+def get_leaderboard_rank(user_id):
+    rank = user_board.rank(user_id)
+    if rank is None:
+        return jsonify({"error": "User is not on the leaderboard"}), 404
+    return jsonify({"user_id": user_id, "rank": rank, "total": len(user_board)})
+
+@app.route('/api/leaderboard/around/<int:user_id>')
+def get_leaderboard_around(user_id):
+    radius = min(max(request.args.get('radius', 5, type=int), 0), 50)
+    neighbours = user_board.around(user_id, radius)
+    if not neighbours:
+        return jsonify({"error": "User is not on the leaderboard"}), 404
+    return jsonify({"user_id": user_id, "users": neighbours, "total": len(user_board)})
+
+
+@app.route('/api/leaderboard/badges/<badge_key>')
+def get_badge_holders(badge_key):
+    if badge_key not in BADGES_BY_KEY:
+        return jsonify({"error": "Unknown badge"}), 404
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    holders = badge_holders(badge_key, limit)
     return jsonify({
-        "users": user_data,
-        "teams": team_data
+        "badge": BADGES_BY_KEY[badge_key].label,
+        "users": [{"user_id": entry.user_id, "username": entry.username, "xp": entry.xp,
+                   "rank": user_board.rank(entry.user_id)} for entry in holders]
     })
 
 
@@ -516,24 +579,143 @@ def export_excel():
     return generate_excel_report()
 
 
+# === Streaming CSV / NDJSON Export Routes ===
+
+from flask import Response, stream_with_context, abort
+from exports import EXPORT_FORMATS, EXPORT_TYPES, parse_export_filters, stream_export
+
+@app.route('/export/<export_type>.<fmt>')
+@admin_required
+def export_stream(export_type, fmt):
+    """Stream a raw extract; resume with after_submitted_at/after_id of the last row received (after_id alone if it had no submitted_at)"""
+    if export_type not in EXPORT_TYPES or fmt not in EXPORT_FORMATS:
+        abort(404)
+    try:
+        filters = parse_export_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    filename = f"{export_type}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+    return Response(
+        stream_with_context(stream_export(export_type, fmt, **filters)),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={
+            'Content-Disposition': f'attachment; filename={filename}',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+
 # === Notification Center Route ===
 
+from notifications import notification_feed
+
 @app.route('/notifications')
 def notifications():
     return render_template('notification_center.html')
 
+@app.route('/api/notifications')
+def notifications_feed():
+    """Open and recently resolved notifications, newest first"""
+    feed = notification_feed(session.get('user_id'))
+    return jsonify({"notifications": [{"id": int(key), **item} for key, item in feed.items()]})
+
 
 # === Accounting Dashboard Routes ===
 
-from accounting import get_accounting_summary
+import hashlib
+from accounting import (get_accounting_summary, get_spend_timeseries, set_budget, parse_period,
+                        parse_series_date, TIMESERIES_CLOSED_MAX_AGE)
+from ledger import balances_as_of
+from budget_guard import remaining_budget
+from rollups import rollup_generation
 
 @app.route('/accounting')
+@admin_required
 def accounting_dashboard():
-    return render_template('accounting_dashboard.html')
+    return render_template('accounting_dashboard.html', rollup_generation=rollup_generation())
 
 @app.route('/api/accounting')
+@admin_required
 def api_accounting_data():
-    return get_accounting_summary()
+    try:
+        return get_accounting_summary(request.args.get('period'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/accounting/timeseries')
+@admin_required
+def api_accounting_timeseries():
+    """Approved spend per month, week or day and department, with conditional GET"""
+    try:
+        payload, closed = get_spend_timeseries(
+            request.args.get('granularity', 'month'),
+            parse_series_date(request.args.get('start')),
+            parse_series_date(request.args.get('end')),
+            request.args.get('department'),
+            int(request.args['points']) if request.args.get('points') else None
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    response = jsonify(payload)
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+    response.cache_control.private = True
+    if closed:
+        # Closed buckets only change on a rollup rebuild, which changes the
+        # dashboard's request URL
+        response.cache_control.max_age = TIMESERIES_CLOSED_MAX_AGE
+    else:
+        # The open bucket may change; revalidate with the ETag every time
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route('/api/accounting/budgets', methods=['POST'])
+@admin_required
+def api_set_budgets():
+    """Set budgets from a JSON list of {department, category, period, amount}"""
+    entries = request.get_json(silent=True)
+    if not isinstance(entries, list):
+        return jsonify({'error': 'Expected a JSON list of budgets'}), 400
+    try:
+        for entry in entries:
+            set_budget(entry['department'], entry['category'],
+                       parse_period(entry.get('period')), float(entry['amount']))
+    except (KeyError, TypeError, ValueError) as e:
+        db.session.rollback()
+        return jsonify({'error': f'Invalid budget entry: {e}'}), 400
+    db.session.commit()
+    return jsonify({'updated': len(entries)})
+
+@app.route('/api/budget/remaining')
+@login_required
+def api_budget_remaining():
+    """Remaining monthly budget for ?department=...&type=purchase|demand"""
+    department = request.args.get('department')
+    if not department:
+        return jsonify({'error': 'department is required'}), 400
+    remaining = remaining_budget(request.args.get('type', 'purchase'), department)
+    if remaining is None:
+        return jsonify({'department': department, 'budgeted': False})
+    return jsonify({'budgeted': True, **remaining})
+
+@app.route('/api/ledger/balances')
+@admin_required
+def api_ledger_balances():
+    """Account balances as of the start of ?as_of=YYYY-MM-DD (default: now)"""
+    as_of = request.args.get('as_of')
+    try:
+        moment = datetime.strptime(as_of, '%Y-%m-%d') if as_of else datetime.utcnow()
+    except ValueError:
+        return jsonify({'error': 'as_of must be in YYYY-MM-DD format'}), 400
+    balances = balances_as_of(moment, request.args.get('department'), request.args.get('account'))
+    return jsonify({
+        'as_of': moment.isoformat(),
+        'balances': [
+            {'department': department, 'account': account, 'balance': balance}
+            for (department, account), balance in sorted(balances.items())
+        ]
+    })
 
 
 # === Mobile + Timesheet Routes ===
@@ -553,18 +735,23 @@ def mobile_timesheet():
     return render_template('timesheet_form.html', form=form)
 
 @app.route('/submit/timesheet', methods=['POST'])
+@login_required
 def submit_timesheet():
     form = TimesheetForm()
     if form.validate_on_submit():
         # Create timesheet entry with GPS data
-        from models import TimesheetEntry  # Placeholder class name
+        from models import TimesheetEntry
         entry = TimesheetEntry(
+            user_id=session['user_id'],
             project=form.project.data,
             hours=form.hours.data,
+            work_date=form.work_date.data,
             latitude=form.latitude.data,
-            longitude=form.longitude.data
+            longitude=form.longitude.data,
+            submitted_at=datetime.utcnow()
         )
         db.session.add(entry)
+        record_event(timesheet_event(entry), entry.user_id)
         db.session.commit()
         flash("Timesheet submitted successfully!", "success")
         return redirect('/mobile')
@@ -608,18 +795,130 @@ def ai_chat():
 
 # === IoT Dashboard Routes ===
 
+from iot_ingest import (IOT_INGEST_KEY, IOT_MAX_BATCH, IOT_METRICS, IOT_SERIES_MAX_POINTS,
+                        IOT_SERIES_SETTLE_SECONDS, ingest_key_valid, ingest_readings, latest_cache,
+                        get_timeseries_store, series_key, parse_timestamp, epoch_ms, from_epoch_ms, series_tiles)
+from downsampling import downsample_store_series
+
 @app.route('/iot')
 def iot_dashboard():
     return render_template('iot_dashboard.html')
 
 @app.route('/api/iot-data')
 def iot_data():
-    data = {
-        "temperature": round(random.uniform(26, 42), 1),
-        "humidity": round(random.uniform(30, 80), 1),
-        "noise": round(random.uniform(50, 95), 1)
-    }
-    return jsonify(data)
+    """Latest averages per metric and zone, served from the in-process cache"""
+    return jsonify(latest_cache.summary())
+
+@app.route('/api/iot/latest')
+def iot_latest():
+    sensors = latest_cache.sensors(request.args.get('zone'))
+    return jsonify({"sensors": [
+        {**sensor, "recorded_at": sensor['recorded_at'].isoformat() + 'Z'}
+        for sensor in sorted(sensors, key=lambda sensor: (sensor['zone'], sensor['sensor_id'], sensor['metric']))
+    ]})
+
+def _series_time(value):
+    try:
+        return parse_timestamp(float(value))
+    except ValueError:
+        return parse_timestamp(value)
+
+@app.route('/api/iot/series/<sensor_id>/<metric>')
+def iot_series(sensor_id, metric):
+    """Readings of one sensor metric from the time-series store.
+
+    ?start and ?end take ISO 8601 or epoch seconds (default: the last hour);
+    ?window=<seconds> returns min/max/avg per window instead of raw points;
+    ?points=<n> downsamples to at most n points for charts (?method=lttb or minmax).
+    """
+    store = get_timeseries_store()
+    if store is None:
+        return jsonify({"error": "Time-series store is not configured"}), 503
+    if metric not in IOT_METRICS:
+        return jsonify({"error": f"Unknown metric: {metric}"}), 404
+    try:
+        end = _series_time(request.args['end']) if request.args.get('end') else datetime.utcnow()
+        start = _series_time(request.args['start']) if request.args.get('start') else end - timedelta(hours=1)
+        window = int(request.args['window']) if request.args.get('window') else None
+        points = int(request.args['points']) if request.args.get('points') else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if start >= end or (window is not None and window <= 0):
+        return jsonify({"error": "start must be before end and window must be positive"}), 400
+    if points is not None and not 4 <= points <= IOT_SERIES_MAX_POINTS:
+        return jsonify({"error": f"points must be between 4 and {IOT_SERIES_MAX_POINTS}"}), 400
+
+    key = series_key(sensor_id, metric)
+    if points:
+        method = request.args.get('method', 'lttb')
+        try:
+            sampled = downsample_store_series(
+                store, key, epoch_ms(start), epoch_ms(end), points, method, cache=series_tiles,
+                settled_before=epoch_ms(datetime.utcnow()) - IOT_SERIES_SETTLE_SECONDS * 1000
+            )
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify({"sensor_id": sensor_id, "metric": metric, "method": method, "points": [
+            [from_epoch_ms(timestamp).isoformat() + 'Z', value] for timestamp, value in sampled
+        ]})
+    if window:
+        windows = store.aggregate(key, epoch_ms(start), epoch_ms(end), window * 1000)
+        return jsonify({"sensor_id": sensor_id, "metric": metric, "window": window, "windows": [
+            {**item, "start": from_epoch_ms(item['start']).isoformat() + 'Z'} for item in windows
+        ]})
+
+    points = store.scan(key, epoch_ms(start), epoch_ms(end))
+    if len(points) > IOT_SERIES_MAX_POINTS:
+        return jsonify({"error": f"More than {IOT_SERIES_MAX_POINTS} points; narrow the range or pass ?window"}), 413
+    return jsonify({"sensor_id": sensor_id, "metric": metric, "points": [
+        [from_epoch_ms(timestamp).isoformat() + 'Z', value] for timestamp, value in points
+    ]})
+
+@app.route('/api/iot/ingest', methods=['POST'])
+def iot_ingest():
+    """Accept a batch of sensor readings: {"readings": [...]} or a bare list"""
+    if not IOT_INGEST_KEY:
+        return jsonify({"error": "IoT ingest is not configured"}), 503
+    if not ingest_key_valid(request.headers.get('X-IoT-Key')):
+        return jsonify({"error": "Invalid ingest key"}), 401
+
+    payload = request.get_json(silent=True)
+    readings = payload.get('readings') if isinstance(payload, dict) else payload
+    if not isinstance(readings, list):
+        return jsonify({"error": "Expected a JSON list of readings"}), 400
+    if len(readings) > IOT_MAX_BATCH:
+        return jsonify({"error": f"At most {IOT_MAX_BATCH} readings per batch"}), 413
+
+    written, errors = ingest_readings(readings)
+    status = 400 if errors and not written else 200
+    return jsonify({"accepted": len(readings) - len(errors), "rows": written,
+                    "rejected": len(errors), "errors": errors[:100]}), status
+
+
+# === Live Stream (Server-Sent Events) Routes ===
+
+from sse_hub import hub
+from accounting import dashboard_metrics
+
+hub.register('iot', latest_cache.summary)
+hub.register('ai', dashboard_metrics)
+hub.register('notifications', notification_feed)
+
+@app.route('/api/stream/iot')
+def stream_iot():
+    """IoT dashboard changes as server-sent events"""
+    return hub.stream('iot', request.headers.get('Last-Event-ID'))
+
+@app.route('/api/stream/notifications')
+def stream_notifications():
+    """Notification center changes (shared notifications) as server-sent events"""
+    return hub.stream('notifications', request.headers.get('Last-Event-ID'))
+
+@app.route('/api/stream/ai')
+@admin_required
+def stream_ai():
+    """AI dashboard metric changes as server-sent events"""
+    return hub.stream('ai', request.headers.get('Last-Event-ID'))
 
 
 # === Drone Upload & Gallery Routes ===
@@ -628,7 +927,15 @@ import os
 from flask import request, redirect, flash
 from werkzeug.utils import secure_filename
 
-UPLOAD_FOLDER = os.path.join(app.static_folder, 'drone_uploads')
+from chunked_upload import (DRONE_CHUNK_SIZE, UploadError, init_upload, upload_status, write_chunk,
+                            complete_upload, completion_status, claim_stored, abort_upload)
+from thumbnails import THUMBNAIL_SIZES, THUMBNAIL_MAX_AGE, rendition_path
+from tile_pyramid import open_pack
+from models import DroneImage
+from drone_catalog import (DRONE_UPLOAD_FOLDER as UPLOAD_FOLDER, DRONE_PAGE_SIZE, DRONE_AREA_MAX_RESULTS, GALLERY_SORTS,
+                           SITE_ZONES, register_upload, gallery_page, images_in_area)
+from geo_index import parse_bbox
+
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 @app.route('/upload/drone', methods=['GET', 'POST'])
@@ -638,14 +945,194 @@ def upload_drone():
         if file:
             filename = secure_filename(file.filename)
             file.save(os.path.join(UPLOAD_FOLDER, filename))
+            register_upload(os.path.join(UPLOAD_FOLDER, filename), session.get('user_id'))
             flash("Image uploaded successfully!", "success")
             return redirect('/gallery/drone')
-    return render_template('drone_upload.html')
+    return render_template('drone_upload.html', chunk_size=DRONE_CHUNK_SIZE)
 
 @app.route('/gallery/drone')
 def drone_gallery():
-    images = os.listdir(UPLOAD_FOLDER)
-    return render_template('drone_gallery.html', images=images)
+    """Catalog page; ?sort, ?q (filename), ?from/?to (capture date), ?gps=1, ?after (next-page cursor)"""
+    sort = request.args.get('sort', 'uploaded')
+    try:
+        captured_from = datetime.fromisoformat(request.args['from']) if request.args.get('from') else None
+        captured_to = datetime.fromisoformat(request.args['to']) + timedelta(days=1) if request.args.get('to') else None
+        images, next_cursor = gallery_page(sort, request.args.get('after'), request.args.get('q'),
+                                           captured_from, captured_to, bool(request.args.get('gps')),
+                                           request.args.get('limit', DRONE_PAGE_SIZE, type=int))
+    except ValueError as e:
+        flash(f"Invalid gallery filter: {e}", "error")
+        sort, images, next_cursor = 'uploaded', *gallery_page()
+    next_url = url_for('drone_gallery', **{**request.args.to_dict(), 'after': next_cursor}) if next_cursor else None
+    return render_template('drone_gallery.html', images=images, next_url=next_url, sort=sort,
+                           sorts=GALLERY_SORTS, sizes=THUMBNAIL_SIZES)
+
+def _is_digest(value):
+    return len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+def _immutable(response):
+    # Thumbnail and tile URLs are content-addressed, so browsers may keep them
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.cache_control.max_age = THUMBNAIL_MAX_AGE
+    return response
+
+@app.route('/drone/thumbnails/<digest>/<size>.webp')
+def drone_thumbnail(digest, size):
+    """WebP rendition of a drone image"""
+    if size not in THUMBNAIL_SIZES or not _is_digest(digest):
+        return jsonify({"error": "Unknown thumbnail"}), 404
+    path = os.path.abspath(rendition_path(digest, size))
+    if not os.path.exists(path):
+        return jsonify({"error": "Unknown thumbnail"}), 404
+    return _immutable(send_file(path, mimetype='image/webp', etag=digest + size))
+
+@app.route('/gallery/drone/<int:image_id>')
+def drone_viewer(image_id):
+    """Deep Zoom viewer for a tiled image; the preview rendition otherwise"""
+    image = DroneImage.query.get_or_404(image_id)
+    if not image.tiled_at:
+        if not image.sha256:
+            return redirect(url_for('drone_gallery'))
+        return redirect(url_for('drone_thumbnail', digest=image.sha256, size='preview'))
+    return render_template('drone_viewer.html', image=image)
+
+@app.route('/drone/tiles/<digest>.dzi')
+def drone_tile_descriptor(digest):
+    pack = open_pack(digest) if _is_digest(digest) else None
+    if pack is None:
+        return jsonify({"error": "Unknown image"}), 404
+    return _immutable(Response(pack.descriptor(), mimetype='application/xml'))
+
+@app.route('/drone/tiles/<digest>_files/<int:level>/<int:column>_<int:row>.jpg')
+def drone_tile(digest, level, column, row):
+    """One Deep Zoom tile, sent from its pack file.
+
+    Under gunicorn, wsgi.file_wrapper hands the pack, positioned at the tile,
+    to sendfile() with Content-Length bounding it to the tile's bytes.
+    """
+    pack = open_pack(digest) if _is_digest(digest) else None
+    tile = pack.open_tile(level, column, row) if pack else None
+    if tile is None:
+        return jsonify({"error": "Unknown tile"}), 404
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        body = file_wrapper(tile, tile.length)
+    else:
+        body = [tile.read()]
+        tile.close()
+    response = Response(body, mimetype='image/jpeg', direct_passthrough=True)
+    response.content_length = tile.length
+    return _immutable(response)
+
+@app.route('/map/drone')
+def drone_map():
+    return render_template('drone_map.html', zones=sorted(SITE_ZONES))
+
+@app.route('/api/drone/zones')
+def api_drone_zones():
+    """Configured site zones as GeoJSON rectangles"""
+    return jsonify({"type": "FeatureCollection", "features": [
+        {"type": "Feature", "properties": {"name": name}, "geometry": {"type": "Polygon", "coordinates": [[
+            [min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat], [min_lon, max_lat], [min_lon, min_lat]
+        ]]}}
+        for name, (min_lon, min_lat, max_lon, max_lat) in sorted(SITE_ZONES.items())
+    ]})
+
+@app.route('/api/drone/images')
+def api_drone_images():
+    """Geotagged drone images as GeoJSON points.
+
+    ?bbox=min_lon,min_lat,max_lon,max_lat or ?zone=<site zone>; ?from and ?to
+    bound the capture time (ISO 8601; a bare ?to date includes that day);
+    ?limit caps the result (the response says when it was truncated).
+    """
+    try:
+        if request.args.get('zone'):
+            if request.args['zone'] not in SITE_ZONES:
+                return jsonify({"error": f"Unknown zone: {request.args['zone']}"}), 404
+            bbox = SITE_ZONES[request.args['zone']]
+        else:
+            bbox = parse_bbox(request.args.get('bbox'))
+        captured_from = datetime.fromisoformat(request.args['from']) if request.args.get('from') else None
+        captured_to = None
+        if request.args.get('to'):
+            captured_to = datetime.fromisoformat(request.args['to'])
+            if len(request.args['to']) == 10:
+                captured_to += timedelta(days=1)
+        limit = min(request.args.get('limit', DRONE_AREA_MAX_RESULTS, type=int), DRONE_AREA_MAX_RESULTS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    images, truncated = images_in_area(bbox, captured_from, captured_to, max(limit, 1))
+    return jsonify({"type": "FeatureCollection", "truncated": truncated, "features": [
+        {"type": "Feature", "id": image.id,
+         "geometry": {"type": "Point", "coordinates": [image.longitude, image.latitude]
+                      + ([image.altitude] if image.altitude is not None else [])},
+         "properties": {
+             "filename": image.filename,
+             "captured_at": image.captured_at.isoformat() if image.captured_at else None,
+             "camera": image.camera,
+             "thumbnail": url_for('drone_thumbnail', digest=image.sha256, size='sm'),
+             "url": url_for('drone_viewer', image_id=image.id)
+         }}
+        for image in images
+    ]})
+
+@app.errorhandler(UploadError)
+def upload_error(e):
+    return jsonify({"error": str(e)}), e.status
+
+@app.route('/api/uploads/drone', methods=['POST'])
+@login_required
+def drone_upload_init():
+    """Open a resumable upload: {"filename", "size", "sha256" and/or "sha256_tree"}"""
+    payload = request.get_json(silent=True) or {}
+    return jsonify(init_upload(payload.get('filename'), payload.get('size'), session['user_id'],
+                               payload.get('sha256'), payload.get('sha256_tree'))), 201
+
+@app.route('/api/uploads/drone/<upload_id>', methods=['GET'])
+@login_required
+def drone_upload_status(upload_id):
+    return jsonify(upload_status(upload_id, session['user_id']))
+
+@app.route('/api/uploads/drone/<upload_id>', methods=['PUT'])
+@login_required
+def drone_upload_chunk(upload_id):
+    """Raw chunk body at ?offset=<bytes>, with its hex SHA-256 in X-Chunk-SHA256"""
+    if request.content_length is None:
+        return jsonify({"error": "Content-Length is required"}), 411
+    return jsonify(write_chunk(upload_id, session['user_id'], request.args.get('offset'), request.stream,
+                               request.content_length, request.headers.get('X-Chunk-SHA256')))
+
+def _completion_response(upload_id, result):
+    if result['state'] == 'verifying':
+        return jsonify(result), 202, {'Location': url_for('drone_upload_completion', upload_id=upload_id),
+                                      'Retry-After': '2'}
+    if result['state'] == 'failed':
+        return jsonify({"error": result['error']}), result['status']
+    path = result['path']
+    if claim_stored(upload_id, session['user_id']):
+        register_upload(path, session['user_id'])
+    return jsonify({"filename": os.path.basename(path), "size": os.path.getsize(path),
+                    "url": url_for('static', filename=f"drone_uploads/{os.path.basename(path)}")})
+
+@app.route('/api/uploads/drone/<upload_id>/complete', methods=['POST'])
+@login_required
+def drone_upload_complete(upload_id):
+    """Store a fully received upload; 202 with a Location to poll while a whole-file digest is checked"""
+    return _completion_response(upload_id, complete_upload(upload_id, session['user_id'], UPLOAD_FOLDER))
+
+@app.route('/api/uploads/drone/<upload_id>/complete', methods=['GET'])
+@login_required
+def drone_upload_completion(upload_id):
+    return _completion_response(upload_id, completion_status(upload_id, session['user_id']))
+
+@app.route('/api/uploads/drone/<upload_id>', methods=['DELETE'])
+@login_required
+def drone_upload_abort(upload_id):
+    abort_upload(upload_id, session['user_id'])
+    return '', 204
 
 
 # === VR/AR Viewer Route ===
@@ -653,3 +1140,58 @@ def drone_gallery():
 @app.route('/vr')
 def vr_viewer():
     return render_template('vr_viewer.html')
+
+
+# === Stored Upload Routes ===
+
+import mimetypes
+from werkzeug.wsgi import wrap_file
+from file_utils import blob_digest, open_file, file_size
+
+def _may_view_upload(user, filename, subfolder):
+    """Admins see every upload; other users only vouchers on their own expense records.
+
+    Content-addressed names ignore the subfolder, so access is decided by the
+    rows that reference the name, never by the path.
+    """
+    if user is None:
+        return False
+    if user.is_admin:
+        return True
+    query = (db.session.query(ExpenseItem.id).join(ExpenseRecord)
+             .filter(ExpenseItem.voucher_filename == filename, ExpenseRecord.user_id == user.id))
+    if not blob_digest(filename):
+        # Legacy vouchers live under the expense_id folder
+        query = query.filter(ExpenseRecord.expense_id == subfolder)
+    return query.first() is not None
+
+@app.route('/uploads/<subfolder>/<filename>')
+@login_required
+def uploaded_file(subfolder, filename):
+    """Serve an uploaded file from the blob store or a legacy folder, honouring a single Range"""
+    if not _may_view_upload(db.session.get(User, session['user_id']), filename, subfolder):
+        abort(404)
+    size = file_size(filename, subfolder)
+    if size is None:
+        abort(404)
+    start, length, status = 0, size, 200
+    if request.range and len(request.range.ranges) == 1:
+        span = request.range.range_for_length(size)
+        if span is None:
+            return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+        start, length, status = span[0], span[1] - span[0], 206
+    try:
+        stream = open_file(filename, subfolder, start, length)
+    except FileNotFoundError:
+        abort(404)
+    # sendfile() under gunicorn for local files; S3 bodies are streamed through
+    response = Response(wrap_file(request.environ, stream, 1024 * 1024), status=status, mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                        direct_passthrough=True)
+    response.content_length = length
+    response.accept_ranges = 'bytes'
+    if status == 206:
+        response.headers['Content-Range'] = f'bytes {start}-{start + length - 1}/{size}'
+    if blob_digest(filename):
+        # Content-addressed, so it never changes
+        response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
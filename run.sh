@@ -1,4 +1,5 @@
 #!/bin/bash
 export FLASK_APP=main.py
 export FLASK_ENV=production
-gunicorn -w 4 -b 0.0.0.0:8000 main:app
\ No newline at end of file
+# Workers, the gevent worker class and the psycopg2 patch are in gunicorn.conf.py
+gunicorn -c gunicorn.conf.py main:app
\ No newline at end of file
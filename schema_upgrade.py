@@ -0,0 +1,110 @@
+# Schema changes for databases created before a column or index was added
+#
+# db.create_all() creates missing tables but never alters existing ones, so
+# columns and indexes added to existing models are listed here and applied
+# by 'flask upgrade-schema'. Every step checks the live schema first, so
+# the command can be run again after each deploy.
+
+import logging
+from sqlalchemy import inspect, text, select, func
+
+from app import app, db
+from models import PurchaseRequest, LeaderboardEntry, TeamLeaderboard
+from badges import BADGES
+
+logger = logging.getLogger(__name__)
+
+# Columns added to existing tables; each is nullable or has a scalar default,
+# so it can be added to a populated table
+ADDED_COLUMNS = (
+    PurchaseRequest.__table__.c.department,
+    LeaderboardEntry.__table__.c.last_active_date,
+    LeaderboardEntry.__table__.c.team_id,
+    TeamLeaderboard.__table__.c.level_total,
+    LeaderboardEntry.__table__.c.version,
+    TeamLeaderboard.__table__.c.version,
+    LeaderboardEntry.__table__.c.badge_mask,
+)
+
+ADDED_INDEXES = (
+    # Keyset indexes behind the streaming exports
+    'ix_purchase_request_submitted_at_id',
+    'ix_expense_record_submitted_at_id',
+    'ix_cash_demand_submitted_at_id',
+    'ix_employee_registration_submitted_at_id',
+    'ix_expense_item_expense_record_id',
+    # Team membership for the team totals
+    'ix_leaderboard_entries_team_id',
+    # Leaderboard delta sync, and one entry per user
+    'ix_leaderboard_entries_version',
+    'ix_team_leaderboard_version',
+    'ux_leaderboard_entries_user_id',
+    # Holders of each badge by XP
+    *(f'ix_leaderboard_badge_{badge.key}' for badge in BADGES),
+)
+
+def _drop_duplicate_entries():
+    """Keep the highest-XP leaderboard entry per user so the unique index can be built"""
+    duplicates = db.session.execute(
+        select(LeaderboardEntry.user_id).where(LeaderboardEntry.user_id.is_not(None))
+        .group_by(LeaderboardEntry.user_id).having(func.count() > 1)
+    ).scalars().all()
+    for user_id in duplicates:
+        keep = (LeaderboardEntry.query.filter_by(user_id=user_id)
+                .order_by(LeaderboardEntry.xp.desc(), LeaderboardEntry.id).first())
+        LeaderboardEntry.query.filter(LeaderboardEntry.user_id == user_id,
+                                      LeaderboardEntry.id != keep.id).delete(synchronize_session=False)
+    db.session.commit()
+    if duplicates:
+        logger.warning(f"Removed duplicate leaderboard entries for {len(duplicates)} users; "
+                       f"run 'flask replay-xp' to recompute XP and team totals")
+
+# Data fixes run before an index is created
+BEFORE_INDEX = {'ux_leaderboard_entries_user_id': _drop_duplicate_entries}
+
+def _indexes():
+    return {index.name: index for table in db.metadata.tables.values() for index in table.indexes}
+
+def _column_ddl(column):
+    """Column definition for ALTER TABLE ... ADD COLUMN"""
+    ddl = f"{column.name} {column.type.compile(dialect=db.engine.dialect)}"
+    for key in column.foreign_keys:
+        ddl += f" REFERENCES {key.column.table.name} ({key.column.name})"
+    if column.default is not None and column.default.is_scalar:
+        ddl += f" DEFAULT {column.default.arg!r}"
+    if not column.nullable:
+        ddl += " NOT NULL"
+    return ddl
+
+def upgrade_schema():
+    """Add the listed columns and indexes where missing; returns the names created"""
+    created = []
+    inspector = inspect(db.engine)
+    for column in ADDED_COLUMNS:
+        existing = {c['name'] for c in inspector.get_columns(column.table.name)}
+        if column.name in existing:
+            continue
+        with db.engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {column.table.name} ADD COLUMN {_column_ddl(column)}"))
+        created.append(f"{column.table.name}.{column.name}")
+
+    indexes = _indexes()
+    for name in ADDED_INDEXES:
+        index = indexes[name]
+        existing = {i['name'] for i in inspect(db.engine).get_indexes(index.table.name)}
+        if name not in existing:
+            if name in BEFORE_INDEX:
+                BEFORE_INDEX[name]()
+            index.create(db.engine)
+            created.append(name)
+    return created
+
+@app.cli.command('upgrade-schema')
+def upgrade_schema_command():
+    """Add columns and indexes that db.create_all() does not add to existing tables."""
+    created = upgrade_schema()
+    if created:
+        for name in created:
+            print(f"Created {name}")
+    else:
+        print("Schema is up to date")
@@ -0,0 +1,189 @@
+import os
+import json
+import queue
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from flask import Response
+from app import app, db
+
+logger = logging.getLogger(__name__)
+
+# How often the worker's poller rebuilds topic snapshots and pushes the changes
+SSE_POLL_SECONDS = float(os.environ.get("SSE_POLL_SECONDS", 2))
+
+# Comment line sent when a stream has been quiet this long, so proxies keep it open
+SSE_HEARTBEAT_SECONDS = float(os.environ.get("SSE_HEARTBEAT_SECONDS", 15))
+
+# Deltas kept per topic for Last-Event-ID resume, and per-client queue depth.
+# A client that falls a full queue behind is disconnected; the browser
+# reconnects and resumes from the ring, or gets a fresh snapshot.
+SSE_HISTORY = int(os.environ.get("SSE_HISTORY", 256))
+SSE_CLIENT_QUEUE = int(os.environ.get("SSE_CLIENT_QUEUE", 64))
+
+# Streams are closed after this long so reconnects spread clients over workers
+SSE_MAX_STREAM_SECONDS = int(os.environ.get("SSE_MAX_STREAM_SECONDS", 1800))
+
+def diff(old, new):
+    """Nested dict of the values in new that differ from old; removed keys map to None"""
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return new
+    changes = {}
+    for key, value in new.items():
+        if key not in old:
+            changes[key] = value
+        elif old[key] != value:
+            changes[key] = diff(old[key], value)
+    for key in old:
+        if key not in new:
+            changes[key] = None
+    return changes
+
+class _Subscriber:
+    __slots__ = ('queue', 'overflowed')
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=SSE_CLIENT_QUEUE)
+        self.overflowed = False
+
+class _Topic:
+    def __init__(self, producer):
+        self.producer = producer
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.snapshot = None
+        self.history = deque(maxlen=SSE_HISTORY)
+        self.subscribers = set()
+
+class EventHub:
+    """Fan-out of topic changes to the SSE clients connected to this worker.
+
+    Each topic has a producer returning its full current state as a dict.
+    The poller calls producers for topics with listeners and publishes the
+    diff, so the cost per interval is one producer call however many
+    dashboards are open. Event ids carry a per-process stream id; a resume
+    id from another worker or an evicted position gets a snapshot instead.
+    """
+
+    def __init__(self):
+        self.stream_id = uuid.uuid4().hex[:8]
+        self._topics = {}
+        self._lock = threading.Lock()
+        self._poller = None
+        self._poller_pid = None
+
+    def register(self, topic, producer):
+        self._topics[topic] = _Topic(producer)
+
+    def _event_id(self, sequence):
+        return f"{self.stream_id}:{sequence}"
+
+    def _publish(self, topic, delta):
+        topic.sequence += 1
+        event = (topic.sequence, 'delta', json.dumps(delta, default=str))
+        topic.history.append(event)
+        for subscriber in list(topic.subscribers):
+            try:
+                subscriber.queue.put_nowait(event)
+            except queue.Full:
+                subscriber.overflowed = True
+                topic.subscribers.discard(subscriber)
+
+    def sync(self, name):
+        """Rebuild a topic's snapshot and publish what changed"""
+        topic = self._topics[name]
+        # The producer runs under the lock too: a slow build overtaken by a
+        # newer one would otherwise publish older state over it
+        with topic.lock:
+            with app.app_context():
+                try:
+                    snapshot = topic.producer()
+                finally:
+                    db.session.remove()
+            if topic.snapshot is not None:
+                delta = diff(topic.snapshot, snapshot)
+                if delta:
+                    self._publish(topic, delta)
+            topic.snapshot = snapshot
+
+    def subscribe(self, name, last_event_id=None):
+        """New subscriber plus the events to send first: the missed deltas, or a snapshot"""
+        topic = self._topics[name]
+        if not topic.subscribers:
+            # Nobody was listening, so the snapshot may be stale
+            self.sync(name)
+        self._ensure_poller()
+
+        subscriber = _Subscriber()
+        with topic.lock:
+            backlog = None
+            stream_id, _, sequence = (last_event_id or '').partition(':')
+            if stream_id == self.stream_id and sequence.isdigit():
+                sequence = int(sequence)
+                oldest = topic.history[0][0] if topic.history else topic.sequence + 1
+                if sequence >= oldest - 1:
+                    backlog = [event for event in topic.history if event[0] > sequence]
+            if backlog is None:
+                backlog = [(topic.sequence, 'snapshot', json.dumps(topic.snapshot, default=str))]
+            topic.subscribers.add(subscriber)
+        return subscriber, backlog
+
+    def unsubscribe(self, name, subscriber):
+        with self._topics[name].lock:
+            self._topics[name].subscribers.discard(subscriber)
+
+    def _ensure_poller(self):
+        with self._lock:
+            if self._poller is not None and self._poller_pid == os.getpid() and self._poller.is_alive():
+                return
+            self._poller = threading.Thread(target=self._poll, name='sse-poller', daemon=True)
+            self._poller_pid = os.getpid()
+            self._poller.start()
+
+    def _poll(self):
+        while True:
+            time.sleep(SSE_POLL_SECONDS)
+            for name, topic in self._topics.items():
+                if not topic.subscribers:
+                    continue
+                try:
+                    self.sync(name)
+                except Exception as e:
+                    logger.error(f"SSE topic {name} failed to refresh: {e}")
+
+    def _format(self, event):
+        sequence, kind, data = event
+        return f"id: {self._event_id(sequence)}\nevent: {kind}\ndata: {data}\n\n"
+
+    def stream(self, name, last_event_id=None):
+        """Streaming text/event-stream response for one topic"""
+        subscriber, backlog = self.subscribe(name, last_event_id)
+
+        def generate():
+            deadline = time.monotonic() + SSE_MAX_STREAM_SECONDS
+            try:
+                yield f"retry: {int(SSE_POLL_SECONDS * 1000)}\n\n"
+                for event in backlog:
+                    yield self._format(event)
+                while time.monotonic() < deadline:
+                    try:
+                        event = subscriber.queue.get(timeout=SSE_HEARTBEAT_SECONDS)
+                    except queue.Empty:
+                        if subscriber.overflowed:
+                            break
+                        yield ": keepalive\n\n"
+                        continue
+                    yield self._format(event)
+                    if subscriber.overflowed and subscriber.queue.empty():
+                        break
+            finally:
+                self.unsubscribe(name, subscriber)
+
+        return Response(generate(), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+
+hub = EventHub()
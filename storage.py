@@ -0,0 +1,370 @@
+# Storage backends for uploaded files
+#
+# A backend keeps byte streams under flat string keys. LocalStorage puts
+# them on disk two shard directories deep, the directories taken from the
+# SHA-256 of the key, so no directory holds more than a few thousand files
+# however many are stored. S3Storage keeps them in an S3-compatible bucket
+# (AWS S3, MinIO, Ceph) and needs boto3. Both read and write as streams,
+# read byte ranges, and can delete on a background thread so a request or
+# a sweep does not wait on the store. Like tile_pyramid, this module must
+# not import the Flask app.
+
+import os
+import re
+import time
+import errno
+import hashlib
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import boto3
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+logger = logging.getLogger(__name__)
+
+# 'local' or 's3'
+UPLOAD_STORAGE = os.environ.get("UPLOAD_STORAGE", "local")
+
+UPLOAD_S3_BUCKET = os.environ.get("UPLOAD_S3_BUCKET")
+UPLOAD_S3_PREFIX = os.environ.get("UPLOAD_S3_PREFIX", "uploads/")
+# Set for MinIO or another S3-compatible server, e.g. http://localhost:9000
+UPLOAD_S3_ENDPOINT_URL = os.environ.get("UPLOAD_S3_ENDPOINT_URL")
+UPLOAD_S3_REGION = os.environ.get("UPLOAD_S3_REGION")
+
+STORAGE_DELETE_WORKERS = int(os.environ.get("STORAGE_DELETE_WORKERS", 4))
+
+_KEY = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*$')
+_SHARD = re.compile(r'^[0-9a-f]{2}$')
+_COPY_BUFFER = 1024 * 1024
+
+_delete_pool = None
+_delete_pool_pid = None
+
+def _deleter():
+    global _delete_pool, _delete_pool_pid
+    if _delete_pool is None or _delete_pool_pid != os.getpid():
+        _delete_pool = ThreadPoolExecutor(max_workers=STORAGE_DELETE_WORKERS, thread_name_prefix='storage-delete')
+        _delete_pool_pid = os.getpid()
+    return _delete_pool
+
+def _check_key(key):
+    if not _KEY.match(key or ''):
+        raise ValueError(f"Invalid storage key {key!r}")
+    return key
+
+class RangeReader:
+    """File object limited to length bytes of an underlying stream.
+
+    fileno() is passed through when the stream is a local file, so
+    wsgi.file_wrapper can sendfile() it.
+    """
+
+    def __init__(self, handle, length):
+        self._handle = handle
+        self.length = self._remaining = length
+
+    def read(self, size=-1):
+        size = self._remaining if size is None or size < 0 else min(size, self._remaining)
+        data = self._handle.read(size) if size else b''
+        self._remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self._handle.fileno()
+
+    def close(self):
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_range(path, start=0, length=None):
+    """RangeReader over a local file; raises FileNotFoundError"""
+    handle = open(path, 'rb')
+    try:
+        size = os.fstat(handle.fileno()).st_size
+        start = min(start, size)
+        handle.seek(start)
+    except BaseException:
+        handle.close()
+        raise
+    return RangeReader(handle, size - start if length is None else min(length, size - start))
+
+class StorageBackend:
+    """Interface of an upload store; keys are flat names such as "<sha256>.pdf"."""
+
+    def write(self, key, stream):
+        """Store a stream under key, replacing any previous content; returns the size"""
+        raise NotImplementedError
+
+    def put_file(self, key, path):
+        """Store a local file under key; the file is consumed (moved or removed)"""
+        with open(path, 'rb') as handle:
+            self.write(key, handle)
+        os.remove(path)
+
+    def open(self, key, start=0, length=None):
+        """RangeReader over length bytes from start (to the end if None); raises FileNotFoundError"""
+        raise NotImplementedError
+
+    def size(self, key):
+        """Size in bytes, or None if nothing is stored under key"""
+        raise NotImplementedError
+
+    def exists(self, key):
+        return self.size(key) is not None
+
+    def rename(self, key, new_key):
+        """Move content to a new key, replacing it; raises FileNotFoundError"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Remove key; a missing key is not an error"""
+        raise NotImplementedError
+
+    def delete_async(self, key):
+        """delete() on a background thread; returns its Future, failures are logged"""
+        future = _deleter().submit(self.delete, key)
+
+        def report(done):
+            if done.exception():
+                logger.error(f"Deleting {key} from upload storage failed: {done.exception()}")
+        future.add_done_callback(report)
+        return future
+
+    def list(self):
+        """Iterate (key, size, modified epoch seconds) over everything stored"""
+        raise NotImplementedError
+
+    def purge_partial(self, max_age):
+        """Drop writes interrupted more than max_age seconds ago"""
+
+    def local_path(self, key):
+        """Path on this machine's filesystem, or None when the content is remote"""
+        return None
+
+class LocalStorage(StorageBackend):
+    """Keys stored as root/<h[:2]>/<h[2:4]>/<key> with h the SHA-256 of the key."""
+
+    def __init__(self, root):
+        self.root = root
+        self.staging = os.path.join(root, 'tmp')
+
+    def path(self, key):
+        shard = hashlib.sha256(_check_key(key).encode()).hexdigest()
+        return os.path.join(self.root, shard[:2], shard[2:4], key)
+
+    def local_path(self, key):
+        return self.path(key)
+
+    def write(self, key, stream):
+        path = self.path(key)
+        os.makedirs(self.staging, exist_ok=True)
+        fd, temporary = tempfile.mkstemp(dir=self.staging)
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as handle:
+                for piece in iter(lambda: stream.read(_COPY_BUFFER), b''):
+                    handle.write(piece)
+                    size += len(piece)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temporary, path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        return size
+
+    def put_file(self, key, path):
+        target = self.path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.replace(path, target)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # Source on another filesystem; copied through staging instead
+            super().put_file(key, path)
+
+    def open(self, key, start=0, length=None):
+        return open_range(self.path(key), start, length)
+
+    def size(self, key):
+        try:
+            return os.path.getsize(self.path(key))
+        except FileNotFoundError:
+            return None
+
+    def rename(self, key, new_key):
+        target = self.path(new_key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(self.path(key), target)
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def list(self):
+        if not os.path.isdir(self.root):
+            return
+        for first in sorted(os.listdir(self.root)):
+            if not _SHARD.match(first) or not os.path.isdir(os.path.join(self.root, first)):
+                continue
+            for second in sorted(os.listdir(os.path.join(self.root, first))):
+                directory = os.path.join(self.root, first, second)
+                if not _SHARD.match(second) or not os.path.isdir(directory):
+                    continue
+                for name in os.listdir(directory):
+                    try:
+                        stat = os.stat(os.path.join(directory, name))
+                    except FileNotFoundError:
+                        continue
+                    yield name, stat.st_size, stat.st_mtime
+
+    def purge_partial(self, max_age):
+        expiry = time.time() - max_age
+        if not os.path.isdir(self.staging):
+            return
+        for name in os.listdir(self.staging):
+            path = os.path.join(self.staging, name)
+            try:
+                if os.path.getmtime(path) < expiry:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+class S3Storage(StorageBackend):
+    """Keys stored as prefix + key in an S3-compatible bucket.
+
+    Credentials come from boto3's usual sources (AWS_ACCESS_KEY_ID and
+    AWS_SECRET_ACCESS_KEY, a profile, or an instance role). The client is
+    created lazily so each gunicorn worker gets its own after fork.
+    """
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None):
+        if boto3 is None:
+            raise RuntimeError("S3 upload storage needs boto3 (pip install boto3)")
+        if not bucket:
+            raise ValueError("S3 upload storage needs a bucket (UPLOAD_S3_BUCKET)")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self._client = None
+        self._client_pid = None
+
+    @property
+    def client(self):
+        if self._client is None or self._client_pid != os.getpid():
+            # Path-style requests work with MinIO and other servers without bucket DNS names
+            config = Config(s3={'addressing_style': 'path'}) if self.endpoint_url else None
+            self._client = boto3.client('s3', endpoint_url=self.endpoint_url, region_name=self.region, config=config)
+            self._client_pid = os.getpid()
+        return self._client
+
+    def _object(self, key):
+        return self.prefix + _check_key(key)
+
+    @staticmethod
+    def _missing(error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def write(self, key, stream):
+        counted = _CountingReader(stream)
+        # upload_fileobj switches to a multipart upload for large streams
+        self.client.upload_fileobj(counted, self.bucket, self._object(key))
+        return counted.size
+
+    def put_file(self, key, path):
+        self.client.upload_file(path, self.bucket, self._object(key))
+        os.remove(path)
+
+    def open(self, key, start=0, length=None):
+        if length == 0:
+            if not self.exists(key):
+                raise FileNotFoundError(key)
+            return RangeReader(_EmptyBody(), 0)
+        request = {'Bucket': self.bucket, 'Key': self._object(key)}
+        if start or length is not None:
+            request['Range'] = f"bytes={start}-{'' if length is None else start + length - 1}"
+        try:
+            response = self.client.get_object(**request)
+        except ClientError as e:
+            if self._missing(e):
+                raise FileNotFoundError(key) from e
+            if e.response.get('Error', {}).get('Code') == 'InvalidRange':
+                # start is at or past the end
+                return RangeReader(_EmptyBody(), 0)
+            raise
+        return RangeReader(response['Body'], response['ContentLength'])
+
+    def size(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._object(key))['ContentLength']
+        except ClientError as e:
+            if self._missing(e):
+                return None
+            raise
+
+    def rename(self, key, new_key):
+        # S3 has no rename; a managed copy (multipart above 5 GB) then a delete
+        try:
+            self.client.copy({'Bucket': self.bucket, 'Key': self._object(key)}, self.bucket, self._object(new_key))
+        except ClientError as e:
+            if self._missing(e):
+                raise FileNotFoundError(key) from e
+            raise
+        self.delete(key)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._object(key))
+
+    def list(self):
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get('Contents', []):
+                key = item['Key'][len(self.prefix):]
+                if _KEY.match(key):
+                    yield key, item['Size'], item['LastModified'].timestamp()
+
+    def purge_partial(self, max_age):
+        expiry = time.time() - max_age
+        paginator = self.client.get_paginator('list_multipart_uploads')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for upload in page.get('Uploads', []):
+                if upload['Initiated'].timestamp() < expiry:
+                    self.client.abort_multipart_upload(Bucket=self.bucket, Key=upload['Key'], UploadId=upload['UploadId'])
+
+class _CountingReader:
+    def __init__(self, stream):
+        self._stream = stream
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self.size += len(data)
+        return data
+
+class _EmptyBody:
+    def read(self, size=-1):
+        return b''
+
+    def close(self):
+        pass
+
+def storage_from_env(local_root):
+    """Backend selected by UPLOAD_STORAGE; local storage lives under local_root"""
+    if UPLOAD_STORAGE == 's3':
+        return S3Storage(UPLOAD_S3_BUCKET, UPLOAD_S3_PREFIX, UPLOAD_S3_ENDPOINT_URL, UPLOAD_S3_REGION)
+    if UPLOAD_STORAGE != 'local':
+        raise ValueError(f"UPLOAD_STORAGE must be 'local' or 's3', not {UPLOAD_STORAGE!r}")
+    return LocalStorage(local_root)
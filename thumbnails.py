@@ -0,0 +1,105 @@
+# Drone image thumbnails
+#
+# Uploaded images are hashed and rendered to WebP at a few widths in the
+# shared process pool. Renditions are stored under the SHA-256 of the
+# source, so a re-uploaded image costs nothing and a rendition URL never
+# changes content, which lets browsers cache it for a year. The same pass
+# reads the EXIF metadata that drone_catalog stores. This module must not
+# import the Flask app; its functions run in pool workers.
+
+import os
+import hashlib
+from datetime import datetime
+
+DRONE_THUMBNAIL_DIR = os.environ.get("DRONE_THUMBNAIL_DIR", os.path.join('uploads', 'drone_thumbnails'))
+
+# Rendition name -> longest edge in pixels
+THUMBNAIL_SIZES = {'sm': 160, 'md': 320, 'lg': 640, 'preview': 1600}
+
+THUMBNAIL_QUALITY = int(os.environ.get("THUMBNAIL_QUALITY", 80))
+
+# Orthomosaics routinely exceed Pillow's decompression-bomb default
+DRONE_MAX_IMAGE_PIXELS = int(os.environ.get("DRONE_MAX_IMAGE_PIXELS", 1_000_000_000))
+
+THUMBNAIL_MAX_AGE = 365 * 24 * 3600
+
+_HASH_BUFFER = 1024 * 1024
+
+# EXIF tags and sub-IFDs
+_ORIENTATION, _MAKE, _MODEL, _DATETIME = 0x0112, 0x010F, 0x0110, 0x0132
+_EXIF_IFD, _GPS_IFD, _DATETIME_ORIGINAL = 0x8769, 0x8825, 0x9003
+
+def rendition_path(digest, size, directory=None):
+    return os.path.join(directory or DRONE_THUMBNAIL_DIR, digest[:2], f"{digest}-{size}.webp")
+
+def file_digest(path):
+    """Hex SHA-256 of a file, read in 1 MB pieces"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for piece in iter(lambda: handle.read(_HASH_BUFFER), b''):
+            digest.update(piece)
+    return digest.hexdigest()
+
+def _degrees(value, reference):
+    try:
+        degrees = float(value[0]) + float(value[1]) / 60 + float(value[2]) / 3600
+    except (TypeError, ValueError, IndexError, ZeroDivisionError):
+        return None
+    return -degrees if reference in ('S', 'W') else degrees
+
+def read_exif(exif):
+    """Capture time, GPS position and camera from a Pillow Exif object"""
+    metadata = {}
+    taken = exif.get_ifd(_EXIF_IFD).get(_DATETIME_ORIGINAL) or exif.get(_DATETIME)
+    try:
+        metadata['captured_at'] = datetime.strptime(str(taken).strip('\x00 '), '%Y:%m:%d %H:%M:%S')
+    except ValueError:
+        pass
+    gps = exif.get_ifd(_GPS_IFD)
+    if gps:
+        metadata['latitude'] = _degrees(gps.get(2), gps.get(1))
+        metadata['longitude'] = _degrees(gps.get(4), gps.get(3))
+        try:
+            metadata['altitude'] = float(gps[6]) * (-1 if gps.get(5) == 1 else 1)
+        except (KeyError, TypeError, ValueError, ZeroDivisionError):
+            pass
+    camera = ' '.join(str(exif.get(tag, '')).strip('\x00 ') for tag in (_MAKE, _MODEL)).strip()
+    if camera:
+        metadata['camera'] = camera[:120]
+    return metadata
+
+def render_thumbnails(source_path, thumbnail_dir=None):
+    """Hash an image, read its metadata and write its missing renditions; runs in the process pool.
+
+    Returns a dict of sha256, size_bytes, width, height and whatever of
+    captured_at, latitude, longitude, altitude and camera the EXIF data has.
+    """
+    from PIL import Image, ImageOps
+
+    Image.MAX_IMAGE_PIXELS = DRONE_MAX_IMAGE_PIXELS
+    digest = file_digest(source_path)
+    with Image.open(source_path) as image:
+        width, height = image.size
+        exif = image.getexif()
+        if exif.get(_ORIENTATION) in (5, 6, 7, 8):
+            # Rotated a quarter turn by its EXIF orientation
+            width, height = height, width
+        metadata = {"sha256": digest, "size_bytes": os.path.getsize(source_path),
+                    "width": width, "height": height, **read_exif(exif)}
+        if all(os.path.exists(rendition_path(digest, size, thumbnail_dir)) for size in THUMBNAIL_SIZES):
+            return metadata
+        largest = max(THUMBNAIL_SIZES.values())
+        # JPEG can decode straight to a reduced scale, skipping most of the IDCT work
+        image.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+        os.makedirs(os.path.dirname(rendition_path(digest, 'sm', thumbnail_dir)), exist_ok=True)
+        # Largest first, each rendition downscaled from the previous one
+        for size, edge in sorted(THUMBNAIL_SIZES.items(), key=lambda item: -item[1]):
+            image.thumbnail((edge, edge), Image.Resampling.LANCZOS)
+            path = rendition_path(digest, size, thumbnail_dir)
+            image.save(f"{path}.{os.getpid()}.tmp", 'WEBP', quality=THUMBNAIL_QUALITY, method=4)
+            os.replace(f"{path}.{os.getpid()}.tmp", path)
+    return metadata
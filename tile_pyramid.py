@@ -0,0 +1,206 @@
+# Deep Zoom tile pyramids
+#
+# Large orthophotos are cut into a Deep Zoom pyramid (the layout
+# OpenSeadragon reads): level n is the image scaled to fit 2^n pixels, down
+# to a single pixel at level 0, each level split into TILE_SIZE tiles with
+# TILE_OVERLAP pixels shared with their neighbours. All tiles of an image
+# go into one pack file instead of tens of thousands of small files:
+#
+#   b'DZP1' | tile bytes ... | index | metadata JSON | footer
+#
+# The index is one (offset uint64, length uint32) entry per tile, ordered
+# by level, row, column, so a tile is found by arithmetic alone; the footer
+# holds the index offset, tile count and metadata length. Packs are named
+# by the source's SHA-256 and never change once written. Like thumbnails,
+# this module must not import the Flask app.
+
+import io
+import os
+import json
+import math
+import struct
+import threading
+from collections import OrderedDict
+
+DRONE_TILE_DIR = os.environ.get("DRONE_TILE_DIR", os.path.join('uploads', 'drone_tiles'))
+
+# Images with a longer edge than this get a pyramid
+DRONE_TILE_MIN_EDGE = int(os.environ.get("DRONE_TILE_MIN_EDGE", 4096))
+
+# Largest image that gets a pyramid. The build decodes the whole image
+# (3 bytes a pixel) plus a quarter-size copy, so this bounds its memory;
+# larger images keep the preview rendition only
+DRONE_TILE_MAX_PIXELS = int(os.environ.get("DRONE_TILE_MAX_PIXELS", 200_000_000))
+
+TILE_SIZE = 254
+TILE_OVERLAP = 1
+TILE_FORMAT = 'jpg'
+TILE_QUALITY = int(os.environ.get("TILE_QUALITY", 85))
+
+_MAGIC = b'DZP1'
+_ENTRY = struct.Struct('<QI')
+_FOOTER = struct.Struct('<QII4s')  # index offset, tile count, metadata length, magic
+
+def pack_path(digest, directory=None):
+    return os.path.join(directory or DRONE_TILE_DIR, digest[:2], f"{digest}.dzp")
+
+def level_sizes(width, height):
+    """(width, height) of every level, from 1x1 at level 0 up to full size"""
+    levels = int(math.ceil(math.log2(max(width, height)))) + 1 if max(width, height) > 1 else 1
+    return [(max(1, math.ceil(width / 2 ** (levels - 1 - level))),
+             max(1, math.ceil(height / 2 ** (levels - 1 - level)))) for level in range(levels)]
+
+def _grid(size):
+    return math.ceil(size[0] / TILE_SIZE), math.ceil(size[1] / TILE_SIZE)
+
+def build_pyramid(source_path, digest, directory=None):
+    """Write the tile pack for an image unless it exists; runs in the tiling pool.
+
+    The full-resolution level is cut first and each smaller level is a 2x
+    box reduction of the one above, so the image is decoded once. Returns
+    the number of tiles.
+    """
+    from PIL import Image
+
+    path = pack_path(digest, directory)
+    if os.path.exists(path):
+        return TilePack(path).tile_count
+    Image.MAX_IMAGE_PIXELS = DRONE_TILE_MAX_PIXELS
+    image = Image.open(source_path)
+    # Pillow only refuses images over twice MAX_IMAGE_PIXELS, so check before decoding
+    if image.size[0] * image.size[1] > DRONE_TILE_MAX_PIXELS:
+        raise ValueError(f"{image.size[0]}x{image.size[1]} is over {DRONE_TILE_MAX_PIXELS} pixels")
+    image.load()
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    sizes = level_sizes(*image.size)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    # Tiles are written as they are cut, top level first; only the index
+    # has to be in level order
+    entries = [None] * len(sizes)
+    with open(temporary, 'wb') as handle:
+        handle.write(_MAGIC)
+        offset = len(_MAGIC)
+        for level in range(len(sizes) - 1, -1, -1):
+            if image.size != sizes[level]:
+                reduced = image.reduce(2)
+                if reduced.size != sizes[level]:
+                    reduced = reduced.resize(sizes[level], Image.Resampling.BOX)
+                image = reduced
+            columns, rows = _grid(sizes[level])
+            level_entries = []
+            for row in range(rows):
+                for column in range(columns):
+                    left, top = column * TILE_SIZE, row * TILE_SIZE
+                    box = (max(left - TILE_OVERLAP, 0), max(top - TILE_OVERLAP, 0),
+                           min(left + TILE_SIZE + TILE_OVERLAP, image.size[0]),
+                           min(top + TILE_SIZE + TILE_OVERLAP, image.size[1]))
+                    buffer = io.BytesIO()
+                    image.crop(box).save(buffer, 'JPEG', quality=TILE_QUALITY)
+                    handle.write(buffer.getbuffer())
+                    level_entries.append(_ENTRY.pack(offset, buffer.tell()))
+                    offset += buffer.tell()
+            entries[level] = b''.join(level_entries)
+        index = b''.join(entries)
+        metadata = json.dumps({"width": sizes[-1][0], "height": sizes[-1][1], "tile_size": TILE_SIZE,
+                               "overlap": TILE_OVERLAP, "format": TILE_FORMAT}).encode()
+        handle.write(index)
+        handle.write(metadata)
+        handle.write(_FOOTER.pack(offset, len(index) // _ENTRY.size, len(metadata), _MAGIC))
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(temporary, path)
+    return len(index) // _ENTRY.size
+
+class TilePack:
+    """Read-only view of a pack's index; tile lookups are pure arithmetic"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as handle:
+            handle.seek(-_FOOTER.size, os.SEEK_END)
+            index_offset, self.tile_count, metadata_length, magic = _FOOTER.unpack(handle.read(_FOOTER.size))
+            if magic != _MAGIC:
+                raise ValueError(f"{path} is not a tile pack")
+            handle.seek(index_offset)
+            self._index = handle.read(self.tile_count * _ENTRY.size)
+            self.metadata = json.loads(handle.read(metadata_length))
+        self.levels = level_sizes(self.metadata['width'], self.metadata['height'])
+        self._level_starts = []
+        start = 0
+        for size in self.levels:
+            self._level_starts.append(start)
+            columns, rows = _grid(size)
+            start += columns * rows
+
+    def locate(self, level, column, row):
+        """(offset, length) of a tile in the pack, or None if there is no such tile"""
+        if not 0 <= level < len(self.levels):
+            return None
+        columns, rows = _grid(self.levels[level])
+        if not (0 <= column < columns and 0 <= row < rows):
+            return None
+        return _ENTRY.unpack_from(self._index, (self._level_starts[level] + row * columns + column) * _ENTRY.size)
+
+    def open_tile(self, level, column, row):
+        """TileReader positioned at a tile, or None if there is no such tile"""
+        location = self.locate(level, column, row)
+        if location is None:
+            return None
+        handle = open(self.path, 'rb', buffering=0)
+        handle.seek(location[0])
+        return TileReader(handle, location[1])
+
+    def descriptor(self):
+        """Deep Zoom Image (.dzi) XML"""
+        return (f'<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{self.metadata["format"]}" '
+                f'Overlap="{self.metadata["overlap"]}" TileSize="{self.metadata["tile_size"]}">'
+                f'<Size Width="{self.metadata["width"]}" Height="{self.metadata["height"]}"/></Image>')
+
+class TileReader:
+    """File object limited to one tile's bytes.
+
+    fileno() exposes the pack positioned at the tile, so a server that
+    implements wsgi.file_wrapper with sendfile() (gunicorn) sends length
+    bytes from there without copying; servers that iterate read() get
+    exactly the tile.
+    """
+
+    def __init__(self, handle, length):
+        self._handle = handle
+        self.length = self._remaining = length
+
+    def read(self, size=-1):
+        size = self._remaining if size is None or size < 0 else min(size, self._remaining)
+        data = self._handle.read(size) if size else b''
+        self._remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self._handle.fileno()
+
+    def close(self):
+        self._handle.close()
+
+_packs = OrderedDict()
+_packs_lock = threading.Lock()
+
+def open_pack(digest, max_open=256):
+    """Cached TilePack for a digest, or None if it has not been built"""
+    with _packs_lock:
+        pack = _packs.get(digest)
+        if pack is not None:
+            _packs.move_to_end(digest)
+            return pack
+    path = pack_path(digest)
+    if not os.path.exists(path):
+        return None
+    pack = TilePack(path)
+    with _packs_lock:
+        _packs[digest] = pack
+        while len(_packs) > max_open:
+            _packs.popitem(last=False)
+    return pack
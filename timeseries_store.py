@@ -0,0 +1,378 @@
+# Compressed time-series store
+#
+# Points are buffered per series in typed arrays and sealed into chunks of
+# CHUNK_POINTS points. A sealed chunk stores timestamps (integer
+# milliseconds) with delta-of-delta encoding and values with Gorilla XOR
+# encoding, plus min/max/sum/count so window aggregates can skip decoding
+# chunks that fall inside one window.
+#
+# Each writer process appends chunks to its own file, so writers never
+# contend. Readers map every chunk file in the directory and index chunk
+# headers without touching payloads. Like report_layout, this module must
+# not import the Flask app so it can be used from benchmarks and workers.
+
+import os
+import mmap
+import socket
+import struct
+import threading
+import time
+from array import array
+from collections import namedtuple
+
+CHUNK_POINTS = 1024
+
+# Unsealed points are only visible to their own process, so heads are also
+# sealed once they are this old, by a background thread or the next read
+MAX_HEAD_SECONDS = 300
+
+_MAGIC = b'TSC1'
+# magic, key length, count, t_min, t_max, v_min, v_max, v_sum, timestamp bytes, value bytes
+_HEADER = struct.Struct('<4sHIqqdddII')
+
+ChunkRef = namedtuple('ChunkRef', 't_min t_max count v_min v_max v_sum path ts_offset ts_length value_offset value_length')
+
+class _BitWriter:
+    """Append-only bit buffer backed by a bytearray"""
+
+    __slots__ = ('buffer', '_acc', '_bits')
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self._acc = 0
+        self._bits = 0
+
+    def write(self, value, nbits):
+        self._acc = (self._acc << nbits) | (value & ((1 << nbits) - 1))
+        self._bits += nbits
+        if self._bits >= 64:
+            self._bits -= 64
+            self.buffer += (self._acc >> self._bits).to_bytes(8, 'big')
+            self._acc &= (1 << self._bits) - 1
+
+    def getvalue(self):
+        if self._bits:
+            padding = -self._bits % 8
+            self.buffer += (self._acc << padding).to_bytes((self._bits + padding) // 8, 'big')
+            self._acc = self._bits = 0
+        return bytes(self.buffer)
+
+def _bit_string(data):
+    """Payload as a string of '0'/'1' characters; slicing it is the fastest bit reader in pure Python"""
+    return format(int.from_bytes(data, 'big'), f'0{len(data) * 8}b')
+
+def _signed(value, nbits):
+    return value - (1 << nbits) if value >> (nbits - 1) else value
+
+# Delta-of-delta buckets: (prefix, prefix bits, value bits)
+_DOD_BUCKETS = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12))
+
+def encode_timestamps(timestamps):
+    writer = _BitWriter()
+    write = writer.write
+    previous = timestamps[0]
+    write(previous, 64)
+    previous_delta = 0
+    for index in range(1, len(timestamps)):
+        timestamp = timestamps[index]
+        delta = timestamp - previous
+        dod = delta - previous_delta
+        if dod == 0:
+            write(0, 1)
+        else:
+            for prefix, prefix_bits, value_bits in _DOD_BUCKETS:
+                limit = 1 << (value_bits - 1)
+                if -limit <= dod < limit:
+                    write(prefix, prefix_bits)
+                    write(dod, value_bits)
+                    break
+            else:
+                write(0b1111, 4)
+                write(dod, 64)
+        previous, previous_delta = timestamp, delta
+    return writer.getvalue()
+
+def decode_timestamps(data, count):
+    bits = _bit_string(data)
+    timestamps = array('q', [_signed(int(bits[:64], 2), 64)])
+    previous, delta, position = timestamps[0], 0, 64
+    for _ in range(count - 1):
+        if bits[position] == '0':
+            position += 1
+        else:
+            if bits[position + 1] == '0':
+                position, value_bits = position + 2, 7
+            elif bits[position + 2] == '0':
+                position, value_bits = position + 3, 9
+            elif bits[position + 3] == '0':
+                position, value_bits = position + 4, 12
+            else:
+                position, value_bits = position + 4, 64
+            delta += _signed(int(bits[position:position + value_bits], 2), value_bits)
+            position += value_bits
+        previous += delta
+        timestamps.append(previous)
+    return timestamps
+
+def encode_values(values):
+    """Gorilla XOR encoding of float64 values"""
+    bits = array('Q')
+    bits.frombytes(array('d', values).tobytes())
+    writer = _BitWriter()
+    write = writer.write
+    previous = bits[0]
+    write(previous, 64)
+    previous_leading, previous_trailing = -1, 0
+    for index in range(1, len(bits)):
+        current = bits[index]
+        xor = current ^ previous
+        if xor == 0:
+            write(0, 1)
+        else:
+            leading = min(64 - xor.bit_length(), 31)
+            trailing = (xor & -xor).bit_length() - 1
+            if previous_leading >= 0 and leading >= previous_leading and trailing >= previous_trailing:
+                # Meaningful bits fit in the previous window
+                write(0b10, 2)
+                write(xor >> previous_trailing, 64 - previous_leading - previous_trailing)
+            else:
+                significant = 64 - leading - trailing
+                write(0b11, 2)
+                write(leading, 5)
+                write(significant - 1, 6)
+                write(xor >> trailing, significant)
+                previous_leading, previous_trailing = leading, trailing
+        previous = current
+    return writer.getvalue()
+
+def decode_values(data, count):
+    bits = _bit_string(data)
+    words = array('Q', [int(bits[:64], 2)])
+    previous, position = words[0], 64
+    leading = trailing = 0
+    for _ in range(count - 1):
+        if bits[position] == '1':
+            if bits[position + 1] == '1':
+                leading = int(bits[position + 2:position + 7], 2)
+                trailing = 64 - leading - int(bits[position + 7:position + 13], 2) - 1
+                position += 11
+            position += 2
+            width = 64 - leading - trailing
+            previous ^= int(bits[position:position + width], 2) << trailing
+            position += width
+        else:
+            position += 1
+        words.append(previous)
+    values = array('d')
+    values.frombytes(words.tobytes())
+    return values
+
+class TimeSeriesStore:
+    """Per-series chunked time-series storage in one directory.
+
+    append()/extend() take integer millisecond timestamps. Points become
+    durable when their chunk is sealed: at CHUNK_POINTS, when the head is
+    max_head_seconds old, or for all series on flush(). Old heads are
+    sealed by a daemon thread, so a series that stops receiving points is
+    still written out. Reads see sealed chunks from every writer plus this
+    process's unsealed points.
+    """
+
+    def __init__(self, directory, writer_id=None, chunk_points=CHUNK_POINTS, max_head_seconds=MAX_HEAD_SECONDS):
+        self.directory = directory
+        self.chunk_points = chunk_points
+        self.max_head_seconds = max_head_seconds
+        os.makedirs(directory, exist_ok=True)
+        writer_id = writer_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.path = os.path.join(directory, f"chunks-{writer_id}.tsc")
+        self._lock = threading.RLock()
+        self._heads = {}
+        self._index = {}
+        self._maps = {}
+        self._scanned = {}
+        self._truncate_torn_tail(self.path)
+        self._file = open(self.path, 'ab')
+        self._closed = threading.Event()
+        self._sealer = threading.Thread(target=self._seal_periodically, name='timeseries-sealer', daemon=True)
+        self._sealer.start()
+
+    # --- writing ---
+
+    def append(self, series, timestamp, value):
+        with self._lock:
+            head = self._heads.get(series)
+            if head is None:
+                head = self._heads[series] = (array('q'), array('d'), time.monotonic())
+            head[0].append(timestamp)
+            head[1].append(value)
+            if len(head[0]) >= self.chunk_points:
+                self._seal(series)
+
+    def extend(self, series, timestamps, values):
+        for timestamp, value in zip(timestamps, values):
+            self.append(series, timestamp, value)
+
+    def _seal(self, series):
+        timestamps, values, _ = self._heads.pop(series)
+        if not timestamps:
+            return
+        key = series.encode('utf-8')
+        ts_data = encode_timestamps(timestamps)
+        value_data = encode_values(values)
+        header = _HEADER.pack(_MAGIC, len(key), len(timestamps), min(timestamps), max(timestamps),
+                              min(values), max(values), sum(values), len(ts_data), len(value_data))
+        self._file.write(header + key + ts_data + value_data)
+        self._file.flush()
+
+    def _seal_expired(self):
+        """Seal heads opened max_head_seconds ago or earlier; the caller holds the lock"""
+        now = time.monotonic()
+        for name, (_, _, opened) in list(self._heads.items()):
+            if now - opened >= self.max_head_seconds:
+                self._seal(name)
+
+    def _seal_periodically(self):
+        while not self._closed.wait(self.max_head_seconds / 2):
+            with self._lock:
+                if self._file.closed:
+                    return
+                self._seal_expired()
+
+    def flush(self, fsync=False):
+        """Seal every open chunk"""
+        with self._lock:
+            for series in list(self._heads):
+                self._seal(series)
+            if fsync:
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            self.flush()
+            self._file.close()
+            for mapped in self._maps.values():
+                mapped.close()
+            self._maps.clear()
+
+    @staticmethod
+    def _truncate_torn_tail(path):
+        """Drop a partially written last chunk left by a crash"""
+        if not os.path.exists(path):
+            return
+        valid = 0
+        with open(path, 'rb') as handle:
+            data = handle.read()
+        while valid + _HEADER.size <= len(data):
+            header = _HEADER.unpack_from(data, valid)
+            end = valid + _HEADER.size + header[1] + header[8] + header[9]
+            if header[0] != _MAGIC or end > len(data):
+                break
+            valid = end
+        if valid < len(data):
+            with open(path, 'r+b') as handle:
+                handle.truncate(valid)
+
+    # --- reading ---
+
+    def _refresh(self):
+        """Index chunks appended since the last read, from every writer's file"""
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.tsc'):
+                continue
+            size = entry.stat().st_size
+            offset = self._scanned.get(entry.path, 0)
+            if size <= offset:
+                continue
+            mapped = self._maps.get(entry.path)
+            if mapped is None or len(mapped) < size:
+                if mapped is not None:
+                    mapped.close()
+                with open(entry.path, 'rb') as handle:
+                    mapped = self._maps[entry.path] = mmap.mmap(handle.fileno(), size, access=mmap.ACCESS_READ)
+            while offset + _HEADER.size <= size:
+                magic, key_length, count, t_min, t_max, v_min, v_max, v_sum, ts_length, value_length = \
+                    _HEADER.unpack_from(mapped, offset)
+                end = offset + _HEADER.size + key_length + ts_length + value_length
+                if magic != _MAGIC or end > size:
+                    break  # chunk still being written
+                key_offset = offset + _HEADER.size
+                series = bytes(mapped[key_offset:key_offset + key_length]).decode('utf-8')
+                ts_offset = key_offset + key_length
+                self._index.setdefault(series, []).append(ChunkRef(
+                    t_min, t_max, count, v_min, v_max, v_sum, entry.path,
+                    ts_offset, ts_length, ts_offset + ts_length, value_length
+                ))
+                offset = end
+            self._scanned[entry.path] = offset
+
+    def _decode(self, chunk):
+        mapped = self._maps[chunk.path]
+        timestamps = decode_timestamps(mapped[chunk.ts_offset:chunk.ts_offset + chunk.ts_length], chunk.count)
+        values = decode_values(mapped[chunk.value_offset:chunk.value_offset + chunk.value_length], chunk.count)
+        return timestamps, values
+
+    def series(self):
+        with self._lock:
+            self._seal_expired()
+            self._refresh()
+            return sorted(set(self._index) | set(self._heads))
+
+    def _parts(self, series, start, end):
+        """Chunks overlapping [start, end), then a copy of the unsealed (timestamps, values) head"""
+        self._seal_expired()
+        self._refresh()
+        for chunk in self._index.get(series, ()):
+            if chunk.t_max >= start and chunk.t_min < end:
+                yield chunk
+        head = self._heads.get(series)
+        if head and head[0]:
+            yield array('q', head[0]), array('d', head[1])
+
+    def scan(self, series, start, end):
+        """Points with start <= timestamp < end, sorted by timestamp"""
+        with self._lock:
+            points = []
+            for part in self._parts(series, start, end):
+                timestamps, values = self._decode(part) if isinstance(part, ChunkRef) else part
+                points.extend((timestamp, value) for timestamp, value in zip(timestamps, values)
+                              if start <= timestamp < end)
+        points.sort(key=lambda point: point[0])
+        return points
+
+    def aggregate(self, series, start, end, window):
+        """Min, max, average and count per window of `window` ms from start, skipping empty windows.
+
+        Chunks that lie entirely inside one window are answered from their
+        header without decoding.
+        """
+        buckets = {}
+
+        def add(bucket, low, high, total, count):
+            current = buckets.get(bucket)
+            if current is None:
+                buckets[bucket] = [low, high, total, count]
+            else:
+                current[0] = min(current[0], low)
+                current[1] = max(current[1], high)
+                current[2] += total
+                current[3] += count
+
+        with self._lock:
+            for part in self._parts(series, start, end):
+                if isinstance(part, ChunkRef):
+                    first = (part.t_min - start) // window
+                    if part.t_min >= start and part.t_max < end and first == (part.t_max - start) // window:
+                        add(first, part.v_min, part.v_max, part.v_sum, part.count)
+                        continue
+                    timestamps, values = self._decode(part)
+                else:
+                    timestamps, values = part
+                for timestamp, value in zip(timestamps, values):
+                    if start <= timestamp < end:
+                        add((timestamp - start) // window, value, value, value, 1)
+
+        return [
+            {'start': start + bucket * window, 'min': low, 'max': high, 'avg': total / count, 'count': count}
+            for bucket, (low, high, total, count) in sorted(buckets.items())
+        ]
@@ -0,0 +1,264 @@
+import os
+import math
+import heapq
+import logging
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import select, insert, update, delete, func, literal, cast, String
+from sqlalchemy.exc import IntegrityError
+from app import app, db
+from models import (PurchaseRequest, CashDemand, ExpenseRecord, TimesheetEntry,
+                    LeaderboardEntry, TeamLeaderboard, User, XpGrant)
+from leaderboard_engine import next_version, user_board, team_board
+from badges import earned_mask
+
+logger = logging.getLogger(__name__)
+
+# XP per domain event
+XP_RULES = {
+    'submission': 10,
+    'approval': 25,
+    'timesheet': 5,
+    'timesheet_on_time': 15
+}
+
+# Bonus XP on the first event of a day, per streak day, capped
+STREAK_BONUS_XP = int(os.environ.get("XP_STREAK_BONUS", 2))
+STREAK_BONUS_CAP = int(os.environ.get("XP_STREAK_BONUS_CAP", 7))
+
+# A timesheet counts as on time when submitted within this many days of the work date
+TIMESHEET_GRACE_DAYS = int(os.environ.get("TIMESHEET_GRACE_DAYS", 1))
+
+XP_PER_LEVEL = 100
+
+# Reviewed models by approval route type; approval XP is granted once per row
+APPROVAL_SOURCES = {'purchase': PurchaseRequest, 'demand': CashDemand, 'expense': ExpenseRecord}
+
+# Rows fetched per round trip and written per statement during replay
+XP_REPLAY_BATCH = int(os.environ.get("XP_REPLAY_BATCH", 5000))
+
+def level_for(xp):
+    """Level 1 at 0 XP, 2 at 100, 3 at 400, 4 at 900, ..."""
+    return int(math.sqrt(max(xp, 0) / XP_PER_LEVEL)) + 1
+
+def timesheet_event(entry):
+    """Event type for a submitted timesheet"""
+    submitted = (entry.submitted_at or datetime.utcnow()).date()
+    if submitted <= entry.work_date + timedelta(days=TIMESHEET_GRACE_DAYS):
+        return 'timesheet_on_time'
+    return 'timesheet'
+
+def advance(state, event_type, day):
+    """Apply one event to a user's state dict (xp, level, streak, last_active_date, badge_mask); returns the XP gained.
+
+    Shared by the live path and replay so both score history identically.
+    """
+    gain = XP_RULES.get(event_type, 0)
+    last = state['last_active_date']
+    if last is None or day > last:
+        state['streak'] = state['streak'] + 1 if last == day - timedelta(days=1) else 1
+        state['last_active_date'] = day
+        gain += min(state['streak'], STREAK_BONUS_CAP) * STREAK_BONUS_XP
+    state['xp'] += gain
+    state['level'] = level_for(state['xp'])
+    state['badge_mask'] |= earned_mask(state, event_type)
+    return gain
+
+def _team_for(department):
+    """Team named after a department, created on first use"""
+    team = TeamLeaderboard.query.filter_by(team_name=department).first()
+    if team is None:
+        team = TeamLeaderboard(team_name=department, total_xp=0, member_count=0, level_total=0, average_level=0)
+        db.session.add(team)
+        db.session.flush()
+    return team
+
+def _adjust_team(team_id, xp=0, levels=0, members=0, version=None):
+    """Apply a delta to a team's running aggregates in SQL"""
+    member_count = func.coalesce(TeamLeaderboard.member_count, 0) + members
+    level_total = func.coalesce(TeamLeaderboard.level_total, 0) + levels
+    db.session.execute(
+        update(TeamLeaderboard).where(TeamLeaderboard.id == team_id).values(
+            total_xp=func.coalesce(TeamLeaderboard.total_xp, 0) + xp,
+            member_count=member_count,
+            level_total=level_total,
+            average_level=func.round(level_total * 1.0 / func.nullif(member_count, 0), 2),
+            last_updated=datetime.utcnow(),
+            version=version
+        )
+    )
+
+def approval_key(kind, item_id):
+    return f"approval:{kind}:{item_id}"
+
+def _insert_once(row):
+    """Add row in a savepoint; False when a unique key says it already exists"""
+    try:
+        with db.session.begin_nested():
+            db.session.add(row)
+    except IntegrityError:
+        return False
+    return True
+
+def record_event(event_type, user_id, department=None, occurred_at=None, source_key=None):
+    """Award XP for a domain event inside the caller's transaction; the caller commits.
+
+    With a source_key the XP is awarded at most once for it (an approval
+    toggled back and forth counts once, as in replay). The user's entry is
+    row-locked so streak updates stay consistent, and the team's totals are
+    adjusted by the delta rather than recomputed.
+    """
+    if not user_id or event_type not in XP_RULES:
+        return 0
+    if source_key and not _insert_once(XpGrant(source_key=source_key, user_id=user_id)):
+        return 0
+    day = (occurred_at or datetime.utcnow()).date()
+
+    entry = LeaderboardEntry.query.filter_by(user_id=user_id).with_for_update().first()
+    if entry is None:
+        # Insert-or-fetch: the unique user_id index turns a concurrent first
+        # event into a wait for the other insert, then a read of its row
+        user = db.session.get(User, user_id)
+        _insert_once(LeaderboardEntry(user_id=user_id, username=user.username if user else None,
+                                      xp=0, level=1, streak=0, badge_mask=0))
+        entry = LeaderboardEntry.query.filter_by(user_id=user_id).with_for_update().first()
+
+    state = {'xp': entry.xp or 0, 'level': entry.level or 1, 'streak': entry.streak or 0,
+             'last_active_date': entry.last_active_date, 'badge_mask': entry.badge_mask or 0}
+    old_level = state['level']
+    gain = advance(state, event_type, day)
+
+    version = next_version()
+    joined = entry.team_id is None and department
+    if joined:
+        entry.team_id = _team_for(department).id
+    entry.xp, entry.level = state['xp'], state['level']
+    entry.streak, entry.last_active_date = state['streak'], state['last_active_date']
+    entry.badge_mask = state['badge_mask']
+    entry.version = version
+
+    if entry.team_id:
+        if joined:
+            _adjust_team(entry.team_id, xp=state['xp'], levels=state['level'], members=1, version=version)
+        else:
+            _adjust_team(entry.team_id, xp=gain, levels=state['level'] - old_level, version=version)
+        team_board.mark_stale()
+    user_board.mark_stale()
+    return gain
+
+def history_events():
+    """All past domain events as (time, user_id, event_type, department), oldest first.
+
+    Each source is streamed in time order and merged, so memory stays flat
+    however long the history is.
+    """
+    def stream(statement):
+        return db.session.execute(statement.execution_options(stream_results=True, yield_per=XP_REPLAY_BATCH))
+
+    sources = []
+    for model in (PurchaseRequest, CashDemand, ExpenseRecord):
+        sources.append((row[0], row[1], 'submission', row[2]) for row in stream(
+            select(model.submitted_at, model.user_id, model.department)
+            .where(model.submitted_at.is_not(None)).order_by(model.submitted_at)
+        ))
+        sources.append((row[0], row[1], 'approval', row[2]) for row in stream(
+            select(model.reviewed_at, model.user_id, model.department)
+            .where(model.status == 'Approved', model.reviewed_at.is_not(None)).order_by(model.reviewed_at)
+        ))
+    sources.append((row.submitted_at, row.user_id, timesheet_event(row), None) for row in stream(
+        select(TimesheetEntry.submitted_at, TimesheetEntry.user_id, TimesheetEntry.work_date)
+        .where(TimesheetEntry.submitted_at.is_not(None)).order_by(TimesheetEntry.submitted_at)
+    ))
+    return heapq.merge(*sources, key=lambda event: event[0])
+
+def replay_history():
+    """Rebuild XP, levels, streaks and team totals for every user from history.
+
+    Events are scored in memory with the same rules as the live path and
+    written back in bulk, then team aggregates are derived from the result.
+    Returns (events, users) processed.
+    """
+    started = time.perf_counter()
+    states = {}
+    events = 0
+    for occurred_at, user_id, event_type, department in history_events():
+        if not user_id:
+            continue
+        state = states.get(user_id)
+        if state is None:
+            state = states[user_id] = {'xp': 0, 'level': 1, 'streak': 0, 'last_active_date': None,
+                                       'badge_mask': 0, 'department': None}
+        state['department'] = state['department'] or department
+        advance(state, event_type, occurred_at.date())
+        events += 1
+
+    version = next_version()
+    existing, existing_badges = {}, {}
+    for user_id, entry_id, badge_mask in db.session.execute(
+        select(LeaderboardEntry.user_id, LeaderboardEntry.id, LeaderboardEntry.badge_mask)
+        .where(LeaderboardEntry.user_id.is_not(None))
+    ):
+        existing[user_id] = entry_id
+        existing_badges[user_id] = badge_mask or 0
+    missing = [user_id for user_id in states if user_id not in existing]
+    usernames = dict(db.session.execute(select(User.id, User.username).where(User.id.in_(missing))).all())
+    teams = {}
+
+    updates, inserts = [], []
+    for user_id, state in states.items():
+        team_id = None
+        if state['department']:
+            if state['department'] not in teams:
+                teams[state['department']] = _team_for(state['department']).id
+            team_id = teams[state['department']]
+        # Badges are never revoked, so keep any granted outside the rules
+        values = dict(xp=state['xp'], level=state['level'], streak=state['streak'],
+                      last_active_date=state['last_active_date'], team_id=team_id, version=version,
+                      badge_mask=state['badge_mask'] | existing_badges.get(user_id, 0))
+        if user_id in existing:
+            updates.append(dict(id=existing[user_id], **values))
+        else:
+            inserts.append(dict(user_id=user_id, username=usernames.get(user_id), **values))
+
+    for batch_start in range(0, len(updates), XP_REPLAY_BATCH):
+        db.session.execute(update(LeaderboardEntry), updates[batch_start:batch_start + XP_REPLAY_BATCH])
+    for batch_start in range(0, len(inserts), XP_REPLAY_BATCH):
+        db.session.execute(insert(LeaderboardEntry), inserts[batch_start:batch_start + XP_REPLAY_BATCH])
+
+    # The approvals just counted are the ones the live path must not count again
+    db.session.execute(delete(XpGrant).where(XpGrant.source_key.like('approval:%')))
+    for kind, model in APPROVAL_SOURCES.items():
+        db.session.execute(insert(XpGrant).from_select(
+            ['source_key', 'user_id'],
+            select(literal(approval_key(kind, '')) + cast(model.id, String), model.user_id)
+            .where(model.status == 'Approved', model.reviewed_at.is_not(None), model.user_id.is_not(None))
+        ))
+
+    # Team aggregates are derived once here; afterwards they are only adjusted
+    aggregates = db.session.execute(
+        select(LeaderboardEntry.team_id, func.sum(LeaderboardEntry.xp),
+               func.sum(LeaderboardEntry.level), func.count(LeaderboardEntry.id))
+        .where(LeaderboardEntry.team_id.is_not(None)).group_by(LeaderboardEntry.team_id)
+    ).all()
+    if aggregates:
+        db.session.execute(update(TeamLeaderboard), [
+            dict(id=team_id, total_xp=xp or 0, level_total=levels or 0, member_count=members,
+                 average_level=round((levels or 0) / members, 2), last_updated=datetime.utcnow(), version=version)
+            for team_id, xp, levels, members in aggregates
+        ])
+    db.session.commit()
+
+    user_board.mark_stale()
+    team_board.mark_stale()
+    elapsed = time.perf_counter() - started
+    logger.info(f"Replayed {events} XP events for {len(states)} users in {elapsed:.1f}s")
+    return events, len(states)
+
+@app.cli.command('replay-xp')
+def replay_xp_command():
+    """Recompute leaderboard XP, streaks and team totals from history."""
+    started = time.perf_counter()
+    events, users = replay_history()
+    elapsed = time.perf_counter() - started
+    print(f"Replayed {events} events for {users} users in {elapsed:.1f}s "
+          f"({events / elapsed if elapsed else 0:,.0f} events/s)")